@@ -0,0 +1,231 @@
+'''
+Throughput benchmark of the ingestion and of the main computed tables on
+synthetic data, against a local MySQL server (see docker-compose.yml).
+
+Each run generates a synthetic Alyx dump and the ALF files of its sessions,
+runs the pipeline stage by stage, and appends the rows inserted, seconds and
+rows per second of every stage to benchmarks/results.csv together with the
+git commit, so that throughput can be compared across commits:
+
+    python -m benchmarks.run --drop --subjects 10 --sessions 5
+    python -m benchmarks.run compare
+'''
+from pathlib import Path
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import datajoint as dj
+import pandas as pd
+
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+RESULTS = BENCHMARK_DIR / 'results.csv'
+LOCAL_HOSTS = ('localhost', '127.0.0.1', 'db', 'mysql')
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+            text=True).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return 'unknown'
+
+
+def drop_schemas():
+    """Drop the pipeline schemas, the benchmark always starts from an empty database"""
+    conn = dj.conn()
+    prefix = dj.config.get('database.prefix', '') + 'ibl\\_'
+    schemas = [s for s, in conn.query(
+        f'SHOW DATABASES LIKE "{prefix}%"').fetchall()]
+    conn.query('SET FOREIGN_KEY_CHECKS=0')
+    try:
+        for s in schemas:
+            print(f'Dropping {s}...')
+            conn.query(f'DROP DATABASE `{s}`')
+    finally:
+        conn.query('SET FOREIGN_KEY_CHECKS=1')
+
+
+class LocalOne:
+    """
+    Stand-in for the ONE instance of behavior_shared, loading the datasets of
+    a session from the synthetic FlatIron tree through the ALF cache.
+    """
+
+    def load(self, eID, dataset_types, **kwargs):
+        import numpy as np
+        from uuid import UUID
+        from ibl_pipeline import acquisition
+        from ibl_pipeline.utils import alf_cache
+
+        if isinstance(dataset_types, str):
+            dataset_types = [dataset_types]
+        key = (acquisition.Session & {'session_uuid': UUID(eID)}).fetch1('KEY')
+        files = alf_cache.load(key, dataset_types)
+        return [np.load(f) for f in files] or [None]
+
+
+def get_stages(dump_file):
+    """
+    Stages of the benchmark, in order, as (name, run, tables counted).
+    Pipeline modules are imported here, after the database is configured.
+    """
+    from ibl_pipeline.ingest import alyxraw
+    from ibl_pipeline.process import (ingest_alyx_raw, ingest_shadow,
+                                      ingest_membership, ingest_real)
+    from ibl_pipeline import acquisition, data, behavior, ephys, behavior_shared
+    from ibl_pipeline.analyses import ephys as ephys_analyses
+    from ibl_pipeline.utils import prefetch
+
+    def populate(*tables, **kwargs):
+        def run():
+            for table in tables:
+                prefetch.populate(table, suppress_errors=True, **kwargs)
+        return run
+
+    # CompleteTrialSession loads the stimulus onset times with ONE
+    behavior_shared.one = LocalOne()
+
+    events = 'event in ("stim on", "feedback")'
+
+    return [
+        ('alyxraw',
+         lambda: ingest_alyx_raw.insert_to_alyxraw(
+             ingest_alyx_raw.get_alyx_entries(dump_file)),
+         [alyxraw.AlyxRaw, alyxraw.AlyxRaw.Field]),
+        ('ingest_shadow', ingest_shadow.main, ingest_shadow.SHADOW_TABLES),
+        ('ingest_membership', ingest_membership.main,
+         [t['dj_current_table'] for t in ingest_membership.MEMBERSHIP_TABLES]),
+        ('ingest_real', ingest_real.main,
+         [acquisition.Session, data.DataSet, data.FileRecord,
+          ephys.ProbeInsertion]),
+        ('trials', populate(behavior.CompleteTrialSession, behavior.TrialSet),
+         [behavior.TrialSet, behavior.TrialSet.Trial]),
+        ('clusters',
+         populate(ephys.CompleteClusterSession, ephys.DefaultCluster),
+         [ephys.DefaultCluster, ephys.DefaultCluster.Metrics]),
+        ('aligned_trial_spikes', populate(ephys.AlignedTrialSpikes, events),
+         [ephys.AlignedTrialSpikes]),
+        ('depth_peth', populate(ephys_analyses.DepthPeth, events),
+         [ephys_analyses.DepthPeth]),
+    ]
+
+
+def count_rows(tables):
+    return sum(len(t()) for t in tables)
+
+
+def run(args):
+    if dj.config['database.host'].split(':')[0] not in LOCAL_HOSTS \
+            and not args.force:
+        raise RuntimeError(
+            'The benchmark drops and fills the pipeline schemas, run it '
+            'against a local server or pass --force.')
+    if args.drop:
+        drop_schemas()
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix='ibl_benchmark_'))
+    data_root = work_dir / 'flatiron'
+    dump_file = work_dir / 'alyxfull.json'
+    # files are copied from the synthetic FlatIron tree instead of downloaded
+    os.environ['ALF_CACHE_LOCAL_ROOT'] = str(data_root)
+    os.environ.setdefault('ALF_CACHE_DIR', str(work_dir / 'alf_cache'))
+
+    from benchmarks import synthetic_alyx
+
+    config = dict(labs=args.labs, subjects=args.subjects,
+                  sessions=args.sessions, ephys_sessions=args.ephys_sessions,
+                  trials=args.trials, spikes=args.spikes,
+                  clusters=args.clusters)
+    print('Generating synthetic data in {}...'.format(work_dir))
+    counts = synthetic_alyx.make_dump(
+        dump_file, data_root, n_labs=args.labs, n_subjects=args.subjects,
+        n_sessions=args.sessions, n_ephys_sessions=args.ephys_sessions,
+        n_trials=args.trials, n_spikes=args.spikes, n_clusters=args.clusters)
+    print(counts)
+
+    import ibl_pipeline  # noqa: F401, sets the stores
+    # external blobs go to a local directory instead of s3
+    for store in dj.config['stores']:
+        dj.config['stores'][store] = dict(
+            protocol='file', location=str(work_dir / 'external' / store))
+
+    commit = get_commit()
+    timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+    results = []
+    for stage, func, tables in get_stages(str(dump_file)):
+        if args.stages and stage not in args.stages:
+            continue
+        print(f'Running {stage}...')
+        n_rows = count_rows(tables)
+        start = time.time()
+        func()
+        seconds = time.time() - start
+        n_rows = count_rows(tables) - n_rows
+        results.append(dict(
+            commit=commit, timestamp=timestamp, stage=stage, rows=n_rows,
+            seconds=seconds, rows_per_sec=n_rows / seconds if seconds else None,
+            config=json.dumps(config, sort_keys=True)))
+        print(f'{stage}: {n_rows} rows in {seconds:.1f} s')
+
+    results = pd.DataFrame(results)
+    results.to_csv(RESULTS, mode='a', header=not RESULTS.exists(), index=False)
+    print(results[['stage', 'rows', 'seconds', 'rows_per_sec']].to_string(
+        index=False))
+
+
+def compare(args):
+    """Throughput of each stage per commit, for runs of the same configuration"""
+    results = pd.read_csv(RESULTS)
+    if args.config:
+        results = results[results['config'] == args.config]
+    else:
+        results = results[results['config'] == results['config'].iloc[-1]]
+    commits = results.drop_duplicates('commit')['commit']
+    table = results.pivot_table(index='stage', columns='commit',
+                                values='rows_per_sec', aggfunc='median')
+    print(table[commits].to_string(float_format='{:.1f}'.format))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', nargs='?', default='run',
+                        choices=['run', 'compare'])
+    parser.add_argument('--labs', type=int, default=2)
+    parser.add_argument('--subjects', type=int, default=5,
+                        help='subjects per lab')
+    parser.add_argument('--sessions', type=int, default=4,
+                        help='sessions per subject')
+    parser.add_argument('--ephys-sessions', type=int, default=1,
+                        help='ephys sessions per subject, with one probe each')
+    parser.add_argument('--trials', type=int, default=600,
+                        help='trials per session')
+    parser.add_argument('--spikes', type=int, default=1000000,
+                        help='spikes per probe')
+    parser.add_argument('--clusters', type=int, default=300,
+                        help='clusters per probe')
+    parser.add_argument('--stages', nargs='*',
+                        help='stages to run, defaults to all')
+    parser.add_argument('--work-dir', help='where the synthetic data is written')
+    parser.add_argument('--drop', action='store_true',
+                        help='drop the pipeline schemas first')
+    parser.add_argument('--force', action='store_true',
+                        help='allow a database host that is not local')
+    parser.add_argument('--config', help='configuration compared, as stored '
+                        'in results.csv, defaults to the latest')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        compare(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+'''
+Synthetic ALF files of a session: trials, wheel, and the spikes, clusters and
+channels of each probe, written in the FlatIron layout
+<root>/<lab>/Subjects/<subject>/<date>/<number>/alf[/<probe>]/.
+'''
+from pathlib import Path
+import hashlib
+import uuid
+import numpy as np
+import pandas as pd
+
+
+# dataset name, dataset type and format of the files written for each session
+TRIALS_DATASETS = [
+    ('_ibl_trials.feedback_times.npy', 'trials.feedback_times'),
+    ('_ibl_trials.feedbackType.npy', 'trials.feedbackType'),
+    ('_ibl_trials.intervals.npy', 'trials.intervals'),
+    ('_ibl_trials.choice.npy', 'trials.choice'),
+    ('_ibl_trials.response_times.npy', 'trials.response_times'),
+    ('_ibl_trials.contrastLeft.npy', 'trials.contrastLeft'),
+    ('_ibl_trials.contrastRight.npy', 'trials.contrastRight'),
+    ('_ibl_trials.probabilityLeft.npy', 'trials.probabilityLeft'),
+    ('_ibl_trials.stimOn_times.npy', 'trials.stimOn_times'),
+    ('_ibl_trials.repNum.npy', 'trials.repNum'),
+    ('_ibl_trials.goCue_times.npy', 'trials.goCue_times'),
+    ('_ibl_trials.goCueTrigger_times.npy', 'trials.goCueTrigger_times'),
+    ('_ibl_trials.rewardVolume.npy', 'trials.rewardVolume'),
+    ('_ibl_trials.itiDuration.npy', 'trials.itiDuration'),
+]
+
+WHEEL_DATASETS = [
+    ('_ibl_wheel.position.npy', 'wheel.position'),
+    ('_ibl_wheel.timestamps.npy', 'wheel.timestamps'),
+    ('_ibl_wheel.velocity.npy', 'wheel.velocity'),
+]
+
+PROBE_DATASETS = [
+    ('clusters.amps.npy', 'clusters.amps'),
+    ('clusters.channels.npy', 'clusters.channels'),
+    ('clusters.depths.npy', 'clusters.depths'),
+    ('clusters.metrics.pqt', 'clusters.metrics'),
+    ('clusters.peakToTrough.npy', 'clusters.peakToTrough'),
+    ('clusters.uuids.csv', 'clusters.uuids'),
+    ('clusters.waveforms.npy', 'clusters.waveforms'),
+    ('clusters.waveformsChannels.npy', 'clusters.waveformsChannels'),
+    ('spikes.amps.npy', 'spikes.amps'),
+    ('spikes.clusters.npy', 'spikes.clusters'),
+    ('spikes.depths.npy', 'spikes.depths'),
+    ('spikes.samples.npy', 'spikes.samples'),
+    ('spikes.templates.npy', 'spikes.templates'),
+    ('spikes.times.npy', 'spikes.times'),
+    ('channels.rawInd.npy', 'channels.rawInd'),
+    ('channels.localCoordinates.npy', 'channels.localCoordinates'),
+]
+
+N_CHANNELS = 384
+FS = 30000
+
+
+def get_trials(n_trials, rng):
+    starts = np.cumsum(rng.uniform(2, 6, n_trials)) + 10
+    stim_on = starts + rng.uniform(0.4, 0.8, n_trials)
+    response = stim_on + rng.uniform(0.1, 2, n_trials)
+    feedback = response + 0.01
+    ends = feedback + rng.uniform(0.6, 1.5, n_trials)
+
+    contrasts = rng.choice([1, 0.25, 0.125, 0.0625, 0], n_trials)
+    left = rng.random(n_trials) < 0.5
+    choice = rng.choice([-1, 1], n_trials)
+    correct = (choice == 1) == left
+    return {
+        'feedback_times': feedback,
+        'feedbackType': np.where(correct, 1, -1),
+        'intervals': np.c_[starts, ends],
+        'choice': choice,
+        'response_times': response,
+        'contrastLeft': np.where(left, contrasts, np.nan),
+        'contrastRight': np.where(left, np.nan, contrasts),
+        'probabilityLeft': rng.choice([0.2, 0.5, 0.8], n_trials),
+        'stimOn_times': stim_on,
+        'repNum': np.ones(n_trials, dtype=int),
+        'goCue_times': stim_on,
+        'goCueTrigger_times': stim_on - 0.005,
+        'rewardVolume': np.where(correct, 1.5, 0),
+        'itiDuration': np.full(n_trials, 0.5),
+    }
+
+
+def get_wheel(duration, rng, fs=1000):
+    timestamps = np.arange(0, duration, 1 / fs)
+    velocity = np.convolve(
+        rng.standard_normal(timestamps.size), np.ones(100) / 100, 'same')
+    return {
+        'position': np.cumsum(velocity) / fs,
+        'timestamps': timestamps,
+        'velocity': velocity,
+    }
+
+
+def get_probe(duration, n_spikes, n_clusters, rng):
+    times = np.sort(rng.uniform(0, duration, n_spikes))
+    clusters = rng.integers(0, n_clusters, n_spikes)
+    cluster_depths = rng.uniform(0, 3840, n_clusters)
+    cluster_channels = (cluster_depths // 10).astype(int)
+
+    spikes = {
+        'times': times,
+        'clusters': clusters,
+        'amps': rng.lognormal(-9, 0.5, n_spikes),
+        'depths': cluster_depths[clusters] + rng.normal(0, 5, n_spikes),
+        'samples': (times * FS).astype(np.int64),
+        'templates': clusters,
+    }
+    clusters = {
+        'amps': rng.lognormal(-9, 0.5, n_clusters),
+        'channels': cluster_channels,
+        'depths': cluster_depths,
+        'metrics': pd.DataFrame({
+            'cluster_id': np.arange(n_clusters),
+            'amp_median': rng.lognormal(-9, 0.5, n_clusters),
+            'firing_rate': rng.uniform(0.1, 20, n_clusters),
+            'presence_ratio': rng.uniform(0.5, 1, n_clusters),
+            'ks2_label': rng.choice(['good', 'mua'], n_clusters)}),
+        'peakToTrough': rng.uniform(0.2, 1, n_clusters),
+        'uuids': pd.DataFrame(
+            {'uuids': [str(uuid.UUID(int=int(i)))
+                       for i in rng.integers(0, 2**63, n_clusters)]}),
+        'waveforms': rng.standard_normal((n_clusters, 82, 32)).astype(np.float32),
+        'waveformsChannels': np.clip(
+            cluster_channels[:, None] + np.arange(-16, 16), 0, N_CHANNELS - 1),
+    }
+    channels = {
+        'rawInd': np.arange(N_CHANNELS),
+        'localCoordinates': np.c_[
+            np.tile([43, 11, 59, 27], N_CHANNELS // 4),
+            np.repeat(np.arange(20, 20 * (N_CHANNELS // 2 + 1), 20), 2)],
+    }
+    return {'spikes': spikes, 'clusters': clusters, 'channels': channels}
+
+
+def save(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix == '.npy':
+        np.save(path, content)
+    elif path.suffix == '.pqt':
+        content.to_parquet(path)
+    else:
+        content.to_csv(path, index=False)
+
+    md5 = hashlib.md5(path.read_bytes()).hexdigest()
+    return md5, path.stat().st_size
+
+
+def write_session(root, session_path, n_trials=600, probes=(),
+                  n_spikes=1000000, n_clusters=300, seed=0):
+    """
+    Write the ALF files of a session.
+
+    Args:
+        root (Path): data root, the local stand-in for FlatIron.
+        session_path (str): <lab>/Subjects/<subject>/<date>/<number>
+        n_trials (int, optional): number of trials.
+        probes (list of str, optional): probe labels, e.g. ['probe00'].
+        n_spikes (int, optional): number of spikes per probe.
+        n_clusters (int, optional): number of clusters per probe.
+        seed (int, optional): random seed.
+
+    Returns:
+        list of dict: dataset_name, dataset_type, relative_path, md5 and
+            file_size of each file written.
+    """
+    rng = np.random.default_rng(seed)
+    trials = get_trials(n_trials, rng)
+    duration = trials['intervals'][-1, 1] + 10
+
+    files = []
+
+    def add(dataset_name, dataset_type, collection, content):
+        relative_path = f'{session_path}/{collection}/{dataset_name}'
+        md5, file_size = save(Path(root) / relative_path, content)
+        files.append(dict(dataset_name=dataset_name, dataset_type=dataset_type,
+                          relative_path=relative_path, md5=md5,
+                          file_size=file_size))
+
+    for dataset_name, dataset_type in TRIALS_DATASETS:
+        add(dataset_name, dataset_type, 'alf',
+            trials[dataset_type.split('.')[1]])
+
+    wheel = get_wheel(duration, rng)
+    for dataset_name, dataset_type in WHEEL_DATASETS:
+        add(dataset_name, dataset_type, 'alf', wheel[dataset_type.split('.')[1]])
+
+    for probe in probes:
+        objects = get_probe(duration, n_spikes, n_clusters, rng)
+        for dataset_name, dataset_type in PROBE_DATASETS:
+            obj, attr = dataset_type.split('.')
+            add(dataset_name, dataset_type, f'alf/{probe}', objects[obj][attr])
+
+    return files
@@ -0,0 +1,189 @@
+'''
+Synthetic Alyx dump in the format of alyxfull.json: a list of
+{"model": ..., "pk": ..., "fields": {...}} entries for labs, users, subjects,
+sessions, probe insertions, datasets and their FlatIron file records.
+
+Primary keys are uuid5 of the model and a name, so that dumps of the same
+configuration are identical across runs and commits.
+'''
+from benchmarks import synthetic_alf
+import datetime
+import json
+import uuid
+
+
+NAMESPACE = uuid.UUID('6b1c9a43-6f4e-4a8e-9c53-2b0e5f4c7a10')
+
+TRAINING_PROTOCOL = '_iblrig_tasks_trainingChoiceWorld6.4.0'
+EPHYS_PROTOCOL = '_iblrig_tasks_ephysChoiceWorld6.4.0'
+
+
+def get_uuid(model, *names):
+    return str(uuid.uuid5(NAMESPACE, '/'.join([model, *map(str, names)])))
+
+
+class AlyxDump:
+    """Entries of a dump, added model by model"""
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, model, name, **fields):
+        pk = get_uuid(model, name)
+        self.entries.append(dict(model=model, pk=pk, fields=fields))
+        return pk
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.entries, f)
+
+
+def add_references(dump, n_labs):
+    """Labs, users, projects and the FlatIron repository of each lab"""
+    fmt = {ext: dump.add('data.dataformat', ext, name=ext, file_extension='.' + ext,
+                         matlab_loader_function=None,
+                         python_loader_function=None, description=None)
+           for ext in ('npy', 'pqt', 'csv')}
+    repotype = dump.add('data.datarepositorytype', 'Fileserver',
+                        name='Fileserver')
+    dump.add('subjects.species', 'mouse', name='Mus musculus', nickname='Laboratory mouse')
+    source = dump.add('subjects.source', 'jax', name='Jax', description=None)
+    probe_model = dump.add('experiments.probemodel', '3B2', name='Neuropixels 3B2',
+                           probe_model='3B2', probe_manufacturer='IMEC',
+                           description=None)
+
+    labs = []
+    for i in range(n_labs):
+        lab_name = f'benchlab{i:02d}'
+        user = dump.add(
+            'misc.labmember', lab_name, username=f'user_{lab_name}',
+            password='!', email=f'user@{lab_name}.org', first_name='Bench',
+            last_name=lab_name, last_login=None,
+            date_joined='2019-01-01T00:00:00', is_active=True, is_staff=False,
+            is_superuser=False, is_stock_manager=False)
+        lab = dump.add(
+            'misc.lab', lab_name, name=lab_name, institution='Benchmark',
+            address='', timezone='Europe/London', reference_weight_pct=0.,
+            zscore_weight_pct=0.)
+        dump.add('misc.labmembership', lab_name, lab=lab, user=user,
+                 role='PI', start_date='2019-01-01', end_date=None)
+        location = dump.add('misc.lablocation', lab_name,
+                            name=f'{lab_name}_rig', lab=lab)
+        repo = dump.add(
+            'data.datarepository', lab_name, name=f'flatiron_{lab_name}',
+            repository_type=repotype, timezone='America/New_York',
+            hostname='ibl.flatironinstitute.org', globus_endpoint_id=None,
+            globus_path=f'/{lab_name}/', globus_is_personal=False,
+            data_url=f'https://ibl.flatironinstitute.org/{lab_name}/')
+        project = dump.add('subjects.project', lab_name,
+                           name=f'{lab_name}_project', description=None,
+                           users=[user], repositories=[repo])
+        labs.append(dict(lab_name=lab_name, lab=lab, user=user,
+                         location=location, repo=repo, project=project))
+
+    return dict(labs=labs, formats=fmt, source=source,
+                probe_model=probe_model)
+
+
+def add_dataset_types(dump, user):
+    dataset_types = dict()
+    for datasets in (synthetic_alf.TRIALS_DATASETS,
+                     synthetic_alf.WHEEL_DATASETS,
+                     synthetic_alf.PROBE_DATASETS):
+        for dataset_name, dataset_type in datasets:
+            dataset_types[dataset_type] = dump.add(
+                'data.datasettype', dataset_type, name=dataset_type,
+                created_by=user, filename_pattern=f'*{dataset_type}*',
+                description=None)
+    return dataset_types
+
+
+def add_datasets(dump, refs, dataset_types, lab, session, files):
+    for f in files:
+        name = f['relative_path']
+        dataset = dump.add(
+            'data.dataset', name, session=session, name=f['dataset_name'],
+            dataset_type=dataset_types[f['dataset_type']],
+            created_by=lab['user'],
+            data_format=refs['formats'][f['dataset_name'].rsplit('.', 1)[1]],
+            created_datetime='2020-01-01T00:00:00', generating_software=None,
+            provenance_directory=None, md5=f['md5'],
+            file_size=f['file_size'])
+        dump.add('data.filerecord', name, dataset=dataset,
+                 data_repository=lab['repo'], relative_path=name,
+                 exists=True)
+
+
+def make_dump(filename, data_root, n_labs=2, n_subjects=5, n_sessions=4,
+              n_ephys_sessions=1, n_trials=600, n_spikes=1000000,
+              n_clusters=300):
+    """
+    Write a synthetic Alyx dump to filename, and the ALF files of its
+    sessions under data_root.
+
+    Args:
+        filename (str): path of the json dump.
+        data_root (str): root of the local FlatIron tree.
+        n_labs (int, optional): number of labs.
+        n_subjects (int, optional): number of subjects per lab.
+        n_sessions (int, optional): number of sessions per subject.
+        n_ephys_sessions (int, optional): number of these sessions per subject
+            that are ephys sessions, with one probe.
+        n_trials (int, optional): number of trials per session.
+        n_spikes (int, optional): number of spikes per probe.
+        n_clusters (int, optional): number of clusters per probe.
+
+    Returns:
+        dict: number of labs, subjects, sessions, probes and datasets.
+    """
+    dump = AlyxDump()
+    refs = add_references(dump, n_labs)
+    dataset_types = add_dataset_types(dump, refs['labs'][0]['user'])
+
+    counts = dict(labs=n_labs, subjects=0, sessions=0, probes=0, datasets=0)
+    start = datetime.datetime(2020, 1, 6, 10)
+    for lab in refs['labs']:
+        for i_subject in range(n_subjects):
+            nickname = f'{lab["lab_name"]}_{i_subject:03d}'
+            subject = dump.add(
+                'subjects.subject', nickname, nickname=nickname, sex='M',
+                strain=None, birth_date='2019-10-01', line=None,
+                protocol_number='1', ear_mark=None, source=refs['source'],
+                description=None, lab=lab['lab'],
+                responsible_user=lab['user'], projects=[lab['project']],
+                cage=None, json=None, litter=None, wean_date=None,
+                death_date=None, cull_method=None)
+            counts['subjects'] += 1
+
+            for i_session in range(n_sessions):
+                is_ephys = i_session >= n_sessions - n_ephys_sessions
+                start_time = start + datetime.timedelta(days=i_session)
+                session_path = '{}/Subjects/{}/{}/001'.format(
+                    lab['lab_name'], nickname, start_time.date())
+                session = dump.add(
+                    'actions.session', session_path, subject=subject,
+                    number=1, start_time=start_time.isoformat(),
+                    end_time=(start_time + datetime.timedelta(hours=1)).isoformat(),
+                    location=lab['location'], type='Experiment',
+                    narrative='', lab=lab['lab'], users=[lab['user']],
+                    project=lab['project'], procedures=[],
+                    parent_session=None,
+                    task_protocol=EPHYS_PROTOCOL if is_ephys else TRAINING_PROTOCOL)
+                counts['sessions'] += 1
+
+                probes = ['probe00'] if is_ephys else []
+                for probe in probes:
+                    dump.add('experiments.probeinsertion',
+                             f'{session_path}/{probe}', session=session,
+                             model=refs['probe_model'], name=probe)
+                    counts['probes'] += 1
+
+                files = synthetic_alf.write_session(
+                    data_root, session_path, n_trials=n_trials, probes=probes,
+                    n_spikes=n_spikes, n_clusters=n_clusters,
+                    seed=counts['sessions'])
+                add_datasets(dump, refs, dataset_types, lab, session, files)
+                counts['datasets'] += len(files)
+
+    dump.save(filename)
+    return counts
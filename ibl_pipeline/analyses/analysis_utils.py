@@ -3,8 +3,7 @@ from .. import subject, action, acquisition, behavior
 from ..utils import psychofit as psy
 import numpy as np
 import pandas as pd
-import scipy
-import scikits.bootstrap as bootstrap
+from scipy import stats
 
 
 def compute_psych_pars(trials):
@@ -79,7 +78,91 @@ def compute_performance_easy(trials):
         return n_correct_trials_easy/len(trials_easy)
 
 
+def get_reaction_time_trials(trials):
+    """Fetch the columns needed for the reaction time of trials in one query.
+
+    The reaction time is measured from the stimulus onset, or from the go cue
+    trigger for trials where the stimulus onset is not available.
+
+    Args:
+        trials (dj query): restriction of behavior.TrialSet.Trial
+
+    Returns:
+        pandas.DataFrame: columns signed_contrast, trial_stim_prob_left and rt
+    """
+    columns = ['signed_contrast', 'trial_stim_prob_left', 'rt']
+    trials_rt = trials.proj(
+        'trial_stim_prob_left',
+        signed_contrast='trial_stim_contrast_left- \
+                        trial_stim_contrast_right',
+        rt='trial_response_time-IFNULL(trial_stim_on_time, \
+                                       trial_go_cue_trigger_time)')
+    rt = pd.DataFrame(trials_rt.fetch(*columns, as_dict=True), columns=columns)
+    return rt.astype(float)
+
+
+def bootstrap_median_ci(x, alpha=0.32, n_samples=10000, chunksz=5000000):
+    """Bias-corrected and accelerated bootstrap confidence interval of the median.
+
+    All resamples are drawn and evaluated as a matrix, in chunks of at most
+    chunksz elements, instead of one resample at a time.
+
+    Args:
+        x (array): samples, NaNs are ignored
+        alpha (float, optional): the interval covers 1-alpha. Defaults to 0.32.
+        n_samples (int, optional): number of resamples. Defaults to 10000.
+        chunksz (int, optional): max number of elements resampled at once.
+
+    Returns:
+        tuple: lower and upper bound, NaN when the interval is undefined
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 2 or np.all(np.isnan(x)):
+        return np.nan, np.nan
+
+    with np.errstate(all='ignore'):
+        stat = np.nanmedian(x)
+
+        rows = max(1, chunksz // n)
+        boot_stat = np.sort(np.concatenate([
+            np.nanmedian(
+                x[np.random.randint(n, size=(min(rows, n_samples - i), n))],
+                axis=1)
+            for i in range(0, n_samples, rows)]))
+
+        # jackknife estimate of the acceleration
+        jack_stat = np.nanmedian(
+            np.broadcast_to(x, (n, n))[~np.eye(n, dtype=bool)].reshape(
+                n, n - 1),
+            axis=1)
+        jack_dev = np.nanmean(jack_stat) - jack_stat
+        a = np.sum(jack_dev**3) / (6.0 * np.sum(jack_dev**2)**1.5)
+
+        z0 = stats.norm.ppf(np.sum(boot_stat < stat) / n_samples)
+        zs = z0 + stats.norm.ppf([alpha/2, 1 - alpha/2])
+        avals = stats.norm.cdf(z0 + zs / (1 - a * zs))
+
+    if not np.all(np.isfinite(avals)):
+        return np.nan, np.nan
+
+    idx = np.round((n_samples - 1) * avals).astype(int)
+    return boot_stat[idx[0]], boot_stat[idx[1]]
+
+
 def compute_reaction_time(trials, compute_ci=False):
+    """Median reaction time for each signed contrast.
+
+    Args:
+        trials (dj query or pandas.DataFrame): restriction of
+            behavior.TrialSet.Trial, or its reaction time columns as
+            returned by get_reaction_time_trials
+        compute_ci (bool, optional): whether to also return the bounds of
+            the 68% confidence interval. Defaults to False.
+    """
+
+    if not isinstance(trials, pd.DataFrame):
+        trials = get_reaction_time_trials(trials)
 
     if not len(trials):
         if compute_ci:
@@ -87,38 +170,12 @@ def compute_reaction_time(trials, compute_ci=False):
         else:
             return np.nan
 
-    # check whether:
-    # 1. There were trials where stim_on_time is not available,
-    #    but go_cue_trigger_time is;
-    # 2. There were any trials where stim_on_time is available.
-    trials_go_cue_only = trials & \
-        'trial_stim_on_time is NULL and trial_go_cue_trigger_time is not NULL'
-    trials_stim_on = trials & \
-        'trial_stim_on_time is not NULL'
-
-    rt = []
-    if len(trials_go_cue_only):
-        trials_rt_go_cue_only = trials_go_cue_only.proj(
-            signed_contrast='trial_stim_contrast_left- \
-                trial_stim_contrast_right',
-            rt='trial_response_time-trial_go_cue_trigger_time')
-        rt += trials_rt_go_cue_only.fetch(as_dict=True)
-
-    if len(trials_stim_on):
-        trials_rt_stim_on = trials.proj(
-            signed_contrast='trial_stim_contrast_left- \
-                            trial_stim_contrast_right',
-            rt='trial_response_time-trial_stim_on_time')
-        rt += trials_rt_stim_on.fetch(as_dict=True)
-
-    rt = pd.DataFrame(rt)
-    rt = rt[['signed_contrast', 'rt']]
-    grouped_rt = rt['rt'].groupby(rt['signed_contrast'])
+    grouped_rt = trials['rt'].groupby(trials['signed_contrast'])
     median_rt = grouped_rt.median()
 
     if compute_ci:
-        ci_rt = grouped_rt.apply(
-            lambda x: bootstrap.ci(x, scipy.nanmedian, alpha=0.32))
+        ci_rt = [bootstrap_median_ci(x.values, alpha=0.32)
+                 for _, x in grouped_rt]
         ci_low = np.array(
             [x[0] if not np.isnan(x[0]) else None for x in ci_rt])
         ci_high = np.array(
@@ -126,3 +183,36 @@ def compute_reaction_time(trials, compute_ci=False):
         return median_rt.values, ci_low, ci_high
     else:
         return median_rt.values
+
+
+def compute_reaction_time_blocks(trials, biased):
+    """Median reaction time and its confidence interval per probability-left block.
+
+    Args:
+        trials (pandas.DataFrame): reaction time columns of the trials of a
+            session, as returned by get_reaction_time_trials
+        biased (bool): if True, split the trials by trial_stim_prob_left,
+            otherwise treat the session as a single block 50.
+
+    Returns:
+        list of dict: prob_left_block, reaction_time_contrast,
+            reaction_time_ci_low and reaction_time_ci_high of each block
+    """
+    if biased:
+        prob_lefts = trials['trial_stim_prob_left'].dropna().unique()
+        blocks = [
+            (round(p_left*10)*10,
+             trials[np.abs(trials['trial_stim_prob_left'] - p_left) < 1e-6])
+            for p_left in prob_lefts]
+    else:
+        blocks = [(50, trials)]
+
+    results = []
+    for prob_left_block, trials_block in blocks:
+        rt = dict(prob_left_block=prob_left_block)
+        rt['reaction_time_contrast'], rt['reaction_time_ci_low'], \
+            rt['reaction_time_ci_high'] = compute_reaction_time(
+                trials_block, compute_ci=True)
+        results.append(rt)
+
+    return results
@@ -3,6 +3,7 @@ from .. import subject, action, acquisition, behavior
 from ..utils import psychofit as psy
 from . import analysis_utils as utils
 from datetime import datetime
+import functools
 import numpy as np
 import pandas as pd
 from pdb import set_trace as bp
@@ -135,10 +136,10 @@ class ReactionTime(dj.Computed):
           go_cue_trigger_times_status in ("Complete", "Partial")')
 
     def make(self, key):
-        trials = behavior.TrialSet.Trial & key & \
-            'trial_stim_on_time is not NULL or trial_go_cue_trigger_time is not NULL'
-        key['reaction_time'] = utils.compute_reaction_time(trials)
-        self.insert1(key)
+        trials = get_session_reaction_time_trials(
+            key['subject_uuid'], key['session_start_time'])
+        self.insert1(
+            dict(**key, reaction_time=utils.compute_reaction_time(trials)))
 
 
 @schema
@@ -160,35 +161,28 @@ class ReactionTimeContrastBlock(dj.Computed):
     def make(self, key):
         task_protocol = (acquisition.Session & key).fetch1(
             'task_protocol')
+        biased = bool(task_protocol) and \
+            ('biased' in task_protocol or 'ephys' in task_protocol)
 
-        trials = behavior.TrialSet.Trial & key & \
-            'trial_stim_on_time is not NULL or trial_go_cue_trigger_time is not NULL'
-
-        if task_protocol and ('biased' in task_protocol or 'ephys' in task_protocol):
-            prob_lefts = dj.U('trial_stim_prob_left') & trials
-
-            for prob_left in prob_lefts:
-                rt = key.copy()
-                p_left = prob_left['trial_stim_prob_left']
-                trials_sub = trials & \
-                    'ABS(trial_stim_prob_left - {})<1e-6'.format(p_left)
-
-                # compute reaction_time
-                rt['reaction_time_contrast'], rt['reaction_time_ci_low'], \
-                    rt['reaction_time_ci_high'] = utils.compute_reaction_time(
-                        trials_sub, compute_ci=True)
-
-                rt['prob_left_block'] = round(p_left*10)*10
+        trials = get_session_reaction_time_trials(
+            key['subject_uuid'], key['session_start_time'])
+        self.insert(
+            [dict(**key, **rt)
+             for rt in utils.compute_reaction_time_blocks(trials, biased)])
 
-                self.insert1(rt)
 
-        else:
-            rt = key.copy()
-            rt['prob_left_block'] = 50
-            rt['reaction_time_contrast'], rt['reaction_time_ci_low'], \
-                rt['reaction_time_ci_high'] = utils.compute_reaction_time(
-                    trials, compute_ci=True)
-            self.insert1(rt)
+@functools.lru_cache(maxsize=1000)
+def get_session_reaction_time_trials(subject_uuid, session_start_time):
+    """
+    Reaction time columns of the trials of a session, cached so that
+    ReactionTime and ReactionTimeContrastBlock share a single fetch per
+    session when populated in the same process.
+    """
+    return utils.get_reaction_time_trials(
+        behavior.TrialSet.Trial &
+        dict(subject_uuid=subject_uuid,
+             session_start_time=session_start_time) &
+        'trial_stim_on_time is not NULL or trial_go_cue_trigger_time is not NULL')
 
 
 @schema
@@ -6,6 +6,7 @@ import datetime
 import logging
 import warnings
 from . import reference, subject, acquisition, data
+from .utils import alf_cache
 
 try:
     from oneibl.one import ONE
@@ -39,8 +40,7 @@ class CompleteWheelSession(dj.Computed):
         (data.FileRecord & flatiron & 'dataset_name="_ibl_wheel.timestamps.npy"')
 
     def make(self, key):
-        datasets = (data.FileRecord & key & 'repo_name LIKE "flatiron_%"' &
-                    {'exists': 1}).fetch('dataset_name')
+        datasets = data.DataSetAvailability.get_datasets(key)
 
         if '_ibl_wheel.velocity.npy' in datasets:
             key['wheel_velocity_status'] = 'Complete'
@@ -111,9 +111,11 @@ class CompleteTrialSession(dj.Computed):
                          "_ibl_trials.contrastRight.npy",
                          "_ibl_trials.probabilityLeft.npy"]
 
+    key_source = acquisition.Session & \
+        data.DataSetAvailability.with_datasets(*required_datasets)
+
     def make(self, key):
-        datasets = (data.FileRecord & key & 'repo_name LIKE "flatiron_%"' &
-                    {'exists': 1}).fetch('dataset_name')
+        datasets = data.DataSetAvailability.get_datasets(key)
         is_complete = bool(np.all([req_ds in datasets
                                    for req_ds in self.required_datasets]))
         if is_complete is True:
@@ -196,30 +198,29 @@ class TrialSet(dj.Imported):
     # Knowledge based hack to be formalized better later
     key_source = acquisition.Session & CompleteTrialSession
 
+    # ALF dataset types loaded by make
+    dataset_types = [
+        'trials.feedback_times',
+        'trials.feedbackType',
+        'trials.intervals',
+        'trials.choice',
+        'trials.response_times',
+        'trials.contrastLeft',
+        'trials.contrastRight',
+        'trials.probabilityLeft',
+        'trials.stimOn_times',
+        'trials.repNum',
+        'trials.included',
+        'trials.goCue_times',
+        'trials.goCueTrigger_times',
+        'trials.rewardVolume',
+        'trials.itiDuration'
+    ]
+
     def make(self, key):
 
         trial_key = key.copy()
-        eID = str((acquisition.Session & key).fetch1('session_uuid'))
-        dtypes = [
-            'trials.feedback_times',
-            'trials.feedbackType',
-            'trials.intervals',
-            'trials.choice',
-            'trials.response_times',
-            'trials.contrastLeft',
-            'trials.contrastRight',
-            'trials.probabilityLeft',
-            'trials.stimOn_times',
-            'trials.repNum',
-            'trials.included',
-            'trials.goCue_times',
-            'trials.goCueTrigger_times',
-            'trials.rewardVolume',
-            'trials.itiDuration'
-            ]
-
-        files = one.load(
-            eID, dataset_types=dtypes, download_only=True, clobber=True)
+        files = alf_cache.load(key, self.dataset_types)
         ses_path = alf.io.get_session_path(files[0])
         trials = alf.io.load_object(
             ses_path.joinpath('alf'), 'trials')
@@ -398,6 +399,7 @@ class Settings(dj.Imported):
     -> acquisition.Session
     ---
     pybpod_board:    varchar(64)   # bpod machine that generated the session
+    quiescent_period=null:  float  # (s) minimum quiescent period of the task, QUIESCENT_PERIOD of the settings
     """
 
     # only check missing data within 5 days
@@ -406,11 +408,12 @@ class Settings(dj.Imported):
         (SettingsAvailability() & 'session_start_time < "{}"'.format(
             date.strftime('%Y-%m-%d')))
 
+    dataset_types = ['_iblrig_taskSettings.raw']
+
     def make(self, key):
-        eID = str((acquisition.Session & key).fetch1('session_uuid'))
         try:
-            setting = one.load(eID, dataset_types='_iblrig_taskSettings.raw',
-                               clobber=True)
+            files = alf_cache.load(key, self.dataset_types)
+            setting = [alf.io.load_file_content(f) for f in files]
         except Exception as e:
             key['error_type'] = 'settings not available'
             SettingsAvailability.insert1(key, allow_direct_insert=True)
@@ -433,6 +436,10 @@ class Settings(dj.Imported):
             SettingsAvailability.insert1(key, allow_direct_insert=True)
             return
         key['pybpod_board'] = setting[0]['PYBPOD_BOARD']
+        # added after the table was declared, see
+        # scripts/updates/update_settings_quiescent_period.py
+        if 'quiescent_period' in self.heading.attributes:
+            key['quiescent_period'] = setting[0].get('QUIESCENT_PERIOD')
         self.insert1(key)
 
 
@@ -447,11 +454,12 @@ class AmbientSensorData(dj.Imported):
     """
     key_source = CompleteTrialSession & 'ambient_sensor_data_status="Complete"'
 
+    dataset_types = ['_iblrig_ambientSensorData.raw']
+
     def make(self, key):
         trial_key = key.copy()
-        eID = str((acquisition.Session & key).fetch1('session_uuid'))
-        asd = one.load(eID, dataset_types='_iblrig_ambientSensorData.raw',
-                       clobber=True)
+        files = alf_cache.load(key, self.dataset_types)
+        asd = [alf.io.load_file_content(f) for f in files]
 
         if not len(TrialSet.Trial & key) == len(asd[0]):
             print('Size of ambient sensor data does not match the trial number')
@@ -101,3 +101,102 @@ class FileRecord(dj.Manual):
     exists:             boolean
     relative_path:      varchar(255)
     """
+
+
+SPIKE_TIMES_PATTERN = '%spikes.times%.npy'
+
+# Datasets tracked in DataSetAvailability, bit i of dataset_bits stands for
+# DATASET_REGISTRY[i]. Names containing % are LIKE patterns.
+# Only append to this list, the positions of existing names must not change.
+DATASET_REGISTRY = [
+    # wheel
+    '_ibl_wheel.position.npy',
+    '_ibl_wheel.timestamps.npy',
+    '_ibl_wheel.velocity.npy',
+    # trials
+    '_ibl_trials.feedback_times.npy',
+    '_ibl_trials.feedbackType.npy',
+    '_ibl_trials.intervals.npy',
+    '_ibl_trials.choice.npy',
+    '_ibl_trials.response_times.npy',
+    '_ibl_trials.contrastLeft.npy',
+    '_ibl_trials.contrastRight.npy',
+    '_ibl_trials.probabilityLeft.npy',
+    '_ibl_trials.stimOn_times.npy',
+    '_ibl_trials.repNum.npy',
+    'ibl_trials.included.npy',
+    '_iblrig_ambientSensorData.raw.jsonable',
+    '_ibl_trials.goCue_times.npy',
+    '_ibl_trials.goCueTrigger_times.npy',
+    '_ibl_trials.rewardVolume.npy',
+    '_ibl_trials.itiDuration.npy',
+    # clusters and spikes
+    'clusters.amps.npy',
+    'clusters.channels.npy',
+    'clusters.depths.npy',
+    'clusters.metrics.pqt',
+    'clusters.peakToTrough.npy',
+    'clusters.uuids.csv',
+    'clusters.waveforms.npy',
+    'clusters.waveformsChannels.npy',
+    'spikes.amps.npy',
+    'spikes.clusters.npy',
+    'spikes.depths.npy',
+    'spikes.samples.npy',
+    'spikes.templates.npy',
+    SPIKE_TIMES_PATTERN,
+]
+
+
+def get_dataset_mask(dataset_names):
+    return sum(1 << DATASET_REGISTRY.index(name) for name in dataset_names)
+
+
+@schema
+class DataSetAvailability(dj.Manual):
+    definition = """
+    # registered datasets available on flatiron for each session, maintained when FileRecord is copied
+    -> acquisition.Session
+    ---
+    dataset_bits:       bigint unsigned     # bit i is set if DATASET_REGISTRY[i] exists
+    availability_ts=CURRENT_TIMESTAMP:  timestamp
+    """
+
+    @classmethod
+    def with_datasets(cls, *dataset_names):
+        """Sessions where all the given registered datasets are available"""
+        mask = get_dataset_mask(dataset_names)
+        return cls & f'dataset_bits & {mask} = {mask}'
+
+    @classmethod
+    def get_datasets(cls, key):
+        """Registered dataset names available for a session"""
+        bits = (cls & key).fetch('dataset_bits')
+        bits = int(bits[0]) if len(bits) else 0
+        return [name for i, name in enumerate(DATASET_REGISTRY)
+                if bits >> i & 1]
+
+    @classmethod
+    def update_sessions(cls, sessions=None):
+        """
+        Recompute the bitmap of sessions from FileRecord, in one query.
+
+        Args:
+            sessions (restriction, optional): sessions to update, all sessions
+                if None.
+        """
+        conditions = ' '.join(
+            'WHEN dataset_name {} "{}" THEN {}'.format(
+                'LIKE' if '%' in name else '=', name, 1 << i)
+            for i, name in enumerate(DATASET_REGISTRY))
+
+        sessions = acquisition.Session if sessions is None \
+            else acquisition.Session & sessions
+        records = FileRecord & 'repo_name LIKE "flatiron_%"' & {'exists': 1}
+
+        with dj.config(safemode=False):
+            (cls & sessions.proj()).delete_quick()
+        cls.insert(
+            sessions.proj().aggr(
+                records, dataset_bits=f'BIT_OR(CASE {conditions} ELSE 0 END)'),
+            ignore_extra_fields=True)
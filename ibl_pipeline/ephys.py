@@ -8,7 +8,7 @@ import pandas as pd
 from uuid import UUID
 import re
 import alf.io
-from ibl_pipeline.utils import atlas
+from ibl_pipeline.utils import atlas, alf_cache, alf_mmap
 
 try:
     wheel = dj.create_virtual_module('wheel', 'group_shared_wheel')
@@ -74,11 +74,10 @@ class CompleteClusterSession(dj.Computed):
 
     def make(self, key):
 
-        datasets = (data.FileRecord & key & 'repo_name LIKE "flatiron_%"' &
-                    {'exists': 1}).fetch('dataset_name')
+        datasets = data.DataSetAvailability.get_datasets(key)
         is_complete = bool(np.all([req_ds in datasets
                                    for req_ds in self.required_datasets])) \
-            and bool(np.any(['spikes.times' in d for d in datasets]))
+            and data.SPIKE_TIMES_PATTERN in datasets
 
         if is_complete:
             self.insert1(key)
@@ -163,16 +162,15 @@ class ChannelGroup(dj.Imported):
             & (data.FileRecord & 'dataset_name="channels.localCoordinates.npy"') - \
                 (ProbeInsertionMissingDataLog & 'missing_data="channels"')
 
-    def make(self, key):
+    # ALF dataset types loaded by make
+    dataset_types = [
+        'channels.rawInd',
+        'channels.localCoordinates'
+    ]
 
-        eID = str((acquisition.Session & key).fetch1('session_uuid'))
-        dtypes = [
-            'channels.rawInd',
-            'channels.localCoordinates'
-        ]
+    def make(self, key):
 
-        files = one.load(eID, dataset_types=dtypes, download_only=True,
-                         clobber=True)
+        files = alf_cache.load(key, self.dataset_types)
         ses_path = alf.io.get_session_path(files[0])
 
         probe_name = (ProbeInsertion & key).fetch1('probe_label')
@@ -224,32 +222,28 @@ class DefaultCluster(dj.Imported):
         key_source = ProbeInsertion & (CompleteClusterSession - ProblematicDataSet) - \
             (ProbeInsertionMissingDataLog & 'missing_data="clusters"')
 
+    # ALF dataset types loaded by make, spikes.times% matches the spike times
+    # of every clock
+    dataset_types = [
+        'clusters.amps',
+        'clusters.channels',
+        'clusters.depths',
+        'clusters.metrics',
+        'clusters.peakToTrough',
+        'clusters.uuids',
+        'clusters.waveforms',
+        'clusters.waveformsChannels',
+        'spikes.amps',
+        'spikes.clusters',
+        'spikes.depths',
+        'spikes.samples',
+        'spikes.templates',
+        'spikes.times%'
+    ]
+
     def make(self, key):
-        eID = str((acquisition.Session & key).fetch1('session_uuid'))
-
-        spikes_times_dtype_name = (
-            data.FileRecord & key &
-            'dataset_name like "%spikes.times%.npy"').fetch1(
-                'dataset_name').split('.npy')[0]
-
-        dtypes = [
-            'clusters.amps',
-            'clusters.channels',
-            'clusters.depths',
-            'clusters.metrics',
-            'clusters.peakToTrough',
-            'clusters.uuids',
-            'clusters.waveforms',
-            'clusters.waveformsChannels',
-            'spikes.amps',
-            'spikes.clusters',
-            'spikes.depths',
-            'spikes.samples',
-            'spikes.templates',
-            spikes_times_dtype_name
-        ]
-
-        files = one.load(eID, dataset_types=dtypes, download_only=True, clobber=True)
+
+        files = alf_cache.load(key, self.dataset_types)
         ses_path = alf.io.get_session_path(files[0])
 
         probe_name = (ProbeInsertion & key).fetch1('probe_label')
@@ -257,7 +251,8 @@ class DefaultCluster(dj.Imported):
         try:
             clusters = alf.io.load_object(
                 ses_path.joinpath('alf', probe_name), 'clusters')
-            spikes = alf.io.load_object(
+            # spikes are memory-mapped, a probe can have tens of millions
+            spikes = alf_mmap.load_object(
                 ses_path.joinpath('alf', probe_name), 'spikes')
         except Exception as e:
             ProbeInsertionMissingDataLog.insert1(
@@ -273,10 +268,14 @@ class DefaultCluster(dj.Imported):
 
         max_spike_time = spikes[time_fname][-1]
 
+        spike_order, cluster_offsets = alf_mmap.group_indices(
+            spikes.clusters, len(clusters.uuids))
+
         for icluster, cluster_uuid in tqdm(enumerate(clusters.uuids['uuids']),
                                            position=0):
 
-            idx = spikes.clusters == icluster
+            idx = spike_order[
+                cluster_offsets[icluster]:cluster_offsets[icluster + 1]]
             cluster = dict(
                 **key,
                 cluster_id=icluster,
@@ -295,7 +294,7 @@ class DefaultCluster(dj.Imported):
 
             self.insert1(cluster)
 
-            num_spikes = len(cluster['cluster_spikes_times'])
+            num_spikes = len(idx)
             firing_rate = num_spikes/max_spike_time
 
             metrics = clusters.metrics.iloc[icluster]
@@ -4,6 +4,8 @@ from logging.handlers import RotatingFileHandler
 import datajoint as dj
 from ibl_pipeline import acquisition, behavior
 import numpy as np
+import pandas as pd
+from tqdm import tqdm
 
 from oneibl.one import ONE
 import brainbox.behavior.wheel as wh
@@ -23,6 +25,39 @@ logger = logging.getLogger(__name__)
 schema = dj.schema('group_shared_wheel')  # group_shared_wheel
 
 
+def get_direction_changes(change_times, intervals):
+    """
+    Assign direction changes to the wheel movements they occur in.
+
+    Each change time is located among the sorted movement onsets with one
+    searchsorted call, instead of masking the whole trace once per movement.
+
+    Args:
+        change_times (np.ndarray): sorted times of the direction changes
+        intervals (np.ndarray): n_moves x 2 array of sorted movement onsets
+            and offsets
+
+    Returns:
+        tuple: move ids, change ids within each movement and times of the
+            direction changes occurring strictly within a movement
+    """
+    move_ids = np.searchsorted(intervals[:, 0], change_times, side='left') - 1
+    within = move_ids >= 0
+    within[within] = change_times[within] < intervals[move_ids[within], 1]
+    move_ids, change_times = move_ids[within], change_times[within]
+
+    # number changes from 0 within each movement
+    change_ids = np.arange(len(move_ids)) - \
+        np.searchsorted(move_ids, move_ids, side='left')
+    return move_ids, change_ids, change_times
+
+
+def insert_chunks(table, entries, chunksz=10000):
+    """Insert the rows of a DataFrame in chunks of chunksz rows."""
+    for i in range(0, len(entries), chunksz):
+        table.insert(entries.iloc[i:i+chunksz])
+
+
 @schema
 class WheelMoveSet(dj.Imported):
     definition = """
@@ -61,7 +96,6 @@ class WheelMoveSet(dj.Imported):
     def make(self, key, one=None):
         # Load the wheel for this session
         move_key = key.copy()
-        change_key = move_key.copy()
         one = one or ONE()
         eid, ver = (acquisition.Session & key).fetch1('session_uuid', 'task_protocol')
         logger.info('WheelMoves for session %s, %s', str(eid), ver)
@@ -87,11 +121,15 @@ class WheelMoveSet(dj.Imported):
             logger.exception(str(ex))
             raise
 
-        # Build list of table entries
-        keys = ('move_id', 'movement_onset', 'movement_offset', 'max_velocity', 'movement_amplitude')
+        # Build columns of the move entries
         on_off, amp, vel_t = wheel_moves.values()  # Unpack into short vars
-        moves = [dict(zip(keys, (i, on, off, vel_t[i], amp[i])), **move_key)
-                 for i, (on, off) in enumerate(on_off)]
+        on_off = on_off.reshape(-1, 2)
+        moves = pd.DataFrame(dict(
+            move_id=np.arange(len(on_off)),
+            movement_onset=on_off[:, 0],
+            movement_offset=on_off[:, 1],
+            max_velocity=vel_t,
+            movement_amplitude=amp))
 
         # Calculate direction changes
         Fs = 1000
@@ -108,13 +146,10 @@ class WheelMoveSet(dj.Imported):
         vel, _ = wh.velocity_smoothed(pos, Fs)
         change_mask = np.insert(np.diff(np.sign(vel)) != 0, 0, 0)
 
-        changes = []
-        for i, (on, off) in enumerate(on_off.reshape(-1, 2)):
-            mask = np.logical_and(ts > on, ts < off)
-            ind = np.logical_and(mask, change_mask)
-            changes.extend(
-                dict(change_key, move_id=i, change_id=j, change_time=t) for j, t in enumerate(ts[ind])
-            )
+        move_ids, change_ids, change_times = get_direction_changes(
+            ts[change_mask], on_off)
+        changes = pd.DataFrame(dict(
+            move_id=move_ids, change_id=change_ids, change_time=change_times))
 
         # Get the units of the position data
         units, *_ = infer_wheel_units(wheel.position)
@@ -129,8 +164,137 @@ class WheelMoveSet(dj.Imported):
 
         # Insert the keys in order
         self.insert1(key)
-        self.Move.insert(moves)
-        self.DirectionChange.insert(changes)
+        insert_chunks(self.Move, moves.assign(**move_key))
+        insert_chunks(self.DirectionChange, changes.assign(**move_key))
+
+
+MOVE_FIELDS = ('move_id', 'movement_onset', 'movement_offset', 'movement_amplitude')
+TRIAL_FIELDS = ('trial_response_choice', 'trial_response_time', 'trial_stim_on_time',
+                'trial_go_cue_time', 'trial_feedback_time', 'trial_start_time')
+
+
+def fetch_session_data(sessions):
+    """
+    Fetch the wheel moves and trials of sessions with one query each.
+
+    Returns:
+        tuple: two dicts (subject_uuid, session_start_time) -> dict of numpy
+            arrays, the moves and the trials of each session
+    """
+    def group_sessions(frame):
+        return {
+            (subject_uuid, pd.Timestamp(session_start_time)): {
+                k: v.values for k, v in
+                group.reset_index()
+                .drop(['subject_uuid', 'session_start_time'], axis=1)
+                .iteritems()}
+            for (subject_uuid, session_start_time), group in frame.groupby(
+                level=['subject_uuid', 'session_start_time'])}
+
+    moves = group_sessions(
+        (WheelMoveSet.Move & sessions)
+        .proj(*MOVE_FIELDS)
+        .fetch(order_by='subject_uuid, session_start_time, move_id', format='frame')
+        .rename(columns={'movement_amplitude': 'peakAmplitude'}))
+    trials = group_sessions(
+        (behavior.TrialSet.Trial & sessions)
+        .proj(*TRIAL_FIELDS)
+        .fetch(order_by='subject_uuid, session_start_time, trial_id', format='frame'))
+    return moves, trials
+
+
+def get_quiescent_periods(sessions):
+    """
+    Minimum quiescent period of sessions, read from behavior.Settings.
+
+    Returns:
+        dict: (subject_uuid, session_start_time) -> quiescent period, None
+            when it was not recorded with the settings
+    """
+    subject_uuids, session_start_times, quiescent_periods = \
+        (behavior.Settings & sessions).fetch(
+            'subject_uuid', 'session_start_time', 'quiescent_period')
+    # a NULL quiescent period is fetched as NaN
+    return {(subject_uuid, pd.Timestamp(session_start_time)):
+            None if pd.isnull(quiescent_period) else float(quiescent_period)
+            for subject_uuid, session_start_time, quiescent_period in zip(
+                subject_uuids, session_start_times, quiescent_periods)}
+
+
+def load_quiescent_period(eid, one=None):
+    """Minimum quiescent period from the task settings file, for sessions missing it in behavior.Settings"""
+    try:
+        one = one or ONE()
+        task_params = one.load_object(str(eid), '_iblrig_taskSettings.raw')
+        return task_params['raw']['QUIESCENT_PERIOD']
+    except Exception:
+        logger.warning('failed to load min quiescent time')
+        return None
+
+
+def compute_movement_times(key, wheel_move_data, trial_data, min_qt):
+    """
+    Find the first movement of each trial of a session.
+
+    Args:
+        key (dict): primary key of the session
+        wheel_move_data (dict): numpy arrays of the WheelMoveSet.Move fields,
+            movement_amplitude renamed to peakAmplitude
+        trial_data (dict): numpy arrays of trial_id and the trial fields
+        min_qt (float): minimum quiescent period, None if unknown
+
+    Returns:
+        pandas.DataFrame: MovementTimes entries of the session
+    """
+    if trial_data['trial_id'].size == 0 or wheel_move_data['move_id'].size == 0:
+        logger.warning('Missing DJ trial or move data')
+        return pd.DataFrame()
+
+    # Many of the timestamps are missing for sessions, therefore will patch together the approximate
+    # closed-loop periods by taking the minimum of go_cue and stim_on, response and feedback.
+    start = np.nanmin(np.c_[trial_data['trial_stim_on_time'], trial_data['trial_go_cue_time']], axis=1)
+    end = np.nanmin(np.c_[trial_data['trial_response_time'], trial_data['trial_feedback_time']], axis=1)
+
+    # Check we have times for at least some trials
+    nan_trial = np.isnan(np.c_[start, end]).any(axis=1)
+    assert ~nan_trial.all(), 'no reliable trials times for session'
+
+    assert (((start < end) | nan_trial).all() and
+            ((np.diff(start) > 0) | np.isnan(np.diff(start))).all()), 'timestamps not increasing'
+    go_trial = trial_data['trial_response_choice'] != 'No Go'
+
+    # Rename data for the firstMovement_times extractor function
+    wheel_move_data = dict(wheel_move_data, intervals=np.c_[
+        wheel_move_data['movement_onset'], wheel_move_data['movement_offset']
+    ])
+    trial_data = {'goCue_times': start, 'feedback_times': end, 'trial_id': trial_data['trial_id']}
+
+    # Find first significant movement for each trial.  To be counted, the movement must
+    # occur between go cue / stim on and before feedback / response time.  The movement
+    # onset is sometimes just before the cue (occurring in the gap between quiescence end and
+    # cue start, or during the quiescence period but sub-threshold).  The movement is
+    # sufficiently large if it is greater than or equal to THRESH
+    onsets, final_movement, ids = extract_first_movement_times(wheel_move_data, trial_data, min_qt)
+    move_ids = np.full_like(onsets, np.nan)
+    move_ids[~np.isnan(onsets)] = ids
+
+    # Check if any movements failed to be detected
+    n_nan = np.count_nonzero(np.isnan(onsets[go_trial]))
+    if n_nan > 0:
+        logger.warning('failed to detect movement on %i go trials', n_nan)
+
+    movement_data = pd.DataFrame(dict(
+        trial_id=trial_data['trial_id'],
+        move_id=move_ids,
+        reaction_time=onsets - start,
+        final_movement=final_movement,
+        movement_time=end - onsets,
+        response_time=end - start,
+        movement_onset=onsets
+    )).astype(float).dropna()
+
+    return movement_data.astype(
+        dict(trial_id=int, move_id=int, final_movement=bool)).assign(**key)
 
 
 @schema
@@ -154,91 +318,50 @@ class MovementTimes(dj.Computed):
         eid, ver = (acquisition.Session & key).fetch1('session_uuid', 'task_protocol')
         logger.info('MovementTimes for session %s, %s', str(eid), ver)
 
-        # Get required data from wheel moves and trials tables, each as a dict of numpy arrays
-        fields = ('move_id', 'movement_onset', 'movement_offset', 'movement_amplitude')
-        wheel_move_data = {k: v.values for k, v in (
-            (
-                (WheelMoveSet.Move & key)
-                .proj(*fields)
-                .fetch(order_by='move_id', format='frame')
-                .reset_index()
-                .drop(['subject_uuid', 'session_start_time'], axis=1)
-                .rename(columns={'movement_amplitude': 'peakAmplitude'})
-                .iteritems()
-            )
-        )}
-
-        fields = ('trial_response_choice', 'trial_response_time', 'trial_stim_on_time',
-                  'trial_go_cue_time', 'trial_feedback_time', 'trial_start_time')
-        trial_data = {k: v.values for k, v in (
-            (
-                (behavior.TrialSet.Trial & key)
-                .proj(*fields)
-                .fetch(order_by='trial_id', format='frame')
-                .reset_index()
-                .drop(['subject_uuid', 'session_start_time'], axis=1)
-                .iteritems()
-            )
-        )}
+        session = (key['subject_uuid'], pd.Timestamp(key['session_start_time']))
+        if session in _prefetched['sessions']:
+            moves, trials, min_qts = \
+                _prefetched['moves'], _prefetched['trials'], _prefetched['min_qts']
+        else:
+            moves, trials = fetch_session_data(key)
+            min_qts = get_quiescent_periods(key)
+        min_qt = min_qts.get(session)
+        if min_qt is None:
+            min_qt = load_quiescent_period(eid, one)
+
+        movement_data = compute_movement_times(
+            key, moves.get(session, {'move_id': np.empty(0)}),
+            trials.get(session, {'trial_id': np.empty(0)}), min_qt)
+        if len(movement_data):
+            self.insert(movement_data)
+
 
-        if trial_data['trial_id'].size == 0 or wheel_move_data['move_id'].size == 0:
-            logger.warning('Missing DJ trial or move data')
-            return
+# moves, trials and quiescent periods of the sessions of the current chunk
+# of populate_movement_times, used by MovementTimes.make
+_prefetched = dict(sessions=set(), moves={}, trials={}, min_qts={})
 
-        # Get minimum quiescent period for session
+
+def populate_movement_times(*restrictions, chunksz=100):
+    """
+    Populate MovementTimes for many sessions in one worker.
+
+    The moves, trials and quiescent periods of chunksz sessions are prefetched
+    with one query each, then the sessions of the chunk are populated, with
+    job reservation so that workers can run in parallel. Errors of single
+    sessions are recorded in the jobs table.
+    """
+    keys = ((MovementTimes.key_source & dj.AndList(restrictions)) -
+            MovementTimes.proj()).fetch('KEY')
+
+    for i in tqdm(range(0, len(keys), chunksz), position=0):
+        sessions = keys[i:i+chunksz]
+        moves, trials = fetch_session_data(sessions)
+        _prefetched.update(
+            sessions={(key['subject_uuid'], pd.Timestamp(key['session_start_time']))
+                      for key in sessions},
+            moves=moves, trials=trials, min_qts=get_quiescent_periods(sessions))
         try:
-            one = one or ONE()
-            task_params = one.load_object(str(eid), '_iblrig_taskSettings.raw')
-            min_qt = task_params['raw']['QUIESCENT_PERIOD']
-        except Exception:
-            logger.warning('failed to load min quiescent time')
-            min_qt = None
-
-        # Many of the timestamps are missing for sessions, therefore will patch together the approximate
-        # closed-loop periods by taking the minimum of go_cue and stim_on, response and feedback.
-        start = np.nanmin(np.c_[trial_data['trial_stim_on_time'], trial_data['trial_go_cue_time']], axis=1)
-        end = np.nanmin(np.c_[trial_data['trial_response_time'], trial_data['trial_feedback_time']], axis=1)
-
-        # Check we have times for at least some trials
-        nan_trial = np.isnan(np.c_[start, end]).any(axis=1)
-        assert ~nan_trial.all(), 'no reliable trials times for session'
-
-        assert (((start < end) | nan_trial).all() and
-                ((np.diff(start) > 0) | np.isnan(np.diff(start))).all()), 'timestamps not increasing'
-        go_trial = trial_data['trial_response_choice'] != 'No Go'
-
-        # Rename data for the firstMovement_times extractor function
-        wheel_move_data['intervals'] = np.c_[
-            wheel_move_data['movement_onset'], wheel_move_data['movement_offset']
-        ]
-        trial_data = {'goCue_times': start, 'feedback_times': end, 'trial_id': trial_data['trial_id']}
-
-        # Find first significant movement for each trial.  To be counted, the movement must
-        # occur between go cue / stim on and before feedback / response time.  The movement
-        # onset is sometimes just before the cue (occurring in the gap between quiescence end and
-        # cue start, or during the quiescence period but sub-threshold).  The movement is
-        # sufficiently large if it is greater than or equal to THRESH
-        onsets, final_movement, ids = extract_first_movement_times(wheel_move_data, trial_data, min_qt)
-        move_ids = np.full_like(onsets, np.nan)
-        move_ids[~np.isnan(onsets)] = ids
-
-        # Check if any movements failed to be detected
-        n_nan = np.count_nonzero(np.isnan(onsets[go_trial]))
-        if n_nan > 0:
-            logger.warning('failed to detect movement on %i go trials', n_nan)
-
-        # Create matrix of values for insertion into table
-        movement_data = np.c_[
-            trial_data['trial_id'],  # trial_id
-            move_ids,  # wheel_move_id
-            onsets - start,  # reaction_time
-            final_movement,  # final_movement
-            end - onsets,  # movement_time
-            end - start,  # response_time
-            onsets  # movement_onset
-        ]
-        data = []
-        for row in movement_data:
-            if ~np.isnan(row).any():  # insert row
-                data.append(tuple([*key.values(), *list(row)]))
-        self.insert(data)
+            MovementTimes.populate(sessions, reserve_jobs=True,
+                                   suppress_errors=True)
+        finally:
+            _prefetched.update(sessions=set(), moves={}, trials={}, min_qts={})
@@ -114,40 +114,58 @@ class ClusterBrainRegionTemp(dj.Computed):
     ---
     -> reference.BrainRegion
     """
-    key_source = ephys.DefaultCluster * Provenance & \
-        ProbeTrajectoryTemp & ephys.ChannelGroup & ChannelBrainLocationTemp
+    key_source = ProbeTrajectoryTemp & ephys.DefaultCluster & \
+        ephys.ChannelGroup & ChannelBrainLocationTemp
 
     def make(self, key):
-        # pdb.set_trace()
+
         channel_raw_inds, channel_local_coordinates = \
             (ephys.ChannelGroup & key).fetch1(
                 'channel_raw_inds', 'channel_local_coordinates')
-        channel = (ephys.DefaultCluster & key).fetch1('cluster_channel')
-        if channel in channel_raw_inds:
-            channel_coords = np.squeeze(
-                channel_local_coordinates[channel_raw_inds == channel])
-        else:
-            return
-
-        q = ChannelBrainLocationTemp & key & \
-            dict(channel_lateral=channel_coords[0],
-                 channel_axial=channel_coords[1])
-
-        if len(q) == 1:
-            key['ontology'], key['acronym'] = q.fetch1(
-                'ontology', 'acronym')
-
-            self.insert1(key)
-        elif len(q) > 1:
-            ontology, acronym = q.fetch('ontology', 'acronym')
-            if len(np.unique(acronym)) == 1:
-                key['ontology'] = 'CCF 2017'
-                key['acronym'] = acronym[0]
-                self.insert1(key)
-            else:
-                print('Conflict regions')
-        else:
-            return
+        cluster_ids, cluster_channels = (ephys.DefaultCluster & key).fetch(
+            'cluster_id', 'cluster_channel')
+        lateral, axial, ontology, acronym = \
+            (ChannelBrainLocationTemp & key).fetch(
+                'channel_lateral', 'channel_axial', 'ontology', 'acronym')
+
+        # regions located at each (lateral, axial) site, in 0.1 um units
+        site_regions = dict()
+        for site, region in zip(
+                zip(np.round(lateral.astype(float) * 10).astype(int),
+                    np.round(axial.astype(float) * 10).astype(int)),
+                zip(ontology, acronym)):
+            site_regions.setdefault(site, set()).add(region)
+
+        # position of each raw channel index in the channel group
+        channel_raw_inds = np.asarray(channel_raw_inds).astype(int)
+        channel_pos = np.full(
+            max(channel_raw_inds.max(), cluster_channels.max()) + 1, -1)
+        channel_pos[channel_raw_inds] = np.arange(len(channel_raw_inds))
+        cluster_pos = channel_pos[cluster_channels.astype(int)]
+        has_channel = cluster_pos >= 0
+
+        cluster_sites = np.round(
+            np.asarray(channel_local_coordinates, dtype=float)[
+                cluster_pos[has_channel], :2] * 10).astype(int)
+
+        entries = []
+        n_conflicts = 0
+        for cluster_id, site in zip(cluster_ids[has_channel], cluster_sites):
+            regions = site_regions.get(tuple(site))
+            if not regions:
+                continue
+            elif len(regions) > 1:
+                n_conflicts += 1
+                continue
+            region_ontology, region_acronym = next(iter(regions))
+            entries.append(dict(**key, cluster_id=cluster_id,
+                                ontology=region_ontology,
+                                acronym=region_acronym))
+
+        if n_conflicts:
+            print(f'Conflict regions for {n_conflicts} clusters')
+
+        self.insert(entries)
 
 
 @schema
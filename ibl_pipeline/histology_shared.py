@@ -1,8 +1,7 @@
 import datajoint as dj
 from . import reference, subject, acquisition, data, ephys, qc
 import numpy as np
-from .utils import atlas
-from tqdm import tqdm
+from .utils import atlas, alf_cache
 from ibllib.pipes.ephys_alignment import EphysAlignment
 import warnings
 from os import environ
@@ -122,16 +121,15 @@ class ChannelBrainLocation(dj.Imported):
                     & (data.FileRecord & 'dataset_name like "%channels.mlapdv%"')) - \
             (ephys.ProbeInsertionMissingDataLog & 'missing_data="channels_brain_region"')
 
-    def make(self, key):
+    # ALF dataset types loaded by make
+    dataset_types = [
+        'channels.brainLocationIds_ccf_2017',
+        'channels.mlapdv'
+    ]
 
-        eID = str((acquisition.Session & key).fetch1('session_uuid'))
-        dtypes = [
-            'channels.brainLocationIds_ccf_2017',
-            'channels.mlapdv'
-        ]
+    def make(self, key):
 
-        files = one.load(eID, dataset_types=dtypes, download_only=True,
-                         clobber=True)
+        files = alf_cache.load(key, self.dataset_types)
         ses_path = alf.io.get_session_path(files[0])
 
         probe_label = (ephys.ProbeInsertion & key).fetch1('probe_label')
@@ -148,22 +146,22 @@ class ChannelBrainLocation(dj.Imported):
             )
             return
 
-        channel_entries = []
-        for ichannel, (brain_loc_id, loc) in tqdm(
-                enumerate(zip(channels['brainLocationIds_ccf_2017'],
-                              channels['mlapdv']))):
-            brain_region_key = (reference.BrainRegion &
-                                {'brain_region_pk': brain_loc_id}).fetch1('KEY')
-
-            channel_entries.append(
-                dict(
-                    channel_idx=ichannel,
-                    **key, **brain_region_key,
-                    channel_ml=loc[0],
-                    channel_ap=loc[1],
-                    channel_dv=loc[2]
-                )
+        ontology = atlas.get_ontology()
+        acronyms = ontology.get_acronyms(channels['brainLocationIds_ccf_2017'])
+
+        channel_entries = [
+            dict(
+                channel_idx=ichannel,
+                **key,
+                ontology=ontology.ontology,
+                acronym=acronym,
+                channel_ml=loc[0],
+                channel_ap=loc[1],
+                channel_dv=loc[2]
             )
+            for ichannel, (acronym, loc) in enumerate(
+                zip(acronyms, channels['mlapdv']))
+        ]
 
         self.insert(channel_entries)
 
@@ -184,16 +182,15 @@ class ClusterBrainRegion(dj.Imported):
         (data.FileRecord & 'dataset_name like "%clusters.brainLocationIds%"') & \
         (data.FileRecord & 'dataset_name like "%clusters.mlapdv%"')
 
-    def make(self, key):
+    # ALF dataset types loaded by make
+    dataset_types = [
+        'clusters.brainLocationIds_ccf_2017',
+        'clusters.mlapdv'
+    ]
 
-        eID = str((acquisition.Session & key).fetch1('session_uuid'))
-        dtypes = [
-            'clusters.brainLocationIds_ccf_2017',
-            'clusters.mlapdv'
-        ]
+    def make(self, key):
 
-        files = one.load(eID, dataset_types=dtypes, download_only=True,
-                         clobber=True)
+        files = alf_cache.load(key, self.dataset_types)
         ses_path = alf.io.get_session_path(files[0])
 
         probe_label = (ephys.ProbeInsertion & key).fetch1('probe_label')
@@ -210,22 +207,22 @@ class ClusterBrainRegion(dj.Imported):
             )
             return
 
-        cluster_entries = []
-        for icluster, (brain_loc_id, loc) in tqdm(
-                enumerate(zip(clusters['brainLocationIds_ccf_2017'],
-                              clusters['mlapdv']))):
-            brain_region_key = (reference.BrainRegion &
-                                {'brain_region_pk': brain_loc_id}).fetch1('KEY')
-
-            cluster_entries.append(
-                dict(
-                    cluster_id=icluster,
-                    **key, **brain_region_key,
-                    cluster_ml=loc[0],
-                    cluster_ap=loc[1],
-                    cluster_dv=loc[2]
-                )
+        ontology = atlas.get_ontology()
+        acronyms = ontology.get_acronyms(clusters['brainLocationIds_ccf_2017'])
+
+        cluster_entries = [
+            dict(
+                cluster_id=icluster,
+                **key,
+                ontology=ontology.ontology,
+                acronym=acronym,
+                cluster_ml=loc[0],
+                cluster_ap=loc[1],
+                cluster_dv=loc[2]
             )
+            for icluster, (acronym, loc) in enumerate(
+                zip(acronyms, clusters['mlapdv']))
+        ]
 
         self.insert(cluster_entries)
 
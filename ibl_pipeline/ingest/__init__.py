@@ -76,6 +76,19 @@ def get_raw_field(key, field, multiple_entries=False, model=None):
         if not multiple_entries and len(query) else query.fetch('fvalue')
 
 
+def get_raw_fields(uuids, fields):
+    '''
+    Fetch single-valued fields of many alyxraw entries in one query.
+    Returns a dictionary uuid string -> dictionary field name -> field value
+    '''
+    query = alyxraw.AlyxRaw.Field & [{'uuid': u} for u in uuids] & \
+        [{'fname': f} for f in fields] & 'value_idx=0'
+    raw_fields = {}
+    for u, fname, fvalue in zip(*query.fetch('uuid', 'fname', 'fvalue')):
+        raw_fields.setdefault(str(u), {})[fname] = fvalue
+    return raw_fields
+
+
 class QueryBuffer(object):
     '''
     QueryBuffer: a utility class to help managed chunked inserts
@@ -1,9 +1,11 @@
 import datajoint as dj
 import json
 import uuid
+from tqdm import tqdm
 
 from . import alyxraw, reference, acquisition
 from . import get_raw_field as grf
+from . import get_raw_fields
 
 schema = dj.schema(dj.config.get('database.prefix', '') +
                    'ibl_ingest_data')
@@ -275,3 +277,146 @@ class FileRecord(dj.Computed):
 
         key_fr['relative_path'] = grf(key, 'relative_path')
         self.insert1(key_fr)
+
+
+class DataResolver:
+    """
+    Resolves the foreign fields of new DataSet and FileRecord entries in memory.
+
+    The dimension tables (dataset types, formats, users and repositories) and
+    the session uuid map are loaded once, the alyxraw fields of the new
+    entries are fetched with one query per chunk.
+    """
+
+    def __init__(self):
+
+        self.sessions = {
+            str(session_uuid): (subject_uuid, session_start_time)
+            for session_uuid, subject_uuid, session_start_time in zip(
+                *acquisition.Session.fetch(
+                    'session_uuid', 'subject_uuid', 'session_start_time'))}
+        self.dataset_types = {
+            str(k): v for k, v in zip(*DataSetType.fetch(
+                'dataset_type_uuid', 'dataset_type_name'))}
+        self.formats = {
+            str(k): v for k, v in zip(*DataFormat.fetch(
+                'format_uuid', 'format_name'))}
+        self.users = {
+            str(k): v for k, v in zip(*reference.LabMember.fetch(
+                'user_uuid', 'user_name'))}
+        self.repos = {
+            str(k): v for k, v in zip(*DataRepository.fetch(
+                'repo_uuid', 'repo_name'))}
+
+    @staticmethod
+    def _optional(value):
+        return None if value == 'None' else value
+
+    def dataset_entry(self, dataset_uuid, fields):
+
+        session = fields.get('session')
+        if session not in self.sessions:
+            print('Session {} is not in the table acquisition.Session'.format(
+                session))
+            print('dataset_uuid: {}'.format(dataset_uuid))
+            return
+
+        dataset_type = fields.get('dataset_type')
+        data_format = fields.get('data_format')
+        if dataset_type not in self.dataset_types or \
+                data_format not in self.formats:
+            print('Dataset type {} or format {} not ingested, dataset_uuid: {}'.format(
+                dataset_type, data_format, dataset_uuid))
+            return
+
+        subject_uuid, session_start_time = self.sessions[session]
+        user = self._optional(fields.get('created_by'))
+        if user is not None and user not in self.users:
+            print(user)
+
+        return dict(
+            dataset_uuid=dataset_uuid,
+            subject_uuid=subject_uuid,
+            session_start_time=session_start_time,
+            dataset_name=fields.get('name'),
+            dataset_type_name=self.dataset_types[dataset_type],
+            dataset_created_by=self.users.get(user),
+            format_name=self.formats[data_format],
+            created_datetime=fields.get('created_datetime'),
+            generating_software=self._optional(fields.get('generating_software')),
+            provenance_directory=self._optional(fields.get('provenance_directory')),
+            md5=self._optional(fields.get('md5')),
+            file_size=self._optional(fields.get('file_size'))
+        )
+
+    def file_record_entry(self, record_uuid, fields, datasets):
+
+        dataset = fields.get('dataset')
+        if dataset not in datasets:
+            print('Dataset {} is not in the table data.DataSet'.format(dataset))
+            print('Record_uuid: {}'.format(record_uuid))
+            return
+
+        repo = fields.get('data_repository')
+        if repo not in self.repos:
+            print('Repository {} is not in the table data.DataRepository'.format(repo))
+            return
+
+        subject_uuid, session_start_time, dataset_name = datasets[dataset]
+        return dict(
+            record_uuid=record_uuid,
+            exists=True,
+            subject_uuid=subject_uuid,
+            session_start_time=session_start_time,
+            dataset_name=dataset_name,
+            repo_name=self.repos[repo],
+            relative_path=fields.get('relative_path')
+        )
+
+
+DATASET_FIELDS = ['session', 'name', 'dataset_type', 'created_by',
+                  'data_format', 'created_datetime', 'generating_software',
+                  'provenance_directory', 'md5', 'file_size']
+FILE_RECORD_FIELDS = ['dataset', 'data_repository', 'relative_path']
+
+
+def ingest_datasets(key_source, resolver=None, chunksz=10000):
+    """
+    Resolve and insert DataSet entries of key_source in chunks of chunksz.
+    """
+    resolver = resolver or DataResolver()
+    uuids = [str(u) for u in key_source.fetch('dataset_uuid')]
+
+    for i in tqdm(range(0, len(uuids), chunksz), position=0):
+        chunk = uuids[i:i+chunksz]
+        raw_fields = get_raw_fields(chunk, DATASET_FIELDS)
+        entries = [resolver.dataset_entry(u, raw_fields.get(u, {}))
+                   for u in chunk]
+        DataSet.insert([e for e in entries if e], skip_duplicates=True,
+                       allow_direct_insert=True)
+
+
+def ingest_file_records(key_source, resolver=None, chunksz=10000):
+    """
+    Resolve and insert FileRecord entries of key_source in chunks of chunksz.
+    The datasets referred to by each chunk are fetched with one query.
+    """
+    resolver = resolver or DataResolver()
+    uuids = [str(u) for u in key_source.fetch('record_uuid')]
+
+    for i in tqdm(range(0, len(uuids), chunksz), position=0):
+        chunk = uuids[i:i+chunksz]
+        raw_fields = get_raw_fields(chunk, FILE_RECORD_FIELDS)
+        dataset_uuids = set(
+            f['dataset'] for f in raw_fields.values()
+            if f.get('dataset', 'None') != 'None')
+        datasets = {
+            str(dataset_uuid): (subject_uuid, session_start_time, dataset_name)
+            for dataset_uuid, subject_uuid, session_start_time, dataset_name in zip(
+                *(DataSet & [{'dataset_uuid': u} for u in dataset_uuids]).fetch(
+                    'dataset_uuid', 'subject_uuid', 'session_start_time',
+                    'dataset_name'))} if dataset_uuids else {}
+        entries = [resolver.file_record_entry(u, raw_fields.get(u, {}), datasets)
+                   for u in chunk]
+        FileRecord.insert([e for e in entries if e], skip_duplicates=True,
+                          allow_direct_insert=True)
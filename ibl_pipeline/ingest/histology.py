@@ -10,6 +10,7 @@ from . import get_raw_field as grf
 
 from ibl_pipeline import acquisition as acquisition_real
 from ibl_pipeline import ephys as ephys_real
+from ibl_pipeline.utils import atlas
 
 schema = dj.schema(dj.config.get('database.prefix', '') +
                    'ibl_ingest_histology')
@@ -135,9 +136,15 @@ class ChannelBrainLocationTemp(dj.Imported):
             return None
 
         brain_region_pk = grf(key, 'brain_region')
-        ontology, acronym = (reference.BrainRegion &
-                             dict(brain_region_pk=brain_region_pk)).fetch1(
-                                 'ontology', 'acronym')
+        try:
+            index = atlas.get_ontology()
+            ontology = index.ontology
+            acronym = index.get_acronyms([brain_region_pk])[0]
+        except KeyError:
+            # region not yet copied to the real table
+            ontology, acronym = (reference.BrainRegion &
+                                 dict(brain_region_pk=brain_region_pk)).fetch1(
+                                     'ontology', 'acronym')
 
         key_brain_loc.update(
             channel_x=grf(key, 'x'),
@@ -47,7 +47,8 @@ class Task(dj.Lookup):
         ['Ingest shadow membership', 5, 'Ingest to alyx shadow membership tables'],
         ['Ingest real', 6, 'Ingest to alyx real tables'],
         ['Update fields', 7, 'Update fields in real tables'],
-        ['Populate behavior', 8, 'Populate behavior tables']
+        ['Populate behavior', 8, 'Populate behavior tables'],
+        ['Process histology', 9, 'Reprocess histology of probe insertions with changed trajectories or channels']
     ]
 
 
@@ -62,3 +63,66 @@ class TaskStatus(dj.Manual):
     task_duration           :  float     # in mins
     task_status_comments='' :  varchar(1000)
     """
+
+    class TableRun(dj.Part):
+        definition = """
+        # instrumentation of the ingestion or populate of a table within the task
+        -> master
+        table_name              : varchar(255)  # schema and class name, e.g. ibl_behavior.TrialSet
+        ---
+        keys_attempted=null     : int           # pending keys, null if not populated from a key source
+        keys_succeeded=null     : int
+        keys_failed=null        : int
+        rows_inserted           : bigint        # rows reported by the INSERT statements, including part tables
+        db_round_trips          : int           # number of statements sent to the database
+        bytes_fetched           : bigint        # bytes fetched from the external stores
+        wall_time               : float         # in secs
+        cpu_time                : float         # in secs, of this process
+        """
+
+
+@schema
+class SubjectChange(dj.Manual):
+    definition = """
+    # subjects that received new rows during ingestion
+    subject_uuid                : uuid
+    change_source               : varchar(64)   # name of the table that received new rows
+    change_ts=CURRENT_TIMESTAMP : timestamp
+    ---
+    lab_name=null               : varchar(255)  # lab of the subject at the time of the change
+    """
+
+
+@schema
+class RefreshRun(dj.Manual):
+    definition = """
+    # runs of the summary refreshes driven by SubjectChange
+    refresh_job             : varchar(64)   # name of the refreshed table
+    refresh_ts              : timestamp     # changes logged up to this time are covered
+    ---
+    n_recomputed            : int           # number of subjects or labs recomputed
+    n_skipped               : int           # number of subjects or labs skipped as unchanged
+    refresh_duration        : float         # in mins
+    """
+
+
+@schema
+class ProbeHistologyHash(dj.Manual):
+    definition = """
+    # content hash of the alyx trajectory estimates and channels of each probe insertion
+    probe_insertion_uuid        : uuid
+    ---
+    histology_hash              : char(32)  # md5 over the trajectory and channel records
+    hash_ts=CURRENT_TIMESTAMP   : timestamp
+    """
+
+
+@schema
+class DeletionStage(dj.Manual):
+    definition = """
+    # uuids staged for chunked deletion
+    stage               : varchar(64)   # name of the deletion run
+    uuid                : uuid
+    ---
+    chunk               : int           # index of the chunk the uuid is deleted in
+    """
@@ -64,8 +64,9 @@ class WaterWeight(dj.Part):
     water_weight: longblob    # dict for the plotting info
     """
 
-    def make(self, key, d):
-        subj = subject.Subject & key
+    def make(self, key, d, snapshot=None):
+        if snapshot is None:
+            snapshot = putils.load_subject_snapshot(subject.Subject & key)
         # plot for water weight
         water_type_names, water_type_colors = WaterTypeColor.fetch(
             'watertype_name', 'water_type_color')
@@ -74,14 +75,11 @@ class WaterWeight(dj.Part):
         for watertype, color in zip(water_type_names, water_type_colors):
             water_type_map.update({watertype: color})
 
-        if action.WaterAdministration * action.Weighing & key:
+        water_info = snapshot['water_administration']
+        weight_info = snapshot['weighing']
+        if len(water_info) and len(weight_info):
             water_weight_entry = key.copy()
             # get water and date
-            water_info_query = (action.WaterAdministration & subj).proj(
-                'water_administered', 'watertype_name',
-                water_date='DATE(administration_time)')
-            water_info = water_info_query.fetch(as_dict=True)
-            water_info = pd.DataFrame(water_info)
             water_types = water_info.watertype_name.unique()
             water_info_type = water_info.pivot_table(
                 index='water_date', columns='watertype_name',
@@ -90,17 +88,12 @@ class WaterWeight(dj.Part):
             yrange_water = [0, max_water_intake]
             water_info_type = water_info_type.where(
                 (pd.notnull(water_info_type)), None)
-            weight_info_query = (action.Weighing & subj).proj(
-                'weight', weighing_date='DATE(weighing_time)')
-            weight_info = weight_info_query.fetch(as_dict=True)
-            weight_info = pd.DataFrame(weight_info)
             weight_info = weight_info.where((pd.notnull(weight_info)), None)
 
             # get water restriction period
-            water_restrictions = (action.WaterRestriction & subj).proj(
-                'reference_weight',
-                res_start='DATE(restriction_start_time)',
-                res_end='DATE(restriction_end_time)')
+            water_restrictions = snapshot['water_restriction']
+            water_restrictions = water_restrictions.where(
+                (pd.notnull(water_restrictions)), None)
 
             data = [
                 go.Bar(
@@ -137,7 +130,7 @@ class WaterWeight(dj.Part):
 
             # water restriction marks and reference weight marks
             for iwater, water_res in \
-                    enumerate(water_restrictions.fetch(as_dict=True)):
+                    enumerate(water_restrictions.to_dict('records')):
 
                 if iwater == 0:
                     show_res_legend = True
@@ -308,57 +301,105 @@ class DailyLabSummary(dj.Computed):
         last_filerecord = subjects.aggr(
             filerecord, latest_session_on_flatiron='max(session_start_time)')
 
-        summary = (last_sessions*last_filerecord).proj(
+        summary = pd.DataFrame((last_sessions*last_filerecord).proj(
             'subject_nickname', 'task_protocol', 'training_status',
-            'latest_session_on_flatiron').fetch(
-                as_dict=True)
-
-        for entry in summary:
-            subj = subject.Subject & entry
-            protocol = entry['task_protocol'].partition('ChoiseWorld')[0]
-
-            # --- check for data availability ---
-
-            # last session_start_time in table acquisition.Session
-            if not len(acquisition.Session & subj):
-                data_update_status = 'No behavioral data collected'
-            else:
-                # get the latest session query
-                last_session = subj.aggr(
-                    acquisition.Session,
-                    session_start_time='max(session_start_time)')
-
-                last_session_date = last_session.proj(
-                    session_date='date(session_start_time)')
-
-                last_date = last_session_date.fetch1(
-                    'session_date').strftime('%Y-%m-%d')
-
-                # existence of CompleteTrialSet tuple for latest session
-                if not len(behavior_ingest.CompleteTrialSession & last_session):
-                    data_update_status = """
+            'latest_session_on_flatiron').fetch(as_dict=True))
+
+        if not len(summary):
+            return
+
+        # --- check for data availability, for all subjects at once ---
+
+        # last session_start_time in table acquisition.Session
+        last_session = subjects.aggr(
+            acquisition.Session,
+            last_session_time='max(session_start_time)')
+        last_session_key = last_session.proj(
+            session_start_time='last_session_time')
+        last_session_date = last_session_key.proj(
+            session_date='date(session_start_time)')
+
+        def subjects_with(query):
+            return set((dj.U('subject_uuid') & query).fetch('subject_uuid'))
+
+        with_complete_trials = subjects_with(
+            behavior_ingest.CompleteTrialSession & last_session_key)
+        with_trial_set = subjects_with(
+            behavior_ingest.TrialSet & last_session_key)
+        with_summary_by_date = subjects_with(
+            behavior.BehavioralSummaryByDate & last_session_date)
+
+        latest_cumulative = dict(zip(*subjects.aggr(
+            behavior_shared.CumulativeSummary,
+            latest_date='max(latest_date)').fetch(
+                'subject_uuid', 'latest_date')))
+
+        last_session_times = dict(zip(*last_session.fetch(
+            'subject_uuid', 'last_session_time')))
+
+        summary['last_session_time'] = summary['subject_uuid'].map(
+            last_session_times)
+        summary['last_date'] = [
+            t.strftime('%Y-%m-%d') if pd.notnull(t) else None
+            for t in summary['last_session_time']]
+        summary['cumulative_date'] = summary['subject_uuid'].map(
+            latest_cumulative)
+
+        has_cumulative = np.array([
+            pd.notnull(c) and pd.notnull(t) and c >= t.date()
+            for c, t in zip(summary['cumulative_date'],
+                            summary['last_session_time'])], dtype=bool)
+
+        conditions = [
+            summary['last_session_time'].isnull().values,
+            ~summary['subject_uuid'].isin(with_complete_trials).values,
+            ~summary['subject_uuid'].isin(with_trial_set).values,
+            ~summary['subject_uuid'].isin(with_summary_by_date).values,
+            ~has_cumulative
+        ]
+        status_templates = [
+            'No behavioral data collected',
+            """
                     Data in the last session on {} were not uploaded
                     or partially uploaded to FlatIron.
-                    """.format(last_date)
-                elif not len(behavior_ingest.TrialSet & last_session):
-                    data_update_status = """
+                    """,
+            """
                     Ingest error in TrialSet for data on {}.
-                    """.format(last_date)
-                elif not len(behavior.BehavioralSummaryByDate & last_session_date):
-                    data_update_status = """
+                    """,
+            """
                     Ingest error in BehavioralSummaryByDate for
                     data on {}
-                    """.format(last_date)
-                elif not len(behavior_shared.CumulativeSummary & last_session.proj(latest_session='session_date')):
-                    data_update_status = """
+                    """,
+            """
                     Error in creating cumulative plots for data on {}
-                    """.format(last_date)
-                else:
-                    data_update_status = """
+                    """
+        ]
+        templates = np.select(
+            conditions, status_templates, default="""
                     Data up to date
-                    """.format(last_date)
-
-            subject_summary = dict(
+                    """)
+        summary['data_update_status'] = [
+            template.format(last_date)
+            for template, last_date in zip(templates, summary['last_date'])]
+
+        # --- number of sessions in the current protocol ---
+        sessions = pd.DataFrame(
+            (ingested_sessions & subjects).fetch(
+                'subject_uuid', 'task_protocol', as_dict=True),
+            columns=['subject_uuid', 'task_protocol'])
+        sessions = sessions.merge(
+            summary[['subject_uuid', 'task_protocol']].rename(
+                columns={'task_protocol': 'latest_task_protocol'}),
+            on='subject_uuid')
+        protocol_prefix = sessions['latest_task_protocol'].str.partition(
+            'ChoiseWorld')[0].str.lower()
+        sessions['current_protocol'] = [
+            protocol.startswith(prefix) for protocol, prefix in
+            zip(sessions['task_protocol'].str.lower(), protocol_prefix)]
+        n_sessions = sessions.groupby('subject_uuid')['current_protocol'].sum()
+
+        self.SubjectSummary.insert([
+            dict(
                 **key,
                 subject_uuid=entry['subject_uuid'],
                 subject_nickname=entry['subject_nickname'],
@@ -366,12 +407,11 @@ class DailyLabSummary(dj.Computed):
                 latest_session_on_flatiron=entry['latest_session_on_flatiron'],
                 latest_task_protocol=entry['task_protocol'],
                 latest_training_status=entry['training_status'],
-                n_sessions_current_protocol=len(
-                    ingested_sessions & subj &
-                    'task_protocol LIKE "{}%"'.format(protocol)),
-                data_update_status=data_update_status
+                n_sessions_current_protocol=int(
+                    n_sessions.get(entry['subject_uuid'], 0)),
+                data_update_status=entry['data_update_status']
             )
-            self.SubjectSummary.insert1(subject_summary)
+            for entry in summary.to_dict('records')])
 
     class SubjectSummary(dj.Part):
         definition = """
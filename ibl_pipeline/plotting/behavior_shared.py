@@ -201,7 +201,48 @@ class CumulativeSummary(dj.Computed):
         fit_pars: longblob  # dict for the plotting info
         """
 
+    def fetch_previous(self, key):
+        """
+        Fetch the plots stored for the most recent entry of the subject
+        before key['latest_date'].
+
+        Returns:
+            tuple: latest_date of that entry (None if there is none) and
+                a dictionary of the plotly json of each part, keyed by the
+                name of its plotting field.
+        """
+        previous_dates = (
+            self & {'subject_uuid': key['subject_uuid']} &
+            'latest_date < "{}"'.format(
+                key['latest_date'].strftime('%Y-%m-%d'))).fetch(
+                    'latest_date', order_by='latest_date desc', limit=1)
+
+        if not len(previous_dates):
+            return None, dict()
+
+        previous_key = dict(subject_uuid=key['subject_uuid'],
+                            latest_date=previous_dates[0])
+        parts = [
+            (self.TrialCountsSessionDuration, 'trial_counts_session_duration'),
+            (self.PerformanceReactionTime, 'performance_reaction_time'),
+            (self.ContrastHeatmap, 'contrast_heatmap'),
+            (self.FitPars, 'fit_pars')]
+
+        previous = dict()
+        for part, field in parts:
+            plots = (part & previous_key).fetch(field)
+            if len(plots):
+                previous[field] = plots[0]
+
+        return previous_dates[0], previous
+
     def make(self, key):
+        """
+        Build all cumulative plots of a subject from one snapshot of its
+        history. If the subject has an earlier entry, its data traces are
+        reused and only the dates since its latest_date are fetched and
+        appended. Deleting all entries of a subject forces a full rebuild.
+        """
         self.insert1(key)
 
         # check the environment, public or internal
@@ -212,10 +253,16 @@ class CumulativeSummary(dj.Computed):
             public = False
 
         subj = subject.Subject & key
+
+        since, previous = self.fetch_previous(key)
+
+        snapshot = putils.load_subject_snapshot(
+            subj, public=public, since=since)
+
         # get the first date when animal became "trained" and "ready for ephys"
-        status = putils.get_status(subj)
+        status = snapshot['status']
         # get date range and mondays
-        d = putils.get_date_range(subj, include_water_weight=not public)
+        d = snapshot['date_range']
 
         if d['seven_months_date']:
             status['is_over_seven_months'] = True
@@ -224,24 +271,29 @@ class CumulativeSummary(dj.Computed):
             status['is_over_seven_months'] = False
 
         # plot for trial counts and session duration
-        if behavior_ingest.TrialSet & key:
+        session_info = snapshot['trial_sets']
+        previous_trial_cnts = previous.get('trial_counts_session_duration')
+        if len(session_info) or previous_trial_cnts:
             trial_cnts = key.copy()
             # get trial counts and session length to date
-            session_info = (behavior_ingest.TrialSet *
-                            acquisition.Session & subj).proj(
-                'n_trials', session_date='DATE(session_start_time)',
-                session_duration='TIMESTAMPDIFF(MINUTE, \
-                    session_start_time, session_end_time)').fetch(as_dict=True)
-            session_info = pd.DataFrame(session_info)
             session_info = session_info.where((pd.notnull(session_info)), None)
+            session_dates = [t.strftime('%Y-%m-%d')
+                             for t in session_info['session_date'].tolist()]
+
+            trial_dates, n_trials = putils.merge_trace_points(
+                previous_trial_cnts, 'trial counts',
+                session_dates, session_info['n_trials'].tolist(), since)
+            duration_dates, session_duration = putils.merge_trace_points(
+                previous_trial_cnts, 'session duration',
+                session_dates, session_info['session_duration'].tolist(),
+                since)
 
-            n_trials = session_info['n_trials'].tolist()
             max_trials = max(n_trials)
             yrange = [0, max_trials+50]
 
             trial_counts = go.Scatter(
-                x=[t.strftime('%Y-%m-%d') for t in session_info['session_date'].tolist()],
-                y=session_info['n_trials'].tolist(),
+                x=trial_dates,
+                y=n_trials,
                 mode='markers+lines',
                 marker=dict(
                     size=6,
@@ -257,8 +309,8 @@ class CumulativeSummary(dj.Computed):
             )
 
             session_length = go.Scatter(
-                x=[t.strftime('%Y-%m-%d') for t in session_info['session_date'].tolist()],
-                y=session_info['session_duration'].tolist(),
+                x=duration_dates,
+                y=session_duration,
                 mode='markers+lines',
                 marker=dict(
                     size=6,
@@ -325,26 +377,29 @@ class CumulativeSummary(dj.Computed):
             trial_cnts['trial_counts_session_duration'] = fig.to_plotly_json()
             self.TrialCountsSessionDuration.insert1(trial_cnts)
 
-        # plot for performance reaction time and fit pars
-        if behavior.BehavioralSummaryByDate & key:
+        # plot for performance reaction time
+        session_info = snapshot['summary_by_date']
+        previous_perf_rt = previous.get('performance_reaction_time')
+        if len(session_info) or previous_perf_rt:
             perf_rt = key.copy()
-            session_info = \
-                (behavior.BehavioralSummaryByDate *
-                    behavior.BehavioralSummaryByDate.ReactionTimeByDate &
-                    key).proj(
-                        'session_date',
-                        'performance_easy',
-                        'median_reaction_time').fetch(as_dict=True)
-            session_info = pd.DataFrame(session_info)
             yrange = [0, 1.1]
+            session_dates = [t.strftime('%Y-%m-%d')
+                             for t in session_info['session_date'].tolist()]
             perf_easy = [None if not p or np.isnan(p) else p
                          for p in session_info['performance_easy']]
 
             median_rt = [None if not p or np.isnan(p) else p
                          for p in session_info['median_reaction_time']]
 
+            perf_dates, perf_easy = putils.merge_trace_points(
+                previous_perf_rt, 'performance easy',
+                session_dates, perf_easy, since)
+            rt_dates, median_rt = putils.merge_trace_points(
+                previous_perf_rt, 'reaction time',
+                session_dates, median_rt, since)
+
             performance_easy = go.Scatter(
-                x=[t.strftime('%Y-%m-%d') for t in session_info['session_date'].tolist()],
+                x=perf_dates,
                 y=perf_easy,
                 mode='markers+lines',
                 marker=dict(
@@ -360,7 +415,7 @@ class CumulativeSummary(dj.Computed):
                 showlegend=False
             )
             rt = go.Scatter(
-                x=[t.strftime('%Y-%m-%d') for t in session_info['session_date'].tolist()],
+                x=rt_dates,
                 y=median_rt,
                 mode='markers+lines',
                 marker=dict(
@@ -431,15 +486,11 @@ class CumulativeSummary(dj.Computed):
             perf_rt['performance_reaction_time'] = fig.to_plotly_json()
             self.PerformanceReactionTime.insert1(perf_rt)
 
-            # plot for fit parameter changes over time
-            # get trial counts and session length to date
+        # plot for fit parameter changes over time
+        fit_pars = snapshot['psych_results']
+        previous_fit_pars = previous.get('fit_pars')
+        if len(fit_pars) or previous_fit_pars:
             fit_pars_entry = key.copy()
-            fit_pars = (behavior.BehavioralSummaryByDate.PsychResults &
-                        key).proj(
-                'session_date', 'prob_left',
-                'threshold', 'bias',
-                'lapse_low', 'lapse_high').fetch(as_dict=True)
-            fit_pars = pd.DataFrame(fit_pars)
             par_names = ['threshold', 'bias', 'lapse_low', 'lapse_high']
             thresholds = [[19, 19], [16, 16, -16, -16], [0.2, 0.2], [0.2, 0.2]]
             xranges = \
@@ -453,24 +504,36 @@ class CumulativeSummary(dj.Computed):
             for par_name in par_names:
                 pars[par_name] = []
 
-            prob_lefts = fit_pars['prob_left'].unique()
+            # p_left of the stored traces, in their original order
+            prob_lefts = []
+            if previous_fit_pars:
+                prob_lefts = [float(trace['name'].partition('=')[2])
+                              for trace in previous_fit_pars['data']
+                              if trace.get('name', '').startswith('p_left =')]
+            prob_lefts = list(dict.fromkeys(
+                prob_lefts + fit_pars['prob_left'].tolist()))
 
             for iprob_left, prob_left in enumerate(prob_lefts):
                 prob_left_filter = fit_pars['prob_left'] == prob_left
                 dot_color, error_color = putils.get_color(prob_left)
 
                 fit_pars_sub = fit_pars[prob_left_filter]
+                fit_dates = [t.strftime('%Y-%m-%d')
+                             for t in fit_pars_sub['session_date'].tolist()]
 
                 for ipar, par_name in enumerate(par_names):
                     if ipar == 0:
                         show_legend = True
                     else:
                         show_legend = False
+                    par_dates, par_values = putils.merge_trace_points(
+                        previous_fit_pars, f'p_left = {prob_left}',
+                        fit_dates, fit_pars_sub[par_name].tolist(), since,
+                        xaxis='x{}'.format(4-ipar))
                     pars[par_name].append(
                         go.Scatter(
-                            x=[t.strftime('%Y-%m-%d')
-                               for t in fit_pars_sub['session_date'].tolist()],
-                            y=fit_pars_sub[par_name].tolist(),
+                            x=par_dates,
+                            y=par_values,
                             mode='markers',
                             marker=dict(
                                 size=5,
@@ -613,28 +676,24 @@ class CumulativeSummary(dj.Computed):
             self.FitPars.insert1(fit_pars_entry)
 
         # plot for contrast heatmap
-        if behavior.BehavioralSummaryByDate.PsychResults & key \
-                & 'ABS(prob_left-0.5)<0.001':
+        sessions = fit_pars[abs(fit_pars['prob_left'] - 0.5) < 0.001]
+        previous_con_hm = previous.get('contrast_heatmap')
+        if len(sessions) or previous_con_hm:
             con_hm = key.copy()
-            # get trial counts and session length to date
-            sessions = (behavior.BehavioralSummaryByDate.PsychResults &
-                        'prob_left=0.5' & key).proj(
-                'session_date', 'signed_contrasts', 'prob_choose_right')
-
-            # get date ranges and mondays
-            d = putils.get_date_range(subj, include_water_weight=not public)
+            sessions = sessions.drop_duplicates('session_date').set_index(
+                'session_date')
 
             # get contrast and p_prob_choose_right per day
             contrast_list = []
             for day in d['date_array']:
-                if sessions & {'session_date': day}:
-                    session = (sessions & {'session_date': day}).fetch(
-                        as_dict=True)
-                    session = session[0]
+                if since and day < since:
+                    continue
+                if day in sessions.index:
+                    session = sessions.loc[day]
                     for icontrast, contrast in \
                             enumerate(session['signed_contrasts']):
                         contrast_list.append(
-                            {'session_date': session['session_date'],
+                            {'session_date': day,
                              'signed_contrast': round(contrast, 2)*100,
                              'prob_choose_right': session['prob_choose_right'][icontrast]})
                 else:
@@ -645,13 +704,14 @@ class CumulativeSummary(dj.Computed):
 
             contrast_df = pd.DataFrame(contrast_list)
             contrast_map = contrast_df.pivot(
-                'signed_contrast',
-                'session_date',
-                'prob_choose_right').sort_values(
-                    by='signed_contrast', ascending=False)
+                index='signed_contrast',
+                columns='session_date',
+                values='prob_choose_right')
+            contrast_map = putils.merge_contrast_heatmap(
+                previous_con_hm, contrast_map, since)
 
             contrast_map = contrast_map.where(pd.notnull(contrast_map), None)
-            contrasts = np.sort(contrast_df['signed_contrast'].unique())
+            contrasts = np.sort(contrast_map.index.values)
 
             data = [dict(
                 x=[t.strftime('%Y-%m-%d')
@@ -712,4 +772,4 @@ class CumulativeSummary(dj.Computed):
         if mode != 'public':
             from .behavior_internal import WaterWeight
             self.WaterWeight = WaterWeight
-            self.WaterWeight().make(key, d)
+            self.WaterWeight().make(key, d, snapshot=snapshot)
@@ -20,79 +20,124 @@ import statsmodels.stats.proportion as smp
 import scipy.signal as signal
 
 
-def get_date_range(subj, include_water_weight=True):
-
-    # get date range of session
-    session_range = subj.aggr(
-        acquisition.Session,
-        first_session_date='min(DATE(session_start_time))',
-        last_session_date='max(DATE(session_start_time))')
-
-    if session_range:
-        first_session_date, last_session_date = session_range.fetch1(
-            'first_session_date', 'last_session_date'
-        )
+def _fetch_frame(query, attrs, order_by=None):
+    return pd.DataFrame(
+        query.fetch(*attrs, as_dict=True, order_by=order_by),
+        columns=attrs)
+
+
+def load_subject_snapshot(subj, public=False, since=None):
+    """Fetch the history of one subject needed by the cumulative summary plots.
+
+    Every query on the subject is issued once here, so that the date range,
+    the training status and each of the plots are computed from the same
+    in-memory snapshot.
+
+    Args:
+        subj (dj query): a query on subject.Subject restricted to one subject
+        public (bool, optional): if True, skip water and weight history.
+            Defaults to False.
+        since (datetime.date, optional): if given, only the per-date plotting
+            data on or after this date are fetched. The date range and the
+            training status are always computed from the full history.
+            Defaults to None.
+
+    Returns:
+        dict: pandas DataFrames of the history, plus the derived
+            'date_range' and 'status' dictionaries.
+    """
+
+    if since:
+        since_restriction = 'session_date >= "{}"'.format(
+            since.strftime('%Y-%m-%d'))
     else:
-        first_session_date = None
-        last_session_date = None
-
-    # get date range of water restriction
-    if include_water_weight:
-        water_res_range = subj.aggr(
-            action.WaterRestriction,
-            first_res_date='min(DATE(restriction_start_time))',
-            last_res_date='max(DATE(restriction_end_time))')
-
-        if water_res_range:
-            first_water_res_date, last_water_res_date = water_res_range.fetch1(
-                'first_res_date', 'last_res_date'
-            )
-        else:
-            first_water_res_date = None
-            last_water_res_date = None
-
-        # get date range of water administration
-        water_admin_range = subj.aggr(
-            action.WaterAdministration,
-            first_admin_date='min(DATE(administration_time))',
-            last_admin_date='max(DATE(administration_time))')
-
-        if water_admin_range:
-            first_water_admin_date, last_water_admin_date = \
-                water_admin_range.fetch1(
-                    'first_admin_date', 'last_admin_date'
-                )
-        else:
-            first_water_admin_date = None
-            last_water_admin_date = None
-
-        # get date range of weighing
-        weighing_range = subj.aggr(
-            action.Weighing,
-            first_weighing_date='min(DATE(weighing_time))',
-            last_weighing_date='max(DATE(weighing_time))')
-
-        if weighing_range:
-            first_weighing_date, last_weighing_date = weighing_range.fetch1(
-                'first_weighing_date', 'last_weighing_date'
-            )
-        else:
-            first_weighing_date = None
-            last_weighing_date = None
-
-    # get overall date range
-    if include_water_weight:
-        first_date_array = [first_session_date,
-                            first_water_res_date,
-                            first_water_admin_date,
-                            first_weighing_date]
-
-        last_date_array = [last_session_date,
-                           last_water_admin_date,
-                           last_weighing_date]
+        since_restriction = {}
+
+    snapshot = dict(since=since, public=public)
+
+    # full history, used for the date range and the status markers
+    snapshot['sessions'] = _fetch_frame(
+        acquisition.Session & subj,
+        ['session_start_time', 'task_protocol'])
+    snapshot['training_status'] = _fetch_frame(
+        behavior.SessionTrainingStatus * acquisition.Session & subj,
+        ['session_start_time', 'training_status',
+         'good_enough_for_brainwide_map', 'task_protocol'],
+        order_by='session_start_time')
+    snapshot['ephysrig_sessions'] = (
+        behavior_ingest.Settings & subj &
+        'pybpod_board like "%ephys%"').fetch('session_start_time')
+    if mode != 'public':
+        snapshot['ephys_sessions'] = (
+            behavior.SessionTrainingStatus & subj &
+            ephys.ProbeInsertion).fetch('session_start_time')
     else:
-        first_date_array = [first_session_date]
-        last_date_array = [last_session_date]
+        snapshot['ephys_sessions'] = []
+    snapshot['subject_birth_date'] = subj.fetch1('subject_birth_date')
+
+    if not public:
+        snapshot['water_administration'] = _fetch_frame(
+            (action.WaterAdministration & subj).proj(
+                'water_administered', 'watertype_name',
+                water_date='DATE(administration_time)'),
+            ['water_date', 'watertype_name', 'water_administered'])
+        snapshot['weighing'] = _fetch_frame(
+            (action.Weighing & subj).proj(
+                'weight', weighing_date='DATE(weighing_time)'),
+            ['weighing_date', 'weight'], order_by='weighing_time')
+        snapshot['water_restriction'] = _fetch_frame(
+            (action.WaterRestriction & subj).proj(
+                'reference_weight',
+                res_start='DATE(restriction_start_time)',
+                res_end='DATE(restriction_end_time)'),
+            ['res_start', 'res_end', 'reference_weight'])
+
+    # per-date plotting data, restricted to the dates not plotted yet
+    snapshot['trial_sets'] = _fetch_frame(
+        (behavior_ingest.TrialSet * acquisition.Session & subj).proj(
+            'n_trials', session_date='DATE(session_start_time)',
+            session_duration='TIMESTAMPDIFF(MINUTE, \
+                session_start_time, session_end_time)') & since_restriction,
+        ['session_date', 'n_trials', 'session_duration'],
+        order_by='session_start_time')
+    snapshot['summary_by_date'] = _fetch_frame(
+        behavior.BehavioralSummaryByDate *
+        behavior.BehavioralSummaryByDate.ReactionTimeByDate &
+        subj & since_restriction,
+        ['session_date', 'performance_easy', 'median_reaction_time'],
+        order_by='session_date')
+    snapshot['psych_results'] = _fetch_frame(
+        behavior.BehavioralSummaryByDate.PsychResults &
+        subj & since_restriction,
+        ['session_date', 'prob_left', 'threshold', 'bias',
+         'lapse_low', 'lapse_high', 'signed_contrasts',
+         'prob_choose_right'],
+        order_by='session_date')
+
+    snapshot['date_range'] = compute_date_range(snapshot)
+    snapshot['status'] = compute_status(snapshot)
+
+    return snapshot
+
+
+def compute_date_range(snapshot):
+
+    sessions = snapshot['sessions']
+    session_dates = [t.date() for t in sessions['session_start_time']]
+
+    first_date_array = [min(session_dates, default=None)]
+    last_date_array = [max(session_dates, default=None)]
+
+    if not snapshot['public']:
+        water_dates = snapshot['water_administration']['water_date']
+        weighing_dates = snapshot['weighing']['weighing_date']
+        res_dates = snapshot['water_restriction']['res_start']
+
+        first_date_array += [min(res_dates, default=None),
+                             min(water_dates, default=None),
+                             min(weighing_dates, default=None)]
+        last_date_array += [max(water_dates, default=None),
+                            max(weighing_dates, default=None)]
 
     first_date_array = [x for x in first_date_array if x is not None]
     last_date_array = [x for x in last_date_array if x is not None]
@@ -114,19 +159,21 @@ def get_date_range(subj, include_water_weight=True):
                for day in date_array if day.weekday() == 0]
 
     # get dates for good enough for brainwide map
-    ephys_sessions = behavior.SessionTrainingStatus & subj & \
-        (acquisition.Session & 'task_protocol like "%ephys%"')
+    training_status = snapshot['training_status']
+    ephys_sessions = training_status[
+        training_status['task_protocol'].str.contains('ephys', na=False)]
 
     if len(ephys_sessions):
-        ephys_dates, good_enough = ephys_sessions.fetch(
-            'session_start_time', 'good_enough_for_brainwide_map')
-        ephys_dates = [day.strftime('%Y-%m-%d') for day in ephys_dates]
+        ephys_dates = [day.strftime('%Y-%m-%d')
+                       for day in ephys_sessions['session_start_time']]
+        good_enough = ephys_sessions[
+            'good_enough_for_brainwide_map'].values
     else:
         ephys_dates = None
         good_enough = None
 
     # check whether the animal is already 7 months
-    dob = subj.fetch1('subject_birth_date')
+    dob = snapshot['subject_birth_date']
     if dob:
         seven_months_date = dob + datetime.timedelta(days=210)
         if seven_months_date > last_date:
@@ -146,91 +193,119 @@ def get_date_range(subj, include_water_weight=True):
         seven_months_date=seven_months_date)
 
 
-def get_status(subj):
+def compute_status(snapshot):
     # get the first date when animal achieved the next stage
-    first_trained_1a = subj.aggr(
-        behavior.SessionTrainingStatus & 'training_status = "trained_1a"',
-        first_session='DATE(min(session_start_time))')
-    first_trained_1b = subj.aggr(
-        behavior.SessionTrainingStatus & 'training_status = "trained_1b"',
-        first_session='DATE(min(session_start_time))')
-    first_ephysrig = subj.aggr(behavior_ingest.Settings & 'pybpod_board like "%ephys%"',
-        first_session='DATE(min(session_start_time))')
-    first_ready4ephysrig = subj.aggr(
-        behavior.SessionTrainingStatus & 'training_status = "ready4ephysrig"',
-        first_session='DATE(min(session_start_time))')
-    first_ready4delay = subj.aggr(
-        behavior.SessionTrainingStatus & 'training_status = "ready4delay"',
-        first_session='DATE(min(session_start_time))')
-    first_ready4recording = subj.aggr(
-        behavior.SessionTrainingStatus & 'training_status = "ready4recording"',
-        first_session='DATE(min(session_start_time))')
-    if mode != 'public':
-        first_ephys_session = subj.aggr(
-            behavior.SessionTrainingStatus & ephys.ProbeInsertion,
-            first_session='DATE(min(session_start_time))')
-    else:
-        first_ephys_session = []
+    training_status = snapshot['training_status']
+
+    def status_sessions(status):
+        return training_status.loc[
+            training_status['training_status'] == status,
+            'session_start_time']
+
+    milestones = [
+        ('is_trained_1a', 'first_trained_1a_date',
+         status_sessions('trained_1a')),
+        ('is_trained_1b', 'first_trained_1b_date',
+         status_sessions('trained_1b')),
+        ('is_ready4ephysrig', 'first_ready4ephysrig_date',
+         status_sessions('ready4ephysrig')),
+        ('is_on_ephysrig', 'first_ephysrig_date',
+         snapshot['ephysrig_sessions']),
+        ('is_ready4delay', 'first_ready4delay_date',
+         status_sessions('ready4delay')),
+        ('is_ready4recording', 'first_ready4recording_date',
+         status_sessions('ready4recording')),
+        ('has_ephys_session', 'first_ephys_session_date',
+         snapshot['ephys_sessions'])
+    ]
 
     result = dict()
-    if len(first_trained_1a):
-        first_trained_1a_date = first_trained_1a.fetch1(
-            'first_session').strftime('%Y-%m-%d')
-        result.update(is_trained_1a=True,
-                      first_trained_1a_date=first_trained_1a_date)
-    else:
-        result.update(is_trained_1a=False)
-
-    if len(first_trained_1b):
-        first_trained_1b_date = first_trained_1b.fetch1(
-            'first_session').strftime('%Y-%m-%d')
-        result.update(is_trained_1b=True,
-                      first_trained_1b_date=first_trained_1b_date)
-    else:
-        result.update(is_trained_1b=False)
+    for flag, date_field, session_times in milestones:
+        if len(session_times):
+            result[flag] = True
+            result[date_field] = min(session_times).strftime('%Y-%m-%d')
+        else:
+            result[flag] = False
 
-    if len(first_ready4ephysrig):
-        first_ready4ephysrig_date = first_ready4ephysrig.fetch1(
-            'first_session').strftime('%Y-%m-%d')
-        result.update(is_ready4ephysrig=True,
-                      first_ready4ephysrig_date=first_ready4ephysrig_date)
-    else:
-        result.update(is_ready4ephysrig=False)
+    return result
 
-    if len(first_ephysrig):
-        first_ephysrig_date = first_ephysrig.fetch1(
-            'first_session').strftime('%Y-%m-%d')
-        result.update(is_on_ephysrig=True,
-                      first_ephysrig_date=first_ephysrig_date)
-    else:
-        result.update(is_on_ephysrig=False)
 
-    if len(first_ready4delay):
-        first_ready4delay_date = first_ready4delay.fetch1(
-            'first_session').strftime('%Y-%m-%d')
-        result.update(is_ready4delay=True,
-                      first_ready4delay_date=first_ready4delay_date)
-    else:
-        result.update(is_ready4delay=False)
+def get_date_range(subj, include_water_weight=True):
+    return load_subject_snapshot(
+        subj, public=not include_water_weight)['date_range']
 
-    if len(first_ready4recording):
-        first_ready4recording_date = first_ready4recording.fetch1(
-            'first_session').strftime('%Y-%m-%d')
-        result.update(is_ready4recording=True,
-                      first_ready4recording_date=first_ready4recording_date)
-    else:
-        result.update(is_ready4recording=False)
-
-    if len(first_ephys_session):
-        first_ephys_session_date = first_ephys_session.fetch1(
-            'first_session').strftime('%Y-%m-%d')
-        result.update(
-            has_ephys_session=True,
-            first_ephys_session_date=first_ephys_session_date)
-    else:
-        result.update(has_ephys_session=False)
 
-    return result
+def get_status(subj):
+    return load_subject_snapshot(subj, public=True)['status']
+
+
+def _normalize_axis(axis):
+    # plotly stores the first axis as "x"/"y" rather than "x1"/"y1"
+    return axis[0] if axis and axis[1:] == '1' else axis
+
+
+def merge_trace_points(previous_fig, name, x, y, since, xaxis=None):
+    """Prepend the points of a stored trace dated before `since` to new points.
+
+    Args:
+        previous_fig (dict): plotly json of the previously stored figure,
+            or None if there is none.
+        name (str): name of the trace to extend.
+        x (list): new dates, as 'YYYY-MM-DD' strings.
+        y (list): new values.
+        since (datetime.date): first date of the new points.
+        xaxis (str, optional): x axis of the trace, for figures with
+            subplots. Defaults to None.
+
+    Returns:
+        tuple: merged lists of x and y.
+    """
+    x, y = list(x), list(y)
+    if not previous_fig:
+        return x, y
+
+    since_str = since.strftime('%Y-%m-%d')
+    for trace in previous_fig['data']:
+        if trace.get('name') != name:
+            continue
+        if xaxis and \
+                _normalize_axis(trace.get('xaxis', 'x')) != \
+                _normalize_axis(xaxis):
+            continue
+        kept = [(xi, yi) for xi, yi in zip(trace['x'], trace['y'])
+                if xi < since_str]
+        return [xi for xi, _ in kept] + x, [yi for _, yi in kept] + y
+
+    return x, y
+
+
+def merge_contrast_heatmap(previous_fig, contrast_map, since):
+    """Prepend the columns of a stored contrast heatmap dated before `since`.
+
+    Args:
+        previous_fig (dict): plotly json of the previously stored heatmap,
+            or None if there is none.
+        contrast_map (pandas.DataFrame): new heatmap, signed contrasts as
+            the index and dates as the columns.
+        since (datetime.date): first date of the new columns.
+
+    Returns:
+        pandas.DataFrame: merged heatmap, sorted by descending contrast.
+    """
+    if previous_fig:
+        heatmap = previous_fig['data'][0]
+        contrasts = [float(c) for c in
+                     previous_fig['layout']['yaxis']['ticktext']]
+        dates = [datetime.datetime.strptime(t, '%Y-%m-%d').date()
+                 for t in heatmap['x']]
+        previous_map = pd.DataFrame(
+            np.array(heatmap['z'], dtype=float),
+            index=contrasts[::-1], columns=dates)
+        previous_map = previous_map.loc[
+            :, [day < since for day in previous_map.columns]]
+        contrast_map = pd.concat([previous_map, contrast_map], axis=1)
+
+    return contrast_map.sort_index(ascending=False)
 
 
 def get_fit_pars(sessions):
@@ -9,7 +9,8 @@ from ibl_pipeline.process import (
     ingest_real,
     populate_behavior,
     get_timezone,
-    process_histology
+    process_histology,
+    task_ledger
 )
 from ibl_pipeline.ingest import job
 from os import path
@@ -18,20 +19,6 @@ import time
 from tqdm import tqdm
 
 
-def ingest_status(job_key, task, start, end):
-
-    job.TaskStatus.insert1(
-        dict(
-            **job_key,
-            task=task,
-            task_start_time=start,
-            task_end_time=end,
-            task_duration=(end-start).total_seconds()/60.,
-        ),
-        skip_duplicates=True
-    )
-
-
 def process_new(previous_dump=None, latest_dump=None,
                 job_date=datetime.date.today().strftime('%Y-%m-%d'),
                 timezone='other'):
@@ -55,55 +42,49 @@ def process_new(previous_dump=None, latest_dump=None,
         job.Job & job_key).fetch1(
             'created_pks', 'modified_pks', 'deleted_pks', 'modified_pks_important')
 
+    # each task is recorded in job.TaskStatus, with the tables it processed
+    # in job.TaskStatus.TableRun
     print('Deleting modified entries from alyxraw and shadow tables...')
-    start = datetime.datetime.now()
-
-    delete_update_entries.delete_entries_from_alyxraw(
-        modified_pks, modified_pks_important)
-
-    ingest_status(job_key, 'Delete alyxraw', start, end=datetime.datetime.now())
+    with task_ledger.task(job_key, 'Delete alyxraw'):
+        delete_update_entries.delete_entries_from_alyxraw(
+            modified_pks, modified_pks_important)
 
     print('Deleting modified entries from membership tables...')
-    start = datetime.datetime.now()
-    delete_update_entries.delete_entries_from_membership(
-        modified_pks_important)
-    ingest_status(job_key, 'Delete shadow membership', start,
-                  end=datetime.datetime.now())
+    with task_ledger.task(job_key, 'Delete shadow membership'):
+        delete_update_entries.delete_entries_from_membership(
+            modified_pks_important)
 
     print('Ingesting into alyxraw...')
-    start = datetime.datetime.now()
-    ingest_alyx_raw.insert_to_alyxraw(
-        ingest_alyx_raw.get_alyx_entries(
-            latest_dump, new_pks=created_pks+modified_pks))
-    ingest_status(job_key, 'Ingest alyxraw', start, end=datetime.datetime.now())
+    with task_ledger.task(job_key, 'Ingest alyxraw'), \
+            task_ledger.record('ibl_alyxraw.AlyxRaw'):
+        ingest_alyx_raw.insert_to_alyxraw(
+            ingest_alyx_raw.get_alyx_entries(
+                latest_dump, new_pks=created_pks+modified_pks))
 
     print('Ingesting into shadow tables...')
-    start = datetime.datetime.now()
-    ingest_shadow.main(modified_pks=modified_pks_important)
-    ingest_status(job_key, 'Ingest shadow', start, end=datetime.datetime.now())
+    with task_ledger.task(job_key, 'Ingest shadow'):
+        ingest_shadow.main(modified_pks=modified_pks_important)
 
     print('Ingesting into shadow membership tables...')
-    start = datetime.datetime.now()
-    ingest_membership.main(created_pks+modified_pks_important)
-    ingest_status(job_key, 'Ingest shadow membership', start,
-                  end=datetime.datetime.now())
+    with task_ledger.task(job_key, 'Ingest shadow membership'):
+        ingest_membership.main(created_pks+modified_pks_important)
 
     print('Ingesting alyx real...')
-    start = datetime.datetime.now()
-    ingest_real.main()
-    ingest_status(job_key, 'Ingest real', start, end=datetime.datetime.now())
+    with task_ledger.task(job_key, 'Ingest real'):
+        ingest_real.main()
+
+    print('Deleting file records...')
+    with task_ledger.task(job_key, 'Delete file records'):
+        delete_update_entries.delete_file_records(modified_pks, deleted_pks)
 
     print('Updating fields...')
-    start = datetime.datetime.now()
-    delete_update_entries.update_entries_from_real_tables(
-        modified_pks_important)
-    ingest_status(job_key, 'Update fields', start, end=datetime.datetime.now())
+    with task_ledger.task(job_key, 'Update fields'):
+        delete_update_entries.update_entries_from_real_tables(
+            modified_pks_important)
 
     print('Ingesting behavior...')
-    start = datetime.datetime.now()
-    populate_behavior.main(backtrack_days=30)
-    ingest_status(job_key, 'Populate behavior', start,
-                  end=datetime.datetime.now())
+    with task_ledger.task(job_key, 'Populate behavior'):
+        populate_behavior.main(backtrack_days=30)
 
 
 def process_updates(pks, current_dump='/data/alyxfull.json'):
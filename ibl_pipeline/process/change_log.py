@@ -0,0 +1,95 @@
+'''
+Record the subjects (and their labs) that received new rows during the
+behavior and action ingestion, so that the cumulative and daily summaries
+are only recomputed for subjects and labs that changed.
+'''
+import datajoint as dj
+import datetime
+from ibl_pipeline import subject
+from ibl_pipeline.ingest import job
+
+
+def log_subject_changes(subject_uuids, change_source):
+    """Record the given subjects as changed by change_source.
+
+    Args:
+        subject_uuids (iterable): uuids of the subjects that received new rows
+        change_source (str): name of the table that received the new rows
+
+    Returns:
+        int: number of subjects logged
+    """
+    subject_uuids = set(subject_uuids)
+    if not subject_uuids:
+        return 0
+
+    labs = dict(zip(*subject.SubjectLab.fetch('subject_uuid', 'lab_name')))
+    job.SubjectChange.insert(
+        [dict(subject_uuid=subject_uuid,
+              change_source=change_source,
+              lab_name=labs.get(subject_uuid))
+         for subject_uuid in subject_uuids],
+        skip_duplicates=True)
+
+    return len(subject_uuids)
+
+
+def get_changes(refresh_job):
+    """Get the changes logged since the last run of refresh_job.
+
+    Args:
+        refresh_job (str): name of the refreshed table, e.g. 'CumulativeSummary'
+
+    Returns:
+        tuple: query on job.SubjectChange with the pending changes, and the
+            database time up to which they were taken, to be passed to
+            record_refresh once the refresh is done.
+    """
+    refresh_ts = dj.conn().query('SELECT NOW()').fetchone()[0]
+    last_refresh = (job.RefreshRun & {'refresh_job': refresh_job}).fetch(
+        'refresh_ts', order_by='refresh_ts desc', limit=1)
+
+    changes = job.SubjectChange & f'change_ts <= "{refresh_ts}"'
+    if len(last_refresh):
+        changes = changes & f'change_ts > "{last_refresh[0]}"'
+
+    return changes, refresh_ts
+
+
+def record_refresh(refresh_job, refresh_ts, start, n_recomputed, n_skipped):
+
+    print(f'{refresh_job}: recomputed {n_recomputed}, '
+          f'skipped {n_skipped} as unchanged.')
+    job.RefreshRun.insert1(
+        dict(
+            refresh_job=refresh_job,
+            refresh_ts=refresh_ts,
+            n_recomputed=n_recomputed,
+            n_skipped=n_skipped,
+            refresh_duration=(
+                datetime.datetime.now() - start).total_seconds()/60.
+        ),
+        skip_duplicates=True
+    )
+
+
+def prune_changes(refresh_jobs):
+    """Delete the changes covered by the last run of every refresh job.
+
+    Args:
+        refresh_jobs (list of str): names of the refreshed tables consuming
+            job.SubjectChange, e.g. ['CumulativeSummary', 'DailyLabSummary']
+
+    Returns:
+        int: number of changes deleted
+    """
+    last_refreshes = [
+        (job.RefreshRun & {'refresh_job': refresh_job}).fetch(
+            'refresh_ts', order_by='refresh_ts desc', limit=1)
+        for refresh_job in refresh_jobs]
+    if not all(len(ts) for ts in last_refreshes):
+        return 0
+
+    prune_ts = min(ts[0] for ts in last_refreshes)
+    return (job.SubjectChange & f'change_ts <= "{prune_ts}"').delete_quick(
+        get_count=True)
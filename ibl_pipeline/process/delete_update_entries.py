@@ -9,65 +9,121 @@ from ibl_pipeline.ingest import job, QueryBuffer
 from ibl_pipeline.ingest import ingest_utils
 from ibl_pipeline import update
 from uuid import UUID
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
 import pdb
-from ibl_pipeline.utils import is_valid_uuid
+from ibl_pipeline.utils import is_valid_uuid, dependency_graph
 from ibl_pipeline.process import get_important_pks
 import datetime
+import time
 
 
 # ====================================== functions for deletion ==================================
 
-def delete_entries_from_alyxraw(pks_to_be_deleted=[], modified_pks_important=[]):
+def stage_pks(stage, pks, chunksz=1000):
+    '''
+    Stage uuids in job.DeletionStage, assigned to chunks of chunksz uuids.
+    Returns the number of chunks.
+    '''
+    pks = sorted(set(pk for pk in pks if is_valid_uuid(pk)))
+    with dj.config(safemode=False):
+        (job.DeletionStage & {'stage': stage}).delete_quick()
+    job.DeletionStage.insert(
+        [dict(stage=stage, uuid=pk, chunk=i // chunksz)
+         for i, pk in enumerate(pks)])
+    return -(-len(pks) // chunksz)
+
 
+def delete_staged(stage, n_chunks, tables, uuid_name='uuid', clear=True,
+                  graph=None):
     '''
-    Delete entries from alyxraw and shadow membership_tables, excluding the membership table.
+    Delete the entries of tables matching the staged uuids, one chunk at a time.
+    Inputs: stage       : name of the staged uuids in job.DeletionStage
+            n_chunks    : number of chunks, as returned by stage_pks
+            tables      : list of (table, quick) or (table, quick, parent). Tables are deleted with
+                          delete_quick if quick is True, otherwise with a cascading delete, children
+                          before parents and part tables before their masters, in the order of the
+                          dependency graph. If a parent table is given, the uuids are matched in the
+                          parent and the table is restricted by its keys.
+            uuid_name   : name of the uuid attribute in the tables, or in the parent tables
+            clear       : if True, remove the staged uuids once deleted
+            graph       : dependency graph, as returned by dependency_graph.load_graph, loaded if
+                          not given. Pass it when deleting several stages in a job.
     '''
+    tables = dependency_graph.get_deletion_order(
+        graph or dependency_graph.load_graph(), tables,
+        get_table=lambda t: t[0])
 
-    print('Deleting alyxraw entries corresponding to file records...')
+    n_deleted = {t[0].full_table_name: 0 for t in tables}
+    start = time.time()
 
-    if pks_to_be_deleted:
-        if len(pks_to_be_deleted) > 5000:
-            file_record_fields = alyxraw.AlyxRaw.Field & \
-                'fname = "exists"' & 'fvalue = "false"'
-        else:
-            file_record_fields = alyxraw.AlyxRaw.Field & \
-                'fname = "exists"' & 'fvalue = "false"' & \
-                [{'uuid': pk} for pk in pks_to_be_deleted]
+    with dj.config(safemode=False):
+        for chunk in tqdm(range(n_chunks), position=0):
+            staged = job.DeletionStage & {'stage': stage, 'chunk': chunk}
+            staged = staged.proj(**{uuid_name: 'uuid'}) \
+                if uuid_name != 'uuid' else staged.proj()
+            for t, quick, *parent in tables:
+                q = t & (parent[0] & staged).proj() if parent else t & staged
+                if quick:
+                    n_deleted[t.full_table_name] += q.delete_quick(get_count=True)
+                else:
+                    n_deleted[t.full_table_name] += len(q)
+                    q.delete()
+
+        if clear:
+            (job.DeletionStage & {'stage': stage}).delete_quick()
+
+    duration = time.time() - start
+    n_total = sum(n_deleted.values())
+    for table_name, n in n_deleted.items():
+        print(f'Deleted {n} entries from {table_name}')
+    print(f'Deleted {n_total} entries in {duration:.1f} s '
+          f'({n_total / max(duration, 1e-6):.0f} entries/s)')
 
-        for key in tqdm(file_record_fields):
-            (alyxraw.AlyxRaw.Field & key).delete_quick()
 
-    if modified_pks_important:
-        pk_list = [{'uuid': pk} for pk in modified_pks_important
-                   if is_valid_uuid(pk)]
-        if len(pk_list) > 1000:
+def delete_entries_from_alyxraw(pks_to_be_deleted=[], modified_pks_important=[]):
 
-            print('Long pk list, deleting from alyxraw.AlyxRaw ...')
-            alyxraw_buffer = QueryBuffer(alyxraw.AlyxRaw & 'model != "actions.session"')
-            for pk in tqdm(pk_list):
-                alyxraw_buffer.add_to_queue1(pk)
-                alyxraw_buffer.flush_delete(chunksz=50, quick=False)
+    '''
+    Delete entries from alyxraw and shadow membership_tables, excluding the membership table.
+    The uuids are staged in job.DeletionStage and deleted with semijoins in chunks.
+    '''
 
-            alyxraw_buffer.flush_delete(quick=False)
+    print('Deleting alyxraw entries corresponding to file records...')
+
+    graph = dependency_graph.load_graph()
 
-            # Delete session fields without deleting the AlyxRaw entries and start time field.
-            # This is to handle the case where uuid is not changed but start time changed for 1 sec.
-            print('Long pk list, deleting from alyxraw.AlyxRaw.Field ...')
-            alyxraw_field_buffer = QueryBuffer(
-                alyxraw.AlyxRaw.Field & 'fname!="start_time"' &
-                (alyxraw.AlyxRaw & 'model="actions.session"'))
+    if pks_to_be_deleted:
+        n_chunks = stage_pks('alyxraw_file_records', pks_to_be_deleted)
+        delete_staged(
+            'alyxraw_file_records', n_chunks,
+            [(alyxraw.AlyxRaw.Field & 'fname = "exists"' & 'fvalue = "false"', True)],
+            graph=graph)
 
-            for pk in tqdm(pk_list):
-                alyxraw_field_buffer.add_to_queue1(pk)
-                alyxraw_field_buffer.flush_delete(chunksz=50, quick=True)
-            alyxraw_field_buffer.flush_delete(quick=True)
+    if modified_pks_important:
+        print('Deleting modified entries from alyxraw.AlyxRaw ...')
+        n_chunks = stage_pks('alyxraw_modified', modified_pks_important)
+
+        # Delete session fields without deleting the AlyxRaw entries and start time field.
+        # This is to handle the case where uuid is not changed but start time changed for 1 sec.
+        # The deletion of the other models cascades to the shadow tables.
+        non_session = alyxraw.AlyxRaw & 'model != "actions.session"'
+        delete_staged(
+            'alyxraw_modified', n_chunks,
+            [(alyxraw.AlyxRaw.Field & non_session, True),
+             (non_session, False),
+             (alyxraw.AlyxRaw.Field & 'fname!="start_time"' &
+              (alyxraw.AlyxRaw & 'model="actions.session"'), True)],
+            graph=graph)
 
 
 def delete_entries_from_membership(pks_to_be_deleted):
     '''
     Delete entries from shadow membership membership_tables
     '''
+    n_chunks = stage_pks('membership', pks_to_be_deleted)
+    graph = dependency_graph.load_graph()
+
     for t in MEMBERSHIP_TABLES:
         ingest_mod = t['dj_parent_table'].__module__
         table_name = t['dj_parent_table'].__name__
@@ -76,11 +132,43 @@ def delete_entries_from_membership(pks_to_be_deleted):
 
         print(f'Deleting from table {mem_table_name} ...')
         real_table = eval(ingest_mod.replace('ibl_pipeline.ingest.', '') + '.' + table_name)
-        with dj.config(safemode=False):
-            (t['dj_current_table'] &
-             (real_table &
-             [{t['dj_parent_uuid_name']:pk}
-              for pk in pks_to_be_deleted if is_valid_uuid(pk)]).fetch('KEY')).delete()
+        delete_staged('membership', n_chunks,
+                      [(t['dj_current_table'], False, real_table)],
+                      uuid_name=t['dj_parent_uuid_name'], clear=False,
+                      graph=graph)
+
+    with dj.config(safemode=False):
+        (job.DeletionStage & {'stage': 'membership'}).delete_quick()
+
+
+def delete_file_records(modified_pks, deleted_pks=[]):
+    '''
+    Delete the file records deleted in alyx, or whose modified record no longer exists on flatiron,
+    from the shadow and real tables, and recompute data.DataSetAvailability of their sessions.
+    The alyxraw entries of the deleted records are deleted as well, so that they are not ingested
+    again. The uuids are staged in job.DeletionStage.
+    '''
+    stage_pks('file_records_modified', modified_pks)
+    stage_pks('file_records_deleted', deleted_pks)
+    modified = (job.DeletionStage & {'stage': 'file_records_modified'}).proj(record_uuid='uuid')
+    deleted = (job.DeletionStage & {'stage': 'file_records_deleted'}).proj(record_uuid='uuid')
+
+    existing = (alyxraw.AlyxRaw.Field & 'fname = "exists"' & 'fvalue = "True"').proj(
+        record_uuid='uuid')
+    records = [data.FileRecord & (modified - existing), data.FileRecord & deleted]
+    sessions = [key for r in records
+                for key in (dj.U('subject_uuid', 'session_start_time') & r).fetch('KEY')]
+
+    with dj.config(safemode=False):
+        for r in records:
+            (data_ingest.FileRecord & (dj.U('record_uuid') & r)).delete_quick()
+            r.delete_quick()
+        (alyxraw.AlyxRaw & 'model = "data.filerecord"' & deleted.proj(uuid='record_uuid')).delete()
+        (job.DeletionStage & 'stage in ("file_records_modified", "file_records_deleted")').delete_quick()
+
+    if sessions:
+        print(f'Updating the dataset availability of {len(sessions)} sessions...')
+        data.DataSetAvailability.update_sessions(sessions)
 
 
 # =================================== functions for update ==========================================
@@ -125,90 +213,191 @@ TABLES_TO_UPDATE = [
 ]
 
 
-def update_fields(real_schema, shadow_schema, table_name, pks, insert_to_table=False):
+def _sql_value(value):
+    """Value of a primary key attribute as a query argument"""
+    if isinstance(value, UUID):
+        return value.bytes
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _native(value):
+    """Value fetched through pandas as a native python value, nulls as None"""
+    if isinstance(value, np.ndarray):
+        return value
+    if value is None or value is pd.NaT or \
+            (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _is_equal(real_values, shadow_values):
+    """Element-wise equality of two object columns, nulls being equal"""
+    real_null = pd.isnull(real_values)
+    shadow_null = pd.isnull(shadow_values)
+    equal = np.array([real_null[i] or shadow_null[i] or
+                      bool(np.all(real_values[i] == shadow_values[i]))
+                      for i in range(len(real_values))], dtype=bool)
+    return (real_null == shadow_null) & equal
+
+
+def update_fields(real_schema, shadow_schema, table_name, pks,
+                  insert_to_table=False, chunksz=1000):
     '''
     Given a table and the primary key of real table, update all the fields that have discrepancy.
+    Real and shadow records are fetched in chunks ordered by the primary key and compared column-wise,
+    the discrepancies of each field are then copied from the shadow table with one UPDATE ... JOIN per chunk,
+    joined with a temporary table holding the primary keys of the changed records.
     Inputs: real_schema     : real schema module, e.g. reference
             shadow_schema   : shadow schema module, e.g. reference_ingest
             table_name      : string, name of a table, e.g. Subject
-            pks             : list of dictionaries, primary keys of real table that contains modification
+            pks             : list of dictionaries or query, primary keys of real table that contains
+                              modification
             insert_to_table : boolean, if True, log the update histolory in the table ibl_update.UpdateRecord
+            chunksz         : number of records fetched and updated at once
     '''
 
     real_table = getattr(real_schema, table_name)
     shadow_table = getattr(shadow_schema, table_name)
+    full_table_name = real_table.__module__ + '.' + real_table.__name__
 
+    primary_key = real_table.primary_key
     secondary_fields = set(real_table.heading.secondary_attributes)
     ts_field = [f for f in secondary_fields
                 if f.endswith('_ts')][0]
-    fields_to_update = secondary_fields - {ts_field}
-
-    for r in (real_table & pks).fetch('KEY'):
-
-        pk_hash = UUID(dj.hash.key_hash(r))
-
-        if not shadow_table & r:
-            real_record = (real_table & r).fetch1()
-            if insert_to_table:
+    shadow_ts_field = ts_field if ts_field in shadow_table.heading.names else \
+        [f for f in shadow_table.heading.names if '_ts' in f][0]
+    fields_to_update = sorted(
+        (secondary_fields - {ts_field}) & set(shadow_table.heading.names))
+
+    keys = sorted((real_table & pks).fetch('KEY'),
+                  key=lambda k: [str(k[a]) for a in primary_key])
+
+    update_records = []
+    update_errors = []
+
+    # primary keys of the changed records, joined in the UPDATE
+    conn = real_table.connection
+    pk_columns = ', '.join(f'`{a}`' for a in primary_key)
+    keys_table = f'`{real_table.database}`.`_update_keys`'
+    conn.query(f'DROP TEMPORARY TABLE IF EXISTS {keys_table}')
+    conn.query(f'CREATE TEMPORARY TABLE {keys_table} (PRIMARY KEY ({pk_columns})) '
+               f'SELECT {pk_columns} FROM {real_table.full_table_name} LIMIT 0')
+    join_condition = ' AND '.join(f'r.`{a}`=s.`{a}`' for a in primary_key)
+    key_condition = ' AND '.join(f'r.`{a}`=k.`{a}`' for a in primary_key)
+    key_values = '(' + ', '.join(['%s'] * len(primary_key)) + ')'
+
+    try:
+        for i in tqdm(range(0, len(keys), chunksz), position=0):
+            chunk = keys[i:i+chunksz]
+
+            # values are kept as python objects, so that nullable integers are not cast to floats
+            real = pd.DataFrame(
+                (real_table & chunk).fetch(
+                    *primary_key, ts_field, *fields_to_update,
+                    order_by=primary_key, as_dict=True),
+                columns=primary_key + [ts_field] + fields_to_update, dtype=object)
+            shadow = pd.DataFrame(
+                (shadow_table & chunk).fetch(
+                    *primary_key, shadow_ts_field, *fields_to_update,
+                    order_by=primary_key + [shadow_ts_field], as_dict=True),
+                columns=primary_key + [shadow_ts_field] + fields_to_update, dtype=object)
+            real['pk'] = [tuple(r) for r in real[primary_key].values]
+            shadow['pk'] = [tuple(r) for r in shadow[primary_key].values]
+            shadow_columns = {f: f + '_shadow' for f in [shadow_ts_field] + fields_to_update}
+
+            # if there are more than 1 shadow record, delete the older records
+            duplicated = shadow['pk'].duplicated(keep='last')
+            if duplicated.any():
+                with dj.config(safemode=False):
+                    for _, record in shadow[duplicated].iterrows():
+                        (shadow_table & dict(zip(primary_key, record['pk'])) &
+                         {shadow_ts_field: record[shadow_ts_field]}).delete()
+                shadow = shadow[~duplicated]
+
+            merged = real.merge(
+                shadow.drop(columns=primary_key).rename(columns=shadow_columns),
+                on='pk', how='left', indicator=True)
+
+            # records that do not exist in the shadow table
+            for _, record in merged[merged['_merge'] == 'left_only'].iterrows():
+                r = dict(zip(primary_key, record['pk']))
+                update_error_msg = 'Record does not exist in the shadow {}'.format(r)
+                print(update_error_msg)
                 update_record = dict(
-                    table=real_table.__module__ + '.' + real_table.__name__,
+                    table=full_table_name,
                     attribute='unknown',
-                    pk_hash=pk_hash,
-                    original_ts=real_record[ts_field],
+                    pk_hash=UUID(dj.hash.key_hash(r)),
+                    original_ts=_native(record[ts_field]),
                     update_ts=datetime.datetime.now(),
-                    pk_dict=r,
                 )
-                update.UpdateRecord.insert1(update_record)
-                update_record.pop('pk_dict')
-
-                update_error_msg = 'Record does not exist in the shadow {}'.format(r)
-                update_record_error = dict(
+                update_records.append(dict(**update_record, pk_dict=r))
+                update_errors.append(dict(
                     **update_record,
                     update_action_ts=datetime.datetime.now(),
-                    update_error_msg=update_error_msg
-                )
-                update.UpdateError.insert1(update_record_error)
-
-            print(update_error_msg)
-            continue
-
-        # if there are more than 1 record
-        elif len(shadow_table & r) > 1:
-            # delete the older record
-            ts_field = [f for f in shadow_table.heading.names if '_ts' in f][0]
-            lastest_record = dj.U().aggr(shadow_table & r, session_ts='max(session_ts)').fetch()
+                    update_error_msg=update_error_msg))
 
-            with dj.config(safemode=False):
-                ((shadow_table & r) - lastest_record).delete()
+            merged = merged[merged['_merge'] == 'both']
 
-        shadow_record = (shadow_table & r).fetch1()
-        real_record = (real_table & r).fetch1()
+            for f in fields_to_update:
+                real_values = merged[f].values
+                shadow_values = merged[f + '_shadow'].values
+                changed = merged[~_is_equal(real_values, shadow_values)]
+                if not len(changed):
+                    continue
 
-        for f in fields_to_update:
-            if real_record[f] != shadow_record[f]:
                 try:
-                    (real_table & r)._update(f, shadow_record[f])
-                    update_narrative = f'{table_name}.{f}: {shadow_record[f]} != {real_record[f]}'
-                    print(update_narrative)
-                    if insert_to_table:
-                        update_record = dict(
-                            table=real_table.__module__ + '.' + real_table.__name__,
-                            attribute=f,
-                            pk_hash=pk_hash,
-                            original_ts=real_record[ts_field],
-                            update_ts=shadow_record[ts_field],
-                            pk_dict=r,
-                            original_value=real_record[f],
-                            updated_value=shadow_record[f],
-                            update_narrative=update_narrative
-                        )
-                        update.UpdateRecord.insert1(update_record)
-
+                    conn.query(f'DELETE FROM {keys_table}')
+                    conn.query(
+                        f'INSERT INTO {keys_table} ({pk_columns}) VALUES ' +
+                        ', '.join([key_values] * len(changed)),
+                        args=[_sql_value(v) for pk in changed['pk'] for v in pk])
+                    conn.query(
+                        f'UPDATE {real_table.full_table_name} r '
+                        f'JOIN {shadow_table.full_table_name} s ON {join_condition} '
+                        f'JOIN {keys_table} k ON {key_condition} '
+                        f'SET r.`{f}`=s.`{f}`')
                 except BaseException as e:
-                    print(f'Error while updating record {r}: {str(e)}')
+                    print(f'Error while updating {table_name}.{f}: {str(e)}')
+                    continue
+
+                for _, record in changed.iterrows():
+                    original_value = _native(record[f])
+                    updated_value = _native(record[f + '_shadow'])
+                    update_narrative = f'{table_name}.{f}: {updated_value} != {original_value}'
+                    print(update_narrative)
+                    r = dict(zip(primary_key, record['pk']))
+                    update_records.append(dict(
+                        table=full_table_name,
+                        attribute=f,
+                        pk_hash=UUID(dj.hash.key_hash(r)),
+                        original_ts=_native(record[ts_field]),
+                        update_ts=_native(record[shadow_columns[shadow_ts_field]]),
+                        pk_dict=r,
+                        original_value=original_value,
+                        updated_value=updated_value,
+                        update_narrative=update_narrative
+                    ))
+    finally:
+        conn.query(f'DROP TEMPORARY TABLE IF EXISTS {keys_table}')
+
+    if insert_to_table:
+        update.UpdateRecord.insert(update_records, skip_duplicates=True)
+        update.UpdateError.insert(update_errors, skip_duplicates=True)
 
 
 def update_entries_from_real_tables(modified_pks):
+    '''
+    Update the real tables from the shadow tables for the modified uuids. The uuids are staged
+    in job.DeletionStage and the tables are restricted with a semijoin on the stage.
+    '''
+    stage_pks('update_modified', get_important_pks(modified_pks))
+    staged = job.DeletionStage & {'stage': 'update_modified'}
 
     for table in TABLES_TO_UPDATE:
 
@@ -222,22 +411,23 @@ def update_entries_from_real_tables(modified_pks):
             uuid_field = next(f for f in table.heading.secondary_attributes
                               if '_uuid' in f and 'subject' not in f)
 
-        pks_important = get_important_pks(modified_pks)
-
-        query = table & [{uuid_field: pk} for pk in pks_important]
+        query = table & staged.proj(**{uuid_field: 'uuid'})
 
         if query:
             members = t.pop('members')
-            update_fields(**t, pks=query.fetch('KEY'), insert_to_table=True)
+            update_fields(**t, pks=query, insert_to_table=True)
 
             if members:
                 for m in members:
                     sub_t = getattr(t['real_schema'], m)
                     if sub_t & query:
                         update_fields(t['real_schema'], t['shadow_schema'],
-                                      m, (sub_t & query).fetch('KEY'),
+                                      m, sub_t & query.proj(),
                                       insert_to_table=True)
 
+    with dj.config(safemode=False):
+        staged.delete_quick()
+
 
 if __name__ == '__main__':
 
@@ -6,6 +6,7 @@ from ibl_pipeline.ingest import QueryBuffer
 from ibl_pipeline.ingest import reference as reference_ingest
 from ibl_pipeline import reference
 from ibl_pipeline.process.ingest_alyx_raw import get_alyx_entries
+from ibl_pipeline.utils import atlas as brain_atlas
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
@@ -83,6 +84,9 @@ def update_real_field(field):
             reference.BrainRegion & key, field,
             (reference_ingest.BrainRegion & key).fetch1(field))
 
+    # the cached region hierarchy of this process is stale now
+    brain_atlas.invalidate_ontology()
+
 
 if __name__ == '__main__':
 
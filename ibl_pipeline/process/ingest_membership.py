@@ -10,6 +10,7 @@ from tqdm import tqdm
 from ibl_pipeline.ingest import alyxraw, reference, subject, action, acquisition, data, QueryBuffer
 from ibl_pipeline.ingest import get_raw_field as grf
 from ibl_pipeline.utils import is_valid_uuid
+from ibl_pipeline.process import task_ledger
 import os
 
 
@@ -149,7 +150,9 @@ def main(new_pks=None, excluded_tables=[]):
         if table_name in excluded_tables:
             continue
         print(f'Ingesting table {table_name}...')
-        ingest_membership_table(**tab_args, new_pks=new_pks)
+        with task_ledger.record(
+                task_ledger.get_table_name(tab_args['dj_current_table'])):
+            ingest_membership_table(**tab_args, new_pks=new_pks)
 
 
 def ingest_membership_table(dj_current_table,
@@ -204,45 +207,63 @@ def ingest_membership_table(dj_current_table,
     alyx_field_entries = alyxraw.AlyxRaw.Field & alyxraw_to_insert & \
         {'fname': alyx_field} & 'fvalue!="None"'
 
-    keys = (alyxraw.AlyxRaw & alyx_field_entries).proj(**{dj_parent_uuid_name: 'uuid'})
-
     if type(dj_parent_fields) == str:
         dj_parent_fields = [dj_parent_fields]
 
+    # all referenced uuids of the parent entries, in one query
+    parent_uuids, other_uuids = (
+        alyx_field_entries & (alyxraw.AlyxRaw & {'model': alyx_parent_model})
+    ).fetch('uuid', 'fvalue')
 
-    insert_buffer = QueryBuffer(dj_current_table)
+    if not len(parent_uuids):
+        return
+
+    # parent fields of each parent uuid, in one query
+    keys = (alyxraw.AlyxRaw & alyx_field_entries).proj(**{dj_parent_uuid_name: 'uuid'})
+    parent_entries = {
+        str(entry.pop(dj_parent_uuid_name)): entry
+        for entry in (dj_parent_table & keys).fetch(
+            dj_parent_uuid_name, *dj_parent_fields, as_dict=True)}
+
+    # field of each referenced entry of the other table, restricted by the
+    # referenced uuids in chunks
+    other_uuids_valid = set(u for u in other_uuids if is_valid_uuid(u))
+    buffer = QueryBuffer(
+        dj.U(dj_other_uuid_name, dj_other_field) & dj_other_table)
+    for u in other_uuids_valid:
+        buffer.add_to_queue1({dj_other_uuid_name: u})
+        buffer.flush_fetch('KEY', chunksz=200)
+    buffer.flush_fetch('KEY')
+    other_fields = {
+        str(entry[dj_other_uuid_name]): entry[dj_other_field]
+        for entry in buffer.fetched_results}
 
-    for key in keys:
+    other_field_name = renamed_other_field_name or dj_other_field
 
-        if not dj_parent_table & key:
-            print(f'The entry {key} is not parent table {dj_parent_table.__name__}')
+    missing_parents = set()
+    missing_others = set()
+    insert_buffer = QueryBuffer(dj_current_table)
+
+    for parent_uuid, other_uuid in zip(parent_uuids, other_uuids):
+        parent_uuid = str(parent_uuid)
+        if parent_uuid not in parent_entries:
+            missing_parents.add(parent_uuid)
+            continue
+        if other_uuid not in other_fields:
+            missing_others.add(other_uuid)
             continue
 
-        entry_base = (dj_parent_table & key).fetch(*dj_parent_fields, as_dict=True)[0]
-
-        key['uuid'] = key[dj_parent_uuid_name]
-        uuids = grf(key, alyx_field, multiple_entries=True,
-                    model=alyx_parent_model)
-        if len(uuids):
-            for uuid in uuids:
-                if uuid == 'None':
-                    continue
-                else:
-                    if not dj_other_table & {dj_other_uuid_name: uuid}:
-                        print(f'The uuid {uuid} is not datajoint table {dj_other_table.__name__}')
-                        continue
-                    entry = entry_base.copy()
-                    field_value = (dj_other_table & {dj_other_uuid_name: uuid}).fetch1(dj_other_field)
-                    if renamed_other_field_name:
-                        entry[renamed_other_field_name] = field_value
-                    else:
-                        entry[dj_other_field] = field_value
-
-                    insert_buffer.add_to_queue1(entry)
-                    insert_buffer.flush_insert(skip_duplicates=True, chunksz=1000)
+        insert_buffer.add_to_queue1(
+            dict(parent_entries[parent_uuid],
+                 **{other_field_name: other_fields[other_uuid]}))
+        insert_buffer.flush_insert(skip_duplicates=True, chunksz=1000)
 
     insert_buffer.flush_insert(skip_duplicates=True)
 
+    if missing_parents:
+        print(f'{len(missing_parents)} entries are not in parent table {dj_parent_table.__name__}')
+    if missing_others:
+        print(f'{len(missing_others)} uuids are not in datajoint table {dj_other_table.__name__}')
 
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@ This script copies tuples in the shadow tables into the real tables for alyx.
 import datajoint as dj
 from ibl_pipeline.ingest.common import *
 from ibl_pipeline import reference, subject, action, acquisition, data, ephys
+from ibl_pipeline.process import change_log, task_ledger
 import traceback
 import datetime
 import os
@@ -112,6 +113,14 @@ EPHYS_TABLES = (
     'Probe',
 )
 
+# tables whose new rows mark their subjects as changed in job.SubjectChange
+SUBJECT_CHANGE_TABLES = (
+    'Session',
+    'Weighing',
+    'WaterAdministration',
+    'WaterRestriction',
+)
+
 
 def copy_table(target_schema, src_schema, table_name,
                fresh=False, use_uuid=True, backtrack_days=None, **kwargs):
@@ -129,6 +138,8 @@ def copy_table(target_schema, src_schema, table_name,
 
     if fresh:
         target_table.insert(src_table, **kwargs)
+        if table_name == 'FileRecord':
+            data.DataSetAvailability.update_sessions()
     else:
         # only ingest entries within certain number of days
         if backtrack_days and 'session_start_time' in src_table.heading.attributes:
@@ -147,6 +158,19 @@ def copy_table(target_schema, src_schema, table_name,
         else:
             q_insert = q_src_table - target_table.proj()
 
+        if table_name in SUBJECT_CHANGE_TABLES:
+            change_log.log_subject_changes(
+                (dj.U('subject_uuid') & q_insert).fetch('subject_uuid'),
+                table_name)
+
+        if table_name == 'FileRecord':
+            # backfill all sessions the first time
+            if len(data.DataSetAvailability):
+                updated_sessions = (dj.U('subject_uuid', 'session_start_time')
+                                    & q_insert).fetch('KEY')
+            else:
+                updated_sessions = None
+
         try:
             target_table.insert(q_insert, skip_duplicates=True, **kwargs)
 
@@ -161,6 +185,9 @@ def copy_table(target_schema, src_schema, table_name,
                     print("Error when inserting {}".format(t))
                     traceback.print_exc()
 
+        if table_name == 'FileRecord':
+            data.DataSetAvailability.update_sessions(updated_sessions)
+
 
 def main(excluded_tables=[]):
     mods = [
@@ -180,16 +207,19 @@ def main(excluded_tables=[]):
             if table in excluded_tables:
                 continue
             print(table)
-            copy_table(target, source, table, backtrack_days=backtrack_days)
+            with task_ledger.record(f'{target.schema.database}.{table}'):
+                copy_table(target, source, table, backtrack_days=backtrack_days)
 
     # ephys tables
     table = 'ProbeModel'
     print(table)
-    copy_table(ephys, ephys_ingest, table)
+    with task_ledger.record(f'{ephys.schema.database}.{table}'):
+        copy_table(ephys, ephys_ingest, table)
 
     table = 'ProbeInsertion'
     print(table)
-    copy_table(ephys, ephys_ingest, table, allow_direct_insert=True)
+    with task_ledger.record(f'{ephys.schema.database}.{table}'):
+        copy_table(ephys, ephys_ingest, table, allow_direct_insert=True)
 
 
 if __name__ == '__main__':
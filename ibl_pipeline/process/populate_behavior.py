@@ -8,6 +8,8 @@ from ibl_pipeline.plotting import behavior as behavior_plotting
 
 import datetime
 from ibl_pipeline import subject, reference, action
+from ibl_pipeline.process import change_log, task_ledger
+from ibl_pipeline.utils import query_profiler
 from tqdm import tqdm
 from os import environ
 
@@ -37,58 +39,79 @@ BEHAVIOR_TABLES = [
 if mode != 'public':
     BEHAVIOR_TABLES.append(behavior_plotting.WaterTypeColor)
 
+# tables whose new rows mark their subjects as changed in job.SubjectChange
+SUBJECT_CHANGE_TABLES = [
+    behavior.TrialSet,
+    behavior_analyses.SessionTrainingStatus,
+    behavior_analyses.BehavioralSummaryByDate,
+]
+
 
 kwargs = dict(
         suppress_errors=True, display_progress=True)
 
 
 def compute_latest_date():
+    """
+    Compute the last date of any event for all subjects with a few grouped
+    queries, and insert into LatestDate only the subjects whose latest date
+    differs from the one recorded in their last check.
+    """
+
+    latest_behavior = subject.Subject.aggr(
+        behavior_analyses.BehavioralSummaryByDate,
+        last_behavior_date='MAX(session_date)')
+    subject_uuids, last_behavior_dates = latest_behavior.fetch(
+        'subject_uuid', 'last_behavior_date')
+    latest_dates = dict(zip(subject_uuids, last_behavior_dates))
 
-    for key in tqdm(subject.Subject.fetch('KEY'), position=0):
-        behavior_summary = behavior_analyses.BehavioralSummaryByDate & key
-        if behavior_summary:
-            latest_behavior = subject.Subject.aggr(
-                behavior_summary,
-                last_behavior_date='MAX(session_date)')
-
-        if mode != 'public':
-            water_weight = action.Weighing * action.WaterAdministration & key
-
-            if water_weight:
-                latest_weight = subject.Subject.aggr(
-                    action.Weighing & key,
-                    last_weighing_date='DATE(MAX(weighing_time))')
-                latest_water = subject.Subject.aggr(
-                    action.WaterAdministration & key,
-                    last_water_date='DATE(MAX(administration_time))')
-
-                latest_water_weight = (latest_water * latest_weight).proj(
-                    last_water_weight_date='GREATEST(last_water_date, \
-                                                    last_weighing_date)')
-        else:
-            water_weight = None
-
-        if not(behavior_summary or water_weight):
-            continue
-        elif behavior_summary and water_weight:
-            last_behavior_date = latest_behavior.fetch1(
-                'last_behavior_date'
-            )
-            last_water_weight_date = latest_water_weight.fetch1(
-                'last_water_weight_date'
-            )
-            latest_date = max([last_behavior_date, last_water_weight_date])
-        elif behavior_summary:
-            latest_date = latest_behavior.fetch1(
-                'last_behavior_date'
-            )
-        elif water_weight:
-            latest_date = latest_water_weight.fetch1(
-                'last_water_weight_date'
-            )
-
-        key['latest_date'] = latest_date
-        behavior_plotting.LatestDate.insert1(key)
+    if mode != 'public':
+        latest_weight = subject.Subject.aggr(
+            action.Weighing,
+            last_weighing_date='DATE(MAX(weighing_time))')
+        latest_water = subject.Subject.aggr(
+            action.WaterAdministration,
+            last_water_date='DATE(MAX(administration_time))')
+        latest_water_weight = (latest_water * latest_weight).proj(
+            last_water_weight_date='GREATEST(last_water_date, \
+                                            last_weighing_date)')
+
+        for subject_uuid, last_water_weight_date in zip(
+                *latest_water_weight.fetch(
+                    'subject_uuid', 'last_water_weight_date')):
+            latest_dates[subject_uuid] = max(
+                latest_dates.get(subject_uuid, last_water_weight_date),
+                last_water_weight_date)
+
+    # latest date recorded by the last check of each subject
+    last_check = subject.Subject.aggr(
+        behavior_plotting.LatestDate,
+        checking_ts='MAX(checking_ts)') * behavior_plotting.LatestDate
+    recorded_dates = dict(zip(*last_check.fetch(
+        'subject_uuid', 'latest_date')))
+
+    entries = [
+        dict(subject_uuid=subject_uuid, latest_date=latest_date)
+        for subject_uuid, latest_date in latest_dates.items()
+        if recorded_dates.get(subject_uuid) != latest_date]
+
+    print(f'{len(entries)} out of {len(latest_dates)} subjects have a new latest date.')
+    behavior_plotting.LatestDate.insert(entries)
+
+
+def populate_with_change_log(table, restrictor, **kwargs):
+    """
+    Populate table and log the subjects of the keys populated without error
+    in job.SubjectChange. The keys left to populate are fetched once and
+    passed on to the populate.
+    """
+    keys = ((table.key_source & restrictor) - table.proj()).fetch('KEY')
+    timer = task_ledger.populate(table, restrictor, keys=keys, **kwargs)
+
+    failed = [key for key, _ in timer['errors']]
+    change_log.log_subject_changes(
+        [key['subject_uuid'] for key in keys if key not in failed],
+        table.__name__)
 
 
 def process_cumulative_plots(backtrack_days=30):
@@ -109,7 +132,13 @@ def process_cumulative_plots(backtrack_days=30):
             checking_ts='MAX(checking_ts)') & \
                 (subject.Subject & 'subject_nickname not like "%human%"').proj()
 
-    subj_keys = (subject.Subject & behavior_plotting.CumulativeSummary & latest).fetch('KEY')
+    start = datetime.datetime.now()
+    changes, refresh_ts = change_log.get_changes('CumulativeSummary')
+
+    subjects = subject.Subject & behavior_plotting.CumulativeSummary & latest
+    # only recompute subjects that got new rows since the last refresh
+    subj_keys = (subjects & (dj.U('subject_uuid') & changes)).fetch('KEY')
+    n_skipped = len(subjects) - len(subj_keys)
 
     # delete and repopulate subject by subject
     with dj.config(safemode=False):
@@ -133,18 +162,35 @@ def process_cumulative_plots(backtrack_days=30):
 
         behavior_plotting.CumulativeSummary.populate(**kwargs)
 
+    change_log.record_refresh(
+        'CumulativeSummary', refresh_ts, start,
+        n_recomputed=len(subj_keys), n_skipped=n_skipped)
+
 
 def process_daily_summary():
 
+    start = datetime.datetime.now()
+    changes, refresh_ts = change_log.get_changes('DailyLabSummary')
+
     with dj.config(safemode=False):
         print('Populating plotting.DailyLabSummary...')
-        last_sessions = (reference.Lab.aggr(
+        last_sessions = reference.Lab.aggr(
             behavior_plotting.DailyLabSummary,
-            last_session_time='max(last_session_time)')).fetch('KEY')
-        (behavior_plotting.DailyLabSummary & last_sessions).delete()
+            last_session_time='max(last_session_time)')
+        # only recompute labs with subjects that got new rows since the last refresh
+        last_sessions_changed = (
+            last_sessions & (dj.U('lab_name') & changes)).fetch('KEY')
+        n_skipped = len(last_sessions) - len(last_sessions_changed)
+        if last_sessions_changed:
+            (behavior_plotting.DailyLabSummary & last_sessions_changed).delete()
         behavior_plotting.DailyLabSummary.populate(**kwargs)
 
+    change_log.record_refresh(
+        'DailyLabSummary', refresh_ts, start,
+        n_recomputed=len(last_sessions_changed), n_skipped=n_skipped)
 
+
+@query_profiler.profiled
 def main(backtrack_days=30, excluded_tables=[]):
 
     if backtrack_days:
@@ -167,7 +213,10 @@ def main(backtrack_days=30, excluded_tables=[]):
         else:
             restrictor = {}
 
-        table.populate(restrictor, **kwargs)
+        if table in SUBJECT_CHANGE_TABLES:
+            populate_with_change_log(table, restrictor, **kwargs)
+        else:
+            task_ledger.populate(table, restrictor, **kwargs)
 
     print('Populating latest date...')
     compute_latest_date()
@@ -175,9 +224,13 @@ def main(backtrack_days=30, excluded_tables=[]):
     print('Processing Cumulative plots...')
     process_cumulative_plots()
 
+    refresh_jobs = ['CumulativeSummary']
     if mode != 'public':
         print('Processing daily summary...')
         process_daily_summary()
+        refresh_jobs.append('DailyLabSummary')
+
+    change_log.prune_changes(refresh_jobs)
 
 
 if __name__ == '__main__':
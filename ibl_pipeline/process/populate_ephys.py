@@ -9,6 +9,8 @@ Shan Shen, 2020-08-15
 '''
 
 from ibl_pipeline.common import *
+from ibl_pipeline.process import task_ledger
+from ibl_pipeline.utils import query_profiler
 import logging
 import time
 
@@ -47,6 +49,7 @@ EPHYS_TABLES = [
 ]
 
 
+@query_profiler.profiled
 def main(exclude_plottings=False):
     logging.basicConfig(
         format='%(asctime)s - %(message)s',
@@ -66,7 +69,7 @@ def main(exclude_plottings=False):
         if exclude_plottings and table.__module__ == 'ibl_pipeline.plotting.ephys':
             continue
         logger.log(30, 'Ingesting {}...'.format(table.__name__))
-        table.populate(**kwargs)
+        task_ledger.populate(table, **kwargs)
         logger.log(30, 'Ingestion time of {} is {}'.format(
             table.__name__,
             time.time()-table_start_time))
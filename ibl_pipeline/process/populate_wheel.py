@@ -23,19 +23,30 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def main(backtrack_days=30):
-
+def get_date_range(backtrack_days):
     date_cutoff = \
         (datetime.datetime.now().date() -
         datetime.timedelta(days=backtrack_days)).strftime('%Y-%m-%d')
-    date_range = f'session_start_time > "{date_cutoff}"'
+    return f'session_start_time > "{date_cutoff}"'
 
-    kwargs = dict(display_progress=True, suppress_errors=True)
+
+def populate_wheel_moves(backtrack_days=30):
     logger.log(25, 'Populating WheelMoveSet...')
-    wheel.WheelMoveSet.populate(date_range, ephys.ProbeInsertion, **kwargs)
+    wheel.WheelMoveSet.populate(
+        get_date_range(backtrack_days), ephys.ProbeInsertion,
+        display_progress=True, suppress_errors=True)
+
 
+def populate_movement_times(backtrack_days=30):
     logger.log(25, 'Populating MovementTimes...')
-    wheel.MovementTimes.populate(date_range, ephys.ProbeInsertion, **kwargs)
+    wheel.populate_movement_times(
+        get_date_range(backtrack_days), ephys.ProbeInsertion)
+
+
+def main(backtrack_days=30):
+
+    populate_wheel_moves(backtrack_days)
+    populate_movement_times(backtrack_days)
 
 
 if __name__ == '__main__':
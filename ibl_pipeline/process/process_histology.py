@@ -1,9 +1,14 @@
-from ibl_pipeline.process import ingest_alyx_raw, ingest_real
+from ibl_pipeline.process import ingest_alyx_raw, ingest_real, get_timezone
 from ibl_pipeline.ingest.common import *
 from ibl_pipeline.ingest import populate_batch, QueryBuffer
 from ibl_pipeline.common import *
 from ibl_pipeline.process import update_utils
+from ibl_pipeline.ingest import job
+from ibl_pipeline.utils import atlas, prefetch
 from tqdm import tqdm
+import datajoint as dj
+import datetime
+import hashlib
 import inspect
 import os
 
@@ -55,6 +60,7 @@ if mode != 'public':
     HISTOLOGY_TABLES_FOR_DELETE = [
         histology.ProbeBrainRegionTemp,
         histology.ClusterBrainRegionTemp,
+        histology.DepthBrainRegionTemp,
         histology.ChannelBrainLocationTemp,
         histology.ProbeTrajectoryTemp,
     ]
@@ -98,6 +104,9 @@ def populate_shadow_tables():
         display_progress=True,
         suppress_errors=True)
 
+    # region lookups of this run share one ontology index
+    atlas.get_ontology(validate=True)
+
     for t in HISTOLOGY_SHADOW_TABLES:
 
         print(f'Populating {t.__name__}...')
@@ -107,61 +116,135 @@ def populate_shadow_tables():
             t.populate(**kwargs)
 
 
-def delete_histology_alyx_shadow(verbose=False):
-
-    CHANNEL_TABLES = [
-        histology_ingest.ChannelBrainLocationTemp,
-        alyxraw.AlyxRaw.Field,
-        alyxraw.AlyxRaw
-    ]
-
-    channel_loc_keys = update_utils.get_deleted_keys('experiments.channel')
-    for t in CHANNEL_TABLES:
+def get_probe_hashes(alyxraw_module=update_utils.alyxraw_update):
+    """
+    Content hash of the trajectory estimates and channels of each probe
+    insertion in an alyxraw schema.
+
+    Each record is hashed in the database, channel hashes are combined per
+    trajectory with an order independent XOR, so only one row per trajectory
+    is fetched.
+
+    Args:
+        alyxraw_module (module, optional): alyxraw schema to hash.
+            Defaults to the update alyxraw loaded from the latest dump.
+
+    Returns:
+        dict: probe insertion uuid (str) -> md5 hex digest
+    """
+    dj.conn().query('SET SESSION group_concat_max_len = 1000000')
+
+    raw = alyxraw_module.AlyxRaw
+    fields = raw.Field & 'fname!="json"'
+
+    def record_hashes(model):
+        return (raw & f'model="{model}"').aggr(
+            fields,
+            record_hash='MD5(GROUP_CONCAT(fname, "=", IFNULL(fvalue, "") '
+                        'ORDER BY fname, value_idx SEPARATOR ";"))')
+
+    trajectories = record_hashes('experiments.trajectoryestimate') * \
+        (fields & 'fname="probe_insertion"').proj(probe_insertion_uuid='fvalue')
+    channels = record_hashes('experiments.channel') * \
+        (fields & 'fname="trajectory_estimate"').proj(trajectory_uuid='fvalue')
+    channel_hashes = dj.U('trajectory_uuid').aggr(
+        channels, n_channels='count(*)',
+        channels_hash='BIT_XOR(CONV(LEFT(record_hash, 16), 16, 10))')
+
+    channel_hashes = {
+        trajectory_uuid: f'{n_channels}-{channels_hash}'
+        for trajectory_uuid, n_channels, channels_hash in zip(
+            *channel_hashes.fetch(
+                'trajectory_uuid', 'n_channels', 'channels_hash'))}
+
+    probe_records = dict()
+    for trajectory_uuid, probe_insertion_uuid, record_hash in zip(
+            *trajectories.fetch(
+                'uuid', 'probe_insertion_uuid', 'record_hash')):
+        probe_records.setdefault(probe_insertion_uuid, []).append(
+            f'{record_hash}:{channel_hashes.get(str(trajectory_uuid), "")}')
+
+    return {
+        probe_insertion_uuid: hashlib.md5(
+            ';'.join(sorted(records)).encode()).hexdigest()
+        for probe_insertion_uuid, records in probe_records.items()}
+
+
+def get_changed_probes(probe_hashes):
+    """
+    Compare the hashes of the latest dump with the recorded ones.
+
+    Returns:
+        list: uuids of the probe insertions that are new, changed or deleted
+    """
+    if not len(job.ProbeHistologyHash):
+        # first run, the previously ingested alyxraw is the baseline
+        record_probe_hashes(get_probe_hashes(update_utils.alyxraw))
+
+    recorded = {
+        str(probe_insertion_uuid): histology_hash
+        for probe_insertion_uuid, histology_hash in zip(
+            *job.ProbeHistologyHash.fetch(
+                'probe_insertion_uuid', 'histology_hash'))}
+
+    return [probe_insertion_uuid
+            for probe_insertion_uuid in set(probe_hashes) | set(recorded)
+            if probe_hashes.get(probe_insertion_uuid) !=
+            recorded.get(probe_insertion_uuid)]
+
+
+def record_probe_hashes(probe_hashes, probe_insertion_uuids=None):
+
+    if probe_insertion_uuids is None:
+        probe_insertion_uuids = list(probe_hashes)
+
+    with dj.config(safemode=False):
+        (job.ProbeHistologyHash &
+         [{'probe_insertion_uuid': u}
+          for u in probe_insertion_uuids]).delete_quick()
+
+    job.ProbeHistologyHash.insert(
+        [dict(probe_insertion_uuid=u, histology_hash=probe_hashes[u])
+         for u in probe_insertion_uuids if u in probe_hashes])
+
+
+def delete_histology_alyx_shadow(probe_insertion_uuids, verbose=False):
+    """
+    Delete the alyxraw and shadow entries of the trajectory estimates and
+    channels of the given probe insertions.
+    """
+
+    traj_keys = (alyxraw.AlyxRaw &
+                 (alyxraw.AlyxRaw.Field & 'fname="probe_insertion"' &
+                  [{'fvalue': u} for u in probe_insertion_uuids])).fetch('KEY')
+
+    channel_loc_keys = (alyxraw.AlyxRaw &
+                        (alyxraw.AlyxRaw.Field & 'fname="trajectory_estimate"' &
+                         [{'fvalue': str(k['uuid'])} for k in traj_keys])).fetch('KEY')
+
+    for t, uuid_keys in [(histology_ingest.ChannelBrainLocationTemp, channel_loc_keys),
+                         (histology_ingest.ProbeTrajectoryTemp, traj_keys),
+                         (alyxraw.AlyxRaw.Field, channel_loc_keys + traj_keys),
+                         (alyxraw.AlyxRaw, channel_loc_keys + traj_keys)]:
         print(f'Deleting from table {t.__name__}')
         uuid_name = t.heading.primary_key[0]
-        keys = [{uuid_name: k['uuid']} for k in tqdm(channel_loc_keys)]
-        table = QueryBuffer(t)
-
-        for k in tqdm(keys, position=0):
-            table.add_to_queue1(k)
-            if table.flush_delete(chunksz=1000, quick=True) and verbose:
-                print(f'Deleted 1000 entries from {t.__name__}')
-
-        table.flush_delete(quick=True)
-
-    traj_keys = update_utils.get_deleted_keys('experiments.trajectoryestimate') + \
-        update_utils.get_updated_keys('experiments.trajectoryestimate')
-
-    TRAJ_TABLES = [
-        histology_ingest.ProbeTrajectoryTemp,
-        alyxraw.AlyxRaw.Field,
-        alyxraw.AlyxRaw
-    ]
-
-    for t in TRAJ_TABLES:
-        uuid_name = t.heading.primary_key[0]
-        keys = [{uuid_name: k['uuid']} for k in traj_keys]
         table = QueryBuffer(t)
-        for k in tqdm(keys, position=0):
-            table.add_to_queue1(k)
+        for k in tqdm(uuid_keys, position=0):
+            table.add_to_queue1({uuid_name: k['uuid']})
             if table.flush_delete(chunksz=1000, quick=True) and verbose:
                 print(f'Deleted 1000 entries from {t.__name__}')
         table.flush_delete(quick=True)
 
 
-def delete_histology_real():
-
-    traj_uuids = update_utils.get_deleted_keys('experiments.trajectoryestimate') + \
-        update_utils.get_updated_keys('experiments.trajectoryestimate')
-
-    traj_uuids_real = [
-        {'probe_trajectory_uuid': k['uuid']} for k in traj_uuids]
+def delete_histology_real(probe_insertion_uuids):
 
-    traj_keys = (histology.ProbeTrajectoryTemp & traj_uuids_real).fetch('KEY')
+    probe_keys = (ephys.ProbeInsertion &
+                  [{'probe_insertion_uuid': u}
+                   for u in probe_insertion_uuids]).fetch('KEY')
 
     for t in HISTOLOGY_TABLES_FOR_DELETE:
         print(f'Deleting from table {t.__name__}')
-        (t & traj_keys).delete_quick()
+        (t & probe_keys).delete_quick()
 
 
 def copy_to_real_tables():
@@ -179,30 +262,71 @@ def copy_to_real_tables():
 
 def populate_real_tables():
 
+    atlas.get_ontology(validate=True)
+
     for t in HISTOLOGY_TABLES_FOR_POPULATE:
         print(f'Populating {t.__name__}...')
-        t.populate(suppress_errors=True, display_progress=True)
+        prefetch.populate(t, suppress_errors=True, display_progress=True)
+
+
+def main(fpath='/data/alyxfull.json', job_key=None):
+    """
+    Reprocess the histology of the probe insertions whose trajectory
+    estimates or channels changed in the latest dump.
 
+    Args:
+        fpath (str, optional): alyx dump. Defaults to '/data/alyxfull.json'.
+        job_key (dict, optional): job_date and job_timezone of the ingestion
+            job to report to in job.TaskStatus. Defaults to today's job.
+    """
 
-def main(fpath='/data/alyxfull.json'):
+    start = datetime.datetime.now()
 
     print('Insert to update alyxraw...')
     update_utils.insert_to_update_alyxraw(
         filename=fpath, delete_tables=True,
         models=['experiments.trajectoryestimate', 'experiments.channel'])
+    print('Detecting changed probe insertions...')
+    probe_hashes = get_probe_hashes()
+    changed_probes = get_changed_probes(probe_hashes)
+    n_skipped = len(set(probe_hashes) - set(changed_probes))
+    print(f'{len(changed_probes)} probe insertions to reprocess, '
+          f'{n_skipped} unchanged')
+
     print('Deleting from alyx and shadow...')
-    delete_histology_alyx_shadow()
+    delete_histology_alyx_shadow(changed_probes)
     print('Ingesting new alyxraw...')
     process_alyxraw_histology(filename=fpath)
     print('Populating new shadow...')
     populate_shadow_tables()
     print('Deleting real table entries...')
-    delete_histology_real()
+    delete_histology_real(changed_probes)
     print('Copying to real tables...')
     copy_to_real_tables()
     print('Populating real tables...')
     populate_real_tables()
 
+    record_probe_hashes(probe_hashes, changed_probes)
+
+    if job_key is None:
+        job_key = dict(job_date=datetime.date.today(),
+                       job_timezone=get_timezone())
+
+    if job.Job & job_key:
+        end = datetime.datetime.now()
+        job.TaskStatus.insert1(
+            dict(
+                **job_key,
+                task='Process histology',
+                task_start_time=start,
+                task_end_time=end,
+                task_duration=(end-start).total_seconds()/60.,
+                task_status_comments=f'{len(changed_probes)} probe insertions '
+                                     f'reprocessed, {n_skipped} skipped'
+            ),
+            skip_duplicates=True
+        )
+
 
 def process_public(fpath='/data/alyxfull.json'):
 
@@ -1,7 +1,7 @@
 import datajoint as dj
 from ibl_pipeline.common import *
 from ibl_pipeline import public
-from ibl_pipeline.ingest import QueryBuffer
+from ibl_pipeline.ingest import job
 from tqdm import tqdm
 from ibl_pipeline.process import (
     ingest_alyx_raw,
@@ -11,9 +11,15 @@ from ibl_pipeline.process import (
     populate_behavior,
     populate_ephys,
     process_histology,
-    populate_wheel
+    populate_wheel,
+    task_ledger
 )
+from ibl_pipeline.process.delete_update_entries import stage_pks
+from ibl_pipeline.utils import dependency_graph
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import multiprocessing
+import time
 
 logging.basicConfig(
     format='%(asctime)s - %(message)s',
@@ -25,61 +31,230 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def delete_non_published_records():
+def delete_closure(closure, root, chunksz=1000):
+    """
+    Delete the rows of root and of its descendants bottom-up with
+    delete_quick, parts before masters and children before parents. The keys
+    of the rows are fetched top-down first, the rows are deleted by key,
+    chunksz keys at a time. Returns the number of rows deleted per table.
+    """
+    n_deleted = dict()
+    for table_name, keys in reversed(closure.get_keys(root, chunksz=chunksz)):
+        table = dj.FreeTable(root.connection, table_name)
+        n_deleted[table_name] = sum(
+            (table & keys[i:i+chunksz]).delete_quick(get_count=True)
+            for i in range(0, len(keys), chunksz))
+    return n_deleted
 
-    with dj.config(safemode=False):
 
-        logger.log(25, 'Deleting non-published probe insertions...')
-        probe_insertion_table = QueryBuffer(ephys.ProbeInsertion)
-        for key in tqdm(
-                (ephys.ProbeInsertion - public.PublicProbeInsertion - ephys.DefaultCluster).fetch('KEY')):
-            probe_insertion_table.add_to_queue1(key)
-            if probe_insertion_table.flush_delete(quick=False, chunksz=100):
-                logger.log(25, 'Deleted 100 probe insertions')
+# the non published records, deleted in this order
+NON_PUBLISHED = [
+    dict(stage='public_probe_insertion', table=ephys.ProbeInsertion,
+         uuid_name='probe_insertion_uuid',
+         query=lambda: ephys.ProbeInsertion - public.PublicProbeInsertion
+         - ephys.DefaultCluster),
+    dict(stage='public_session', table=acquisition.Session,
+         uuid_name='session_uuid',
+         query=lambda: acquisition.Session - public.PublicSession
+         - behavior.TrialSet),
+    dict(stage='public_subject', table=subject.Subject,
+         uuid_name='subject_uuid',
+         query=lambda: subject.Subject - public.PublicSubjectUuid
+         - (subject.Subject & acquisition.Session).proj()),
+]
 
-        probe_insertion_table.flush_delete(quick=False)
-        logger.log(25, 'Deleted the rest of the probe insertions')
 
-        logger.log(25, 'Deleting non-published sessions...')
-        session_table = QueryBuffer(acquisition.Session)
-        for key in tqdm(
-                (acquisition.Session - public.PublicSession - behavior.TrialSet).fetch('KEY')):
-            session_table.add_to_queue1(key)
-            if session_table.flush_delete(quick=False, chunksz=100):
-                logger.log(25, 'Deleted 100 sessions')
+def delete_non_published_records(chunksz=1000):
+    """
+    Delete the non published probe insertions, sessions and subjects with all
+    their dependent records.
 
-        session_table.flush_delete(quick=False)
-        logger.log(25, 'Deleted the rest of the sessions')
+    The uuids to delete are staged in job.DeletionStage, in chunks of chunksz.
+    For each chunk, the keys of the rows to remove are fetched top-down from
+    the dependency graph and deleted bottom-up with delete_quick, and the
+    chunk is then removed from the stage. If the deletion is interrupted,
+    the next call resumes with the chunks left in the stage.
+    """
+    for d in NON_PUBLISHED:
+        stage = d['stage']
+        staged = job.DeletionStage & {'stage': stage}
+        if staged:
+            logger.log(25, f'Resuming the deletion of {stage}...')
+        else:
+            stage_pks(stage, [str(pk) for pk in d['query']().fetch(d['uuid_name'])],
+                      chunksz=chunksz)
 
-        logger.log(25, 'Deleting non-published subjects...')
-        subjs = subject.Subject & acquisition.Session
+        chunks = (dj.U('chunk') & staged).fetch('chunk', order_by='chunk')
+        logger.log(25, f'Deleting {stage} in {len(chunks)} chunks...')
 
-        for key in tqdm(
-                (subject.Subject - public.PublicSubjectUuid - subjs.proj()).fetch('KEY')):
-            (subject.Subject & key).delete()
+        # the graph is walked once, only the root changes per chunk
+        closure = dependency_graph.Closure(
+            dependency_graph.load_graph(), d['table'].full_table_name)
 
+        n_deleted = dict()
+        start = time.time()
+        for chunk in tqdm(chunks, position=0):
+            chunk_staged = staged & {'chunk': chunk}
+            root = d['table'] & chunk_staged.proj(**{d['uuid_name']: 'uuid'})
+            for table_name, n in delete_closure(closure, root).items():
+                n_deleted[table_name] = n_deleted.get(table_name, 0) + n
+            # checkpoint
+            chunk_staged.delete_quick()
 
-def main(populate_only=False):
+        for table_name, n in n_deleted.items():
+            if n:
+                logger.log(25, f'Deleted {n} entries from {table_name}')
+        logger.log(25, f'Deleted {sum(n_deleted.values())} entries for '
+                       f'{stage} in {time.time() - start:.1f} s')
+
+
+# fields through which an alyx entry belongs to a dataset, trajectory, probe
+# insertion, session or subject, checked in this order
+PUBLISHED_FIELDS = ['dataset', 'trajectory_estimate', 'probe_insertion',
+                    'session', 'subject']
+
+# breeding pairs reference their parent subjects through father, mother1 and
+# mother2, and litters and litter subjects reference the breeding pairs, so
+# they are left out of the public release with their tables
+UNPUBLISHED_MODELS = ['subjects.breedingpair', 'subjects.litter']
+UNPUBLISHED_TABLES = ['BreedingPair', 'Litter', 'LitterSubject']
+
+
+def get_published_entries(entries):
+    """
+    Entries of the alyx dump that belong to the public release: the published
+    subjects and sessions, the published probe insertions of the published
+    sessions, the subjects of the published sessions, the entries attached to
+    any of these directly or through other entries (datasets and their file
+    records, trajectories and their channels, weighings...), and every entry
+    attached to none of them (labs, users, dataset types...) except the
+    UNPUBLISHED_MODELS. These are the records that
+    delete_non_published_records keeps.
+
+    Published subjects are matched on the lab and nickname of
+    public.PublicSubject, since public.PublicSubjectUuid is computed from
+    alyxraw.
+    """
+    lab_names = {e['pk']: e['fields']['name'] for e in entries
+                 if e['model'] == 'misc.lab'}
+    public_subjects = set(zip(*public.PublicSubject.fetch(
+        'lab_name', 'subject_nickname')))
+
+    public_pks = {
+        'experiments.probeinsertion': {
+            str(pk) for pk in public.PublicProbeInsertion.fetch(
+                'probe_insertion_uuid')},
+        'actions.session': {
+            str(pk) for pk in public.PublicSession.fetch('session_uuid')},
+        'subjects.subject': {
+            e['pk'] for e in entries if e['model'] == 'subjects.subject'
+            and (lab_names.get(e['fields']['lab']),
+                 e['fields']['nickname']) in public_subjects},
+    }
+    for e in entries:
+        if e['model'] == 'actions.session' and \
+                e['pk'] in public_pks['actions.session']:
+            public_pks['subjects.subject'].add(e['fields']['subject'])
+
+    by_pk = {e['pk']: e for e in entries}
+    published = dict()
+
+    def is_published(e):
+        # entries are resolved through the entry they are attached to, e.g. a
+        # channel through its trajectory, its probe insertion and its session
+        if e['pk'] in published:
+            return published[e['pk']]
+        if e['model'] in UNPUBLISHED_MODELS:
+            published[e['pk']] = False
+        elif e['model'] in public_pks and \
+                e['pk'] not in public_pks[e['model']]:
+            published[e['pk']] = False
+        elif e['model'] in ('actions.session', 'subjects.subject'):
+            published[e['pk']] = True
+        else:
+            published[e['pk']] = True
+            for field in PUBLISHED_FIELDS:
+                if e['fields'].get(field):
+                    parent = by_pk.get(e['fields'][field])
+                    published[e['pk']] = \
+                        parent is not None and is_published(parent)
+                    break
+        return published[e['pk']]
+
+    return [e for e in entries if is_published(e)]
+
+
+def populate_complete_sessions():
+    for table in (behavior.CompleteWheelSession, behavior.CompleteTrialSession):
+        task_ledger.populate(table, populate_wheel.get_date_range(1000),
+                             **populate_behavior.kwargs)
+
+
+def populate_behavior_tables():
+    populate_behavior.main(
+        backtrack_days=1000,
+        excluded_tables=['CompleteWheelSession', 'CompleteTrialSession'])
+
+
+def populate_wheel_moves():
+    populate_wheel.populate_wheel_moves(backtrack_days=1000)
+
+
+def populate_movement_times():
+    populate_wheel.populate_movement_times(backtrack_days=1000)
+
+
+# stages of the populate, the functions within a stage are independent and
+# run in parallel
+POPULATE_STAGES = [
+    [populate_complete_sessions],
+    [populate_behavior_tables, populate_wheel_moves],
+    [populate_movement_times],
+]
+
+
+def run_stage(funcs, n_processes):
+    """
+    Run the functions of a stage, in separate processes if n_processes > 1.
+    Processes are spawned so that each opens its own database connection.
+    They share the ALF cache, which stores and links files atomically.
+    """
+    if n_processes <= 1 or len(funcs) == 1:
+        for func in funcs:
+            func()
+        return
+
+    with ProcessPoolExecutor(
+            max_workers=min(n_processes, len(funcs)),
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(func) for func in funcs]
+        for future in futures:
+            future.result()
+
+
+def main(populate_only=False, n_processes=2):
 
     if not populate_only:
+        logger.log(25, 'Selecting the published alyx entries...')
+        entries = get_published_entries(ingest_alyx_raw.get_alyx_entries())
         logger.log(25, 'Ingesting alyxraw...')
-        ingest_alyx_raw.insert_to_alyxraw(
-            ingest_alyx_raw.get_alyx_entries())
+        ingest_alyx_raw.insert_to_alyxraw(entries)
+        public.PublicSubjectUuid.populate(suppress_errors=True)
         logger.log(25, 'Ingesting shadow tables...')
-        ingest_shadow.main()
+        ingest_shadow.main(excluded_tables=UNPUBLISHED_TABLES)
         logger.log(25, 'Ingesting shadow membership...')
         ingest_membership.main()
         logger.log(25, 'Copying to real tables...')
-        ingest_real.main()
+        ingest_real.main(excluded_tables=UNPUBLISHED_TABLES)
 
+        # only the records published in an earlier release and withdrawn since
         logger.log(25, 'Deleting the non published records...')
         delete_non_published_records()
 
-    logger.log(25, 'Processing behavior...')
-    populate_behavior.main(backtrack_days=1000)
-
-    logger.log(25, 'Processing wheel...')
-    populate_wheel.main(backtrack_days=1000)
+    for funcs in POPULATE_STAGES:
+        logger.log(25, 'Processing {}...'.format(
+            ', '.join(func.__name__ for func in funcs)))
+        run_stage(funcs, n_processes)
 
     # logger.log(25, 'Processing ephys...')
     # populate_ephys.main()
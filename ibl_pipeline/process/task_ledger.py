@@ -0,0 +1,204 @@
+'''
+Per-table instrumentation of the ingestion tasks, stored in
+job.TaskStatus.TableRun next to the task timing of job.TaskStatus.
+
+Within `with task_ledger.task(job_key, task):`, the ingestion and populate
+routines report each table they process through `record` or `populate`:
+keys attempted, succeeded and failed, rows inserted, database round trips,
+bytes fetched from the external stores, wall and cpu time. Outside of a task,
+`record` does nothing and `populate` simply populates.
+'''
+import datajoint as dj
+from datajoint.external import ExternalTable
+from contextlib import contextmanager
+from ibl_pipeline.ingest import job
+from ibl_pipeline.utils import prefetch
+import datetime
+import pandas as pd
+import time
+
+
+COUNTERS = ['keys_attempted', 'keys_succeeded', 'keys_failed',
+            'rows_inserted', 'db_round_trips', 'bytes_fetched',
+            'wall_time', 'cpu_time']
+
+# task being recorded, see task()
+_task = None
+
+
+def get_table_name(table):
+    return f'{table.database}.{table.__name__}'
+
+
+@contextmanager
+def instrument(stats):
+    """
+    Count the statements sent to the database, the rows they inserted and the
+    bytes fetched from the external stores during the block into stats.
+    """
+    conn = dj.conn()
+    patched_conn = 'query' in vars(conn)
+    query = conn.query
+    get = ExternalTable.get
+
+    def counted_query(sql, *args, **kwargs):
+        cursor = query(sql, *args, **kwargs)
+        stats['db_round_trips'] += 1
+        if sql.lstrip()[:7].upper() in ('INSERT ', 'REPLACE'):
+            stats['rows_inserted'] += max(cursor.rowcount, 0)
+        return cursor
+
+    def counted_get(self, *args, **kwargs):
+        blob = get(self, *args, **kwargs)
+        stats['bytes_fetched'] += len(blob) if blob else 0
+        return blob
+
+    conn.query = counted_query
+    ExternalTable.get = counted_get
+    try:
+        yield stats
+    finally:
+        ExternalTable.get = get
+        if patched_conn:
+            conn.query = query
+        else:
+            del conn.query
+
+
+@contextmanager
+def record(table_name):
+    """
+    Record the work done in the block as table_name in the active task.
+    Yields the statistics, the caller may set the keys_* counts.
+    """
+    stats = dict(dict.fromkeys(COUNTERS), rows_inserted=0, db_round_trips=0,
+                 bytes_fetched=0)
+    if _task is None:
+        yield stats
+        return
+
+    wall_start, cpu_start = time.time(), time.process_time()
+    try:
+        with instrument(stats):
+            yield stats
+    finally:
+        stats.update(wall_time=time.time() - wall_start,
+                     cpu_time=time.process_time() - cpu_start)
+        # a table processed more than once in a task is recorded once
+        recorded = _task['tables'].setdefault(
+            table_name, dict.fromkeys(COUNTERS))
+        for counter, value in stats.items():
+            if value is not None:
+                recorded[counter] = (recorded[counter] or 0) + value
+
+
+def populate(table, *restrictions, **kwargs):
+    """
+    Populate table with prefetch.populate, recording it in the active task.
+    Returns the timings of prefetch.populate.
+    """
+    if _task is None:
+        return prefetch.populate(table, *restrictions, **kwargs)
+
+    keys = kwargs.get('keys')
+    n_keys = len(keys) if keys is not None else \
+        len((table.key_source & dj.AndList(restrictions)) - table.proj())
+    with record(get_table_name(table)) as stats:
+        timer = prefetch.populate(table, *restrictions, **kwargs)
+        n_failed = len(timer['errors'])
+        stats.update(keys_attempted=n_keys, keys_failed=n_failed,
+                     keys_succeeded=n_keys - n_failed)
+    return timer
+
+
+@contextmanager
+def task(job_key, task_name):
+    """
+    Record a task of an ingestion job in job.TaskStatus, and the tables
+    recorded during it in job.TaskStatus.TableRun. Nothing is recorded if the
+    task raises. Yields a dictionary whose 'comments' go to
+    task_status_comments.
+    """
+    global _task
+    previous, _task = _task, dict(tables=dict(), comments='')
+    start = datetime.datetime.now()
+    try:
+        yield _task
+    finally:
+        current, _task = _task, previous
+
+    end = datetime.datetime.now()
+    key = dict(**job_key, task=task_name)
+    job.TaskStatus.insert1(
+        dict(
+            **key,
+            task_start_time=start,
+            task_end_time=end,
+            task_duration=(end-start).total_seconds()/60.,
+            task_status_comments=current['comments'][:1000]
+        ),
+        skip_duplicates=True
+    )
+    job.TaskStatus.TableRun.insert(
+        [dict(**key, table_name=table_name, **stats)
+         for table_name, stats in current['tables'].items()],
+        skip_duplicates=True
+    )
+
+
+def get_table_runs(table_name=None, task_name=None, days=30):
+    """
+    Recorded table runs of the last days, latest first.
+
+    Args:
+        table_name (str, optional): restrict to a table, e.g. 'ibl_behavior.TrialSet'.
+            Defaults to all tables.
+        task_name (str, optional): restrict to a task, e.g. 'Ingest shadow'.
+            Defaults to all tasks.
+        days (int, optional): Defaults to 30.
+
+    Returns:
+        pandas.DataFrame: one row per job, task and table.
+    """
+    runs = job.TaskStatus.TableRun * job.TaskStatus.proj('task_start_time') & \
+        f'job_date >= CURDATE() - INTERVAL {days} DAY'
+    if table_name:
+        runs &= {'table_name': table_name}
+    if task_name:
+        runs &= {'task': task_name}
+
+    return runs.fetch(format='frame',
+                      order_by='task_start_time desc').reset_index()
+
+
+def compare_to_history(job_key, counter='wall_time', n_jobs=7):
+    """
+    Compare a counter of every table in a job to its median over the previous
+    jobs, to pinpoint the tables responsible for a regression.
+
+    Args:
+        job_key (dict): job_date and job_timezone of the job.
+        counter (str, optional): one of COUNTERS. Defaults to 'wall_time'.
+        n_jobs (int, optional): number of previous jobs in the median.
+            Defaults to 7.
+
+    Returns:
+        pandas.DataFrame: counter in the job, previous median and their
+            ratio per task and table, largest ratio first.
+    """
+    runs = job.TaskStatus.TableRun & \
+        f'job_date <= "{job_key["job_date"]}"' & \
+        {'job_timezone': job_key['job_timezone']}
+    runs = runs.proj(counter).fetch(format='frame').reset_index()
+
+    job_dates = sorted(runs['job_date'].unique())[-n_jobs-1:]
+    runs = runs[runs['job_date'].isin(job_dates)]
+
+    is_current = runs['job_date'] == pd.Timestamp(job_key['job_date']).date()
+    current = runs[is_current].set_index(['task', 'table_name'])[counter]
+    history = runs[~is_current].groupby(['task', 'table_name'])[counter].median()
+
+    comparison = pd.DataFrame({'current': current, 'median': history}).dropna(
+        subset=['current'])
+    comparison['ratio'] = comparison['current'] / comparison['median']
+    return comparison.sort_values('ratio', ascending=False)
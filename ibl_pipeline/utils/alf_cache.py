@@ -0,0 +1,321 @@
+'''
+Shared on-disk cache of the ALF files loaded by the populate functions.
+
+Files are stored once per dataset uuid and md5 (from data.DataSet), so a file
+fetched for one table is reused by every other table and by later populates,
+and a new version of a dataset (new md5) is fetched again. The least recently
+used files are evicted when the cache grows over its size limit.
+
+Files are exposed through a session directory tree of symbolic links that
+mirrors the FlatIron layout, so alf.io.get_session_path and
+alf.io.load_object work on the returned paths as they do on ONE downloads.
+
+Configuration through environment variables:
+    ALF_CACHE_DIR: root of the cache, defaults to ~/.alf_cache
+    ALF_CACHE_SIZE_GB: size limit of the cache, defaults to 100
+    ALF_CACHE_LOCAL_ROOT: if set, files are copied from this local copy of
+        the FlatIron tree instead of downloaded with ONE
+'''
+from ibl_pipeline import acquisition, data
+from contextlib import contextmanager
+from pathlib import Path
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+
+
+DATASET_FIELDS = ['session_uuid', 'dataset_uuid', 'dataset_name',
+                  'dataset_type_name', 'md5', 'relative_path']
+
+SESSION_PATH = re.compile(r'\d{4}-\d{2}-\d{2}/\d{3}/')
+
+
+def get_relative_path(dataset):
+    """FlatIron path of a dataset, relative to the data root"""
+    relative_path = dataset['relative_path'].replace('\\', '/')
+    if not relative_path.endswith(dataset['dataset_name']):
+        relative_path = relative_path.rstrip('/') + '/' + dataset['dataset_name']
+    return relative_path
+
+
+def get_session_relative_path(dataset):
+    """Path of a dataset relative to its session directory, e.g. alf/probe00/spikes.times.npy"""
+    relative_path = get_relative_path(dataset)
+    match = SESSION_PATH.search(relative_path)
+    return relative_path[match.end():] if match else dataset['dataset_name']
+
+
+def get_datasets(key, dataset_types):
+    """
+    Datasets of the given types with an existing FlatIron file record,
+    restricted by key, as a list of dictionaries with the DATASET_FIELDS.
+    Dataset types containing % are LIKE patterns.
+    """
+    query = acquisition.Session.proj('session_uuid') * data.DataSet * \
+        data.FileRecord & key & 'repo_name LIKE "flatiron_%"' & \
+        {'exists': 1} & [
+            f'dataset_type_name LIKE "{t}"' if '%' in t
+            else {'dataset_type_name': t} for t in dataset_types]
+
+    # a dataset may have a record in several FlatIron repositories
+    datasets = dict()
+    for d in query.fetch(*DATASET_FIELDS, as_dict=True):
+        datasets.setdefault(d['dataset_uuid'], d)
+    return list(datasets.values())
+
+
+class LocalDirectoryFetcher:
+    """Fetch the files from a local copy of the FlatIron directory tree"""
+
+    transfer = staticmethod(shutil.copy2)
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def fetch(self, datasets):
+        paths = dict()
+        for d in datasets:
+            path = self.root / get_relative_path(d)
+            if path.exists():
+                paths[d['dataset_uuid']] = path
+        return paths
+
+
+class OneFetcher:
+    """Download the files with ONE, one call per session"""
+
+    transfer = staticmethod(shutil.move)
+
+    def __init__(self, one=None):
+        if one is None:
+            from oneibl.one import ONE
+            one = ONE(silent=True)
+        self.one = one
+
+    def fetch(self, datasets):
+        sessions = dict()
+        for d in datasets:
+            sessions.setdefault(str(d['session_uuid']), []).append(d)
+
+        paths = dict()
+        for eID, session_datasets in sessions.items():
+            dataset_types = sorted(
+                {d['dataset_type_name'] for d in session_datasets})
+            files = [Path(f).as_posix() for f in self.one.load(
+                eID, dataset_types=dataset_types, download_only=True,
+                clobber=True) if f]
+            for d in session_datasets:
+                session_relative_path = get_session_relative_path(d)
+                matches = [f for f in files if f.endswith(session_relative_path)]
+                if matches:
+                    paths[d['dataset_uuid']] = Path(matches[0])
+        return paths
+
+
+def get_default_fetcher():
+    local_root = os.environ.get('ALF_CACHE_LOCAL_ROOT')
+    return LocalDirectoryFetcher(local_root) if local_root else OneFetcher()
+
+
+class ALFCache:
+    """
+    Content-addressed file cache with least recently used eviction.
+
+    Args:
+        root (str or Path, optional): cache directory.
+        max_bytes (float, optional): size limit of the cached files.
+        fetcher (optional): object with a fetch(datasets) method returning a
+            dictionary dataset_uuid -> local path of the fetched files, and a
+            transfer(src, dst) function moving or copying them into the
+            cache. Defaults to get_default_fetcher().
+    """
+
+    def __init__(self, root=None, max_bytes=None, fetcher=None):
+
+        self.root = Path(
+            root or os.environ.get('ALF_CACHE_DIR',
+                                   Path.home() / '.alf_cache'))
+        if max_bytes is None:
+            max_bytes = float(os.environ.get('ALF_CACHE_SIZE_GB', 100)) * 1e9
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher or get_default_fetcher()
+
+        self.objects = self.root / 'objects'
+        self.sessions = self.root / 'sessions'
+        # size of the cached files, scanned on first use and then counted as
+        # files are stored, so that the cache is only scanned for eviction
+        # when it crosses max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+    def object_path(self, dataset):
+        version = dataset['md5'] or 'nomd5'
+        return self.objects / f'{dataset["dataset_uuid"]}_{version}' / \
+            dataset['dataset_name']
+
+    def get(self, datasets):
+        """
+        Local paths of the datasets, fetching those not in the cache.
+        Returns a dictionary dataset_uuid -> Path, datasets that could not be
+        fetched are left out.
+        """
+        paths = dict()
+        missing = []
+        for d in datasets:
+            path = self.object_path(d)
+            try:
+                # the modification time orders the files for eviction
+                os.utime(path)
+                paths[d['dataset_uuid']] = path
+            except FileNotFoundError:
+                # not cached, or evicted by another process
+                missing.append(d)
+
+        if missing:
+            fetched = self.fetcher.fetch(missing)
+            for d in missing:
+                if d['dataset_uuid'] in fetched:
+                    paths[d['dataset_uuid']] = self._store(
+                        d, fetched[d['dataset_uuid']])
+            if self.get_size() > self.max_bytes:
+                self.evict(keep=set(paths.values()))
+
+        return paths
+
+    def _store(self, dataset, src):
+        dst = self.object_path(dataset)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary name first, other processes may share the cache
+        fd, tmp = tempfile.mkstemp(dir=dst.parent, prefix='.')
+        os.close(fd)
+        self.fetcher.transfer(str(src), tmp)
+        os.replace(tmp, dst)
+        size = dst.stat().st_size
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+        return dst
+
+    def scan(self):
+        """(mtime, size, path) of the cached files"""
+        files = []
+        for path in self.objects.glob('*/*'):
+            if path.name.startswith('.'):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def get_size(self):
+        """Size of the cached files, scanned only on first use"""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self.scan())
+            return self._size
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used files until the cache fits in
+        max_bytes. The cache is rescanned, since other processes may share it.
+        """
+        files = self.scan()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            shutil.rmtree(path.parent, ignore_errors=True)
+            total -= size
+
+        with self._lock:
+            self._size = total
+
+    def load(self, key, dataset_types):
+        """
+        Make the datasets of a session available locally, replaces
+        one.load(eID, dataset_types=dataset_types, download_only=True).
+
+        Args:
+            key (dict): restriction of a single session.
+            dataset_types (list of str): dataset type names.
+
+        Returns:
+            list of Path: files in the cached session tree, in the FlatIron
+                layout.
+        """
+        datasets = get_datasets(key, dataset_types)
+        return self.link(datasets, self.get(datasets))
+
+    def link(self, datasets, paths):
+        """
+        Link the cached files of the datasets into the session tree.
+        Returns the list of links, datasets missing in paths are left out.
+        """
+        files = []
+        session_dirs = set()
+        for d in datasets:
+            if d['dataset_uuid'] not in paths:
+                continue
+            link = self.sessions / get_relative_path(d)
+            link.parent.mkdir(parents=True, exist_ok=True)
+            # replace the link atomically, other workers may link the same
+            # session concurrently
+            tmp = link.parent / f'.{link.name}.{uuid.uuid4().hex}'
+            tmp.symlink_to(paths[d['dataset_uuid']])
+            os.replace(tmp, link)
+            files.append(link)
+            session_dirs.add(link.parent)
+
+        # links to evicted files would break alf.io.load_object
+        for session_dir in session_dirs:
+            for link in session_dir.iterdir():
+                if link.name.startswith('.'):
+                    continue
+                if link.is_symlink() and not link.exists():
+                    try:
+                        link.unlink()
+                    except FileNotFoundError:
+                        pass
+
+        return files
+
+
+_cache = None
+_loader = None
+
+
+def get_cache():
+    """Process-wide ALFCache, created on first use"""
+    global _cache
+    if _cache is None:
+        _cache = ALFCache()
+    return _cache
+
+
+@contextmanager
+def use_loader(loader):
+    """
+    Resolve the files of the make functions with loader, an object with a
+    load(key, dataset_types) method, instead of the cache.
+    """
+    global _loader
+    previous, _loader = _loader, loader
+    try:
+        yield loader
+    finally:
+        _loader = previous
+
+
+def load(key, dataset_types):
+    """
+    Local files of the datasets of a session, as returned by
+    ALFCache.load. Called by the make functions of the imported tables.
+    """
+    return (_loader or get_cache()).load(key, dataset_types)
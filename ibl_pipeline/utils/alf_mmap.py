@@ -0,0 +1,80 @@
+'''
+Lazy, memory-mapped loading of large ALF objects such as spikes.
+
+alf.io.load_object reads every file of an object into memory at once. The
+objects returned here only open a file when its attribute is first accessed,
+and map .npy files read-only instead of reading them, so that only the pages
+actually indexed are brought into memory.
+'''
+from pathlib import Path
+import numpy as np
+
+try:
+    import alf.io
+except ImportError:
+    pass
+
+
+class LazyALFObject:
+    """
+    ALF object (e.g. spikes) with attributes loaded on first access, as
+    attributes or items like the alf.io.AlfBunch returned by
+    alf.io.load_object.
+    """
+
+    def __init__(self, alf_path, obj):
+        self._files = dict()
+        for f in sorted(Path(alf_path).glob(f'{obj}.*')):
+            # object.attribute[.extra].extension
+            self._files.setdefault(f.name.split('.')[1], f)
+        if not self._files:
+            raise FileNotFoundError(
+                f'ALF object {obj} not found in {alf_path}')
+        self._loaded = dict()
+
+    def keys(self):
+        return list(self._files)
+
+    def __getitem__(self, attr):
+        if attr not in self._loaded:
+            f = self._files[attr]
+            if f.suffix == '.npy':
+                self._loaded[attr] = np.load(f, mmap_mode='r')
+            else:
+                self._loaded[attr] = alf.io.load_file_content(f)
+        return self._loaded[attr]
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+
+def load_object(alf_path, obj):
+    return LazyALFObject(alf_path, obj)
+
+
+def group_indices(labels, n_groups):
+    """
+    Indices of the elements of each group, as slices of a single sorted index
+    array, instead of one boolean mask over all elements per group.
+
+    Args:
+        labels (array of int): group of each element, e.g. spikes.clusters.
+        n_groups (int): number of groups, labels are in [0, n_groups).
+
+    Returns:
+        order (array of int): element indices sorted by group, in their
+            original order within each group.
+        offsets (array of int): order[offsets[i]:offsets[i+1]] are the
+            indices of group i.
+    """
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_groups)[:n_groups],
+              out=offsets[1:])
+    return order, offsets
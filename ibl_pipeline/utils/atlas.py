@@ -1,49 +1,171 @@
-
 from ibl_pipeline import reference
 import datajoint as dj
+import numpy as np
 import json
 
 
+class BrainRegionOntology:
+    """
+    In-memory index of the brain region hierarchy in reference.BrainRegion,
+    loaded with a single query.
+
+    Regions are stored in arrays indexed by position. The hierarchy is kept
+    as parent and child arrays, a pre-order (Euler) tour with entry/exit
+    positions for O(1) ancestor tests and descendant slices, and the
+    precomputed list of ancestors of every region.
+    """
+
+    def __init__(self, ontology='CCF 2017'):
+
+        self.ontology = ontology
+        self.fingerprint = get_fingerprint(ontology)
+
+        pks, acronyms, names, parents, levels, graph_orders = \
+            (reference.BrainRegion & {'ontology': ontology}).fetch(
+                'brain_region_pk', 'acronym', 'brain_region_name',
+                'parent', 'brain_region_level', 'graph_order')
+
+        n = len(acronyms)
+        self.pks = pks.astype(int)
+        self.acronyms = acronyms
+        self.names = names
+        self.levels = levels
+        self.pk_index = {pk: i for i, pk in enumerate(self.pks)}
+        self.pk_order = np.argsort(self.pks)
+        self.acronym_index = {acronym: i for i, acronym in enumerate(acronyms)}
+
+        # parent position of each region, -1 for the roots
+        self.parent_idx = np.array(
+            [self.pk_index.get(parent, -1) if parent is not None else -1
+             for parent in parents], dtype=int)
+
+        # children of each region, ordered by graph order
+        order = sorted(
+            range(n),
+            key=lambda i: (graph_orders[i] is None, graph_orders[i] or 0, i))
+        self.children = [[] for _ in range(n)]
+        roots = []
+        for i in order:
+            if self.parent_idx[i] < 0:
+                roots.append(i)
+            else:
+                self.children[self.parent_idx[i]].append(i)
+        self.roots = roots
+
+        # pre-order tour; descendants of i are tour[tin[i]+1:tout[i]]
+        self.tour = np.empty(n, dtype=int)
+        self.tin = np.empty(n, dtype=int)
+        self.tout = np.empty(n, dtype=int)
+        self.ancestors = [None] * n
+        position = 0
+        stack = [(root, False) for root in reversed(roots)]
+        while stack:
+            i, visited = stack.pop()
+            if visited:
+                self.tout[i] = position
+                continue
+            self.tin[i] = position
+            self.tour[position] = i
+            position += 1
+            parent = self.parent_idx[i]
+            self.ancestors[i] = [] if parent < 0 else \
+                self.ancestors[parent] + [parent]
+            stack.append((i, True))
+            stack += [(child, False) for child in reversed(self.children[i])]
+
+    def get_acronyms(self, pks):
+        """
+        Acronyms of an array of brain_region_pk, mapped with one vectorised
+        lookup on the sorted pks.
+
+        Raises:
+            KeyError: if any of the pks is not a region of the ontology
+        """
+        pks = np.asarray(pks).astype(int)
+        sorted_pks = self.pks[self.pk_order]
+        pos = np.clip(np.searchsorted(sorted_pks, pks), 0, len(sorted_pks) - 1)
+        unknown = sorted_pks[pos] != pks
+        if np.any(unknown):
+            raise KeyError(
+                f'Unknown brain_region_pk: {np.unique(pks[unknown]).tolist()}')
+        return self.acronyms[self.pk_order[pos]]
+
+    def parent(self, acronym):
+        parent = self.parent_idx[self.acronym_index[acronym]]
+        return None if parent < 0 else self.acronyms[parent]
+
+    def get_parents(self, acronym):
+        """All upper-level regions of a region, from the root down."""
+        return [self.acronyms[i]
+                for i in self.ancestors[self.acronym_index[acronym]]]
+
+    def is_ancestor(self, ancestor, acronym):
+        a = self.acronym_index[ancestor]
+        i = self.acronym_index[acronym]
+        return self.tin[a] < self.tin[i] < self.tout[a]
+
+    def get_descendants(self, acronym):
+        i = self.acronym_index[acronym]
+        return self.acronyms[self.tour[self.tin[i]+1:self.tout[i]]]
+
+    def to_nested_dict(self):
+        """Nested dictionary of the hierarchy, keyed by str((acronym, name))."""
+
+        def subtree(i):
+            return {str((self.acronyms[c], self.names[c])): subtree(c)
+                    for c in self.children[i]}
+
+        return {str((self.acronyms[r], self.names[r])): subtree(r)
+                for r in self.roots}
+
+
+def get_fingerprint(ontology='CCF 2017'):
+    """Count and checksum of the hierarchy, to detect updates of reference.BrainRegion"""
+    return dj.U().aggr(
+        reference.BrainRegion & {'ontology': ontology},
+        n='count(*)',
+        checksum='SUM(CRC32(CONCAT_WS(",", acronym, brain_region_pk, IFNULL(parent, ""))))'
+    ).fetch1('n', 'checksum')
+
+
+_ontologies = dict()
+
+
+def get_ontology(ontology='CCF 2017', validate=False):
+    """
+    Process-wide BrainRegionOntology, loaded on first use.
+
+    Args:
+        ontology (str, optional): Defaults to 'CCF 2017'.
+        validate (bool, optional): if True, reload the index when
+            reference.BrainRegion changed since it was loaded, at the cost
+            of one aggregation query. Defaults to False.
+    """
+    index = _ontologies.get(ontology)
+    if index is None or \
+            (validate and index.fingerprint != get_fingerprint(ontology)):
+        index = _ontologies[ontology] = BrainRegionOntology(ontology)
+    return index
+
+
+def invalidate_ontology():
+    """Drop the cached ontology indices, called after updates of the brain regions"""
+    _ontologies.clear()
+
+
 class BrainAtlas:
 
     def __init__(self):
 
-        self.name_lookup = dict()
-        for acronym, name in zip(*reference.BrainRegion.fetch(
-                'acronym', 'brain_region_name')):
-            self.name_lookup.update({acronym: name})
-
-        self.atlas_dict = dict()
-        for level in (dj.U('brain_region_level') &
-                      reference.BrainRegion).fetch(
-                          'KEY', order_by='brain_region_level'):
-            for acronym, name in zip(*(reference.BrainRegion & level).fetch(
-                    'acronym', 'brain_region_name',
-                    order_by='graph_order')):
-                if level == 0:
-                    self.atlas_dict.update({str((acronym, name)): dict()})
-                else:
-                    self.add_region_to_dict(acronym, name)
-
-    def add_region_to_dict(self, acronym, name):
-
-        current_region = self.atlas_dict
-        parent_list = self.get_parents(acronym)
-        for region in parent_list:
-            current_region = current_region[str((region, self.name_lookup[region]))]
-        current_region.update({str((acronym, name)): dict()})
+        ontology = get_ontology(validate=True)
+        self.name_lookup = dict(zip(ontology.acronyms, ontology.names))
+        self.atlas_dict = ontology.to_nested_dict()
 
     @staticmethod
     def get_parents(acronym):
-        parent_list = []
-        while reference.ParentRegion & dict(acronym=acronym):
-            acronym = (reference.ParentRegion &
-                       dict(acronym=acronym)).fetch1('parent')
-            parent_list.append(acronym)
-
-        return parent_list[::-1]
+        return get_ontology().get_parents(acronym)
 
-    def to_json(filename='/data/atlas.json'):
+    def to_json(self, filename='/data/atlas.json'):
 
-        with open('atlas.json', 'w') as json_file:
+        with open(filename, 'w') as json_file:
             json.dump(self.atlas_dict, json_file)
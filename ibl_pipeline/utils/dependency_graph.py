@@ -0,0 +1,78 @@
+'''
+Order of the tables in the dependency graph of the database, for deletions
+that bypass the cascading delete of DataJoint.
+'''
+import datajoint as dj
+
+
+def load_graph(connection=None):
+    """Dependency graph of the schemas activated on the connection"""
+    graph = (connection or dj.conn()).dependencies
+    graph.load()
+    return graph
+
+
+def get_deletion_order(graph, tables, get_table=None):
+    """
+    Sort tables (or restricted tables) so that children come before their
+    parents and part tables before their masters. A table has strictly more
+    ancestors than each of its parents; tables of the same rank keep their
+    order. get_table extracts the table of an item if tables are not tables,
+    e.g. tuples.
+    """
+    get_table = get_table or (lambda t: t)
+    n_ancestors = {
+        name: len(graph.ancestors(name))
+        for name in {get_table(t).full_table_name for t in tables}}
+    return sorted(
+        tables, key=lambda t: -n_ancestors[get_table(t).full_table_name])
+
+
+class Closure:
+    """
+    Descendant tables of a table in topological order, with the foreign keys
+    to their parents within the descendants, computed once from the graph so
+    that the closure of many restrictions of the table can be built without
+    walking the graph again.
+    """
+
+    def __init__(self, graph, full_table_name):
+        self.full_table_name = full_table_name
+        # (table name, [(parent name, {attribute: parent attribute})])
+        self.tables = []
+        names = {full_table_name}
+        for node in graph.descendants(full_table_name)[1:]:
+            # renamed foreign keys go through an alias node, e.g. '3'
+            if node.isdigit():
+                continue
+            parents = []
+            for parent, _, props in graph.in_edges(node, data=True):
+                if parent.isdigit():
+                    parent = next(iter(graph.in_edges(parent)))[0]
+                if parent not in names:
+                    continue
+                parents.append((parent, dict(props['attr_map'])))
+            names.add(node)
+            self.tables.append((node, parents))
+
+    def get_keys(self, root, chunksz=1000):
+        """
+        Primary keys of root, a restriction of the table, and of the rows of
+        its descendants that reference them, as a list of
+        (full_table_name, keys) in topological order. The keys are fetched
+        once per table, top-down: each table is restricted by the distinct
+        foreign key values of the keys of its parents, chunksz at a time.
+        """
+        keys = {self.full_table_name: root.fetch('KEY')}
+        for node, parents in self.tables:
+            restrictions = {
+                tuple((attr, key[ref]) for attr, ref in attr_map.items())
+                for parent, attr_map in parents for key in keys[parent]}
+            restrictions = [dict(r) for r in restrictions]
+            table = dj.FreeTable(root.connection, node)
+            node_keys = dict()
+            for i in range(0, len(restrictions), chunksz):
+                for key in (table & restrictions[i:i+chunksz]).fetch('KEY'):
+                    node_keys[tuple(key.items())] = key
+            keys[node] = list(node_keys.values())
+        return list(keys.items())
@@ -5,6 +5,8 @@ import datajoint as dj
 from ibl_pipeline import reference, subject, acquisition
 from ibl_pipeline import update
 from uuid import UUID
+import numpy as np
+import pandas as pd
 
 
 def show(tablepairs, comment=''):
@@ -41,84 +43,143 @@ def get_user(key):
     return user
 
 
+def get_users(keys, records):
+    """
+    Responsible user and email of each record, resolved with one join per
+    user table, with the same precedence as get_user.
+
+    Args:
+        keys (dj query): query of the keys of the records
+        records (pandas.DataFrame): records with the primary key columns
+
+    Returns:
+        pandas.DataFrame: records with the columns responsible_user and
+            user_email, null where no user is found
+    """
+    pk = keys.primary_key
+    records = records.assign(responsible_user=None)
+
+    for table, user_attr in [(acquisition.SessionUser, 'user_name'),
+                             (subject.SubjectUser, 'responsible_user'),
+                             (reference.LabMember, 'user_name')]:
+        common = [attr for attr in pk if attr in table.heading.names]
+        if not common:
+            continue
+        candidates = pd.DataFrame(
+            (table & keys).fetch(*common, user_attr, as_dict=True),
+            columns=common + [user_attr], dtype=object)
+        if not len(candidates):
+            continue
+        # a user is only assigned when the key matches exactly one entry
+        candidates = candidates[
+            candidates.groupby(common)[user_attr].transform('count') == 1]
+        users = records[common].merge(
+            candidates.rename(columns={user_attr: 'user'}),
+            on=common, how='left')['user'].values
+        missing = records['responsible_user'].isnull().values
+        records.loc[missing, 'responsible_user'] = users[missing]
+
+    emails = dict(zip(*reference.LabMember.fetch('user_name', 'email')))
+    records['user_email'] = records['responsible_user'].map(emails)
+    return records
+
+
+def _records(query, attrs, order_by):
+    return pd.DataFrame(query.fetch(*attrs, order_by=order_by, as_dict=True),
+                        columns=attrs, dtype=object)
+
+
+def _with_users(record, user, email):
+    if not pd.isnull(user):
+        record.update(responsible_user=user)
+        if not pd.isnull(email):
+            record.update(user_email=email)
+    return record
+
+
 def diff(tablenames, tablepairs):
     # tablepairs [shadow, real]
     for t in tablenames:
-        ndiffs = 0
-        ndels = 0
         shadow, real = tablepairs[t]
+        table = real.__module__+'.'+real.__name__
+        pk = real.primary_key
+        kstr = ', '.join(pk)
 
-        # only detect deleted entries in the shadow table
-        for deleted_key in (real - shadow.proj(*real.primary_key)).fetch('KEY'):
+        real_ts = [attr for attr in real.heading.names if '_ts' in attr][0]
+        shadow_ts = [attr for attr in shadow.heading.names if '_ts' in attr][0]
 
-            deleted_entry = (real & deleted_key).fetch1()
-            deleted_record = dict(
-                table=real.__module__+'.'+real.__name__,
+        # only detect deleted entries in the shadow table
+        deleted_keys = real.proj() - shadow.proj(*pk)
+        deleted = _records(real & deleted_keys, pk + [real_ts], kstr)
+        deleted = get_users(deleted_keys, deleted)
+
+        deletion_records = []
+        for record in deleted.to_dict('records'):
+            deleted_key = {attr: record[attr] for attr in pk}
+            deletion_records.append(_with_users(dict(
+                table=table,
                 pk_hash=UUID(dj.hash.key_hash(deleted_key)),
-                original_ts=deleted_entry[[key for key in deleted_entry.keys() if '_ts' in key][0]],
+                original_ts=record[real_ts],
                 pk_dict=deleted_key,
                 deletion_narrative='{} only in {} - record deleted?'.format(
                     deleted_key, real),
-            )
-
-            user = get_user(deleted_key)
-            if user:
-                email = \
-                    (reference.LabMember &
-                     'user_name="{}"'.format(user)).fetch1(
-                         'email'
-                     )
-                deleted_record.update(
-                    responsible_user=user,
-                    user_email=email
-                )
-
-            update.DeletionRecord.insert1(deleted_record, skip_duplicates=True)
-            ndels += 1
+            ), record['responsible_user'], record['user_email']))
+
+        update.DeletionRecord.insert(deletion_records, skip_duplicates=True)
 
         # detect updates in common records of shadow and real tables
-        common_records = (real.proj() & shadow.proj(*real.primary_key))
-        kstr = ', '.join(real.primary_key)
-        shadow_records = (shadow & common_records).fetch(
-            order_by=kstr, as_dict=True)
-        real_records = (real & common_records.proj()).fetch(
-            order_by=kstr, as_dict=True)
-        real_keys = (real & common_records.proj()).fetch('KEY', order_by=kstr)
-
-        for shadow_record, real_record, pk in \
-                zip(shadow_records, real_records, real_keys):
-
-            for attr in shadow_record:
-                shadow_value = shadow_record[attr]
-                real_value = real_record[attr]
-
-                if shadow_value != real_value and \
-                        (isinstance(shadow_value, str) and
-                            '_ts' not in shadow_value):
-
-                    update_record = dict(
-                        table=real.__module__+'.'+real.__name__,
-                        attribute=attr,
-                        pk_hash=UUID(dj.hash.key_hash(pk)),
-                        original_ts=real_record[[key for key in real_record.keys() if '_ts' in key][0]],
-                        update_ts=shadow_record[[key for key in shadow_record.keys() if '_ts' in key][0]],
-                        pk_dict=pk,
-                        original_value=real_value,
-                        updated_value=shadow_value,
-                        update_narrative='{t}.{a}: {s} != {d}'.format(
-                            t=t, a=attr, s=shadow_value, d=real_value)
-                    )
-                    user = get_user(pk)
-                    if user:
-                        update_record.update(
-                            responsible_user=user,
-                            user_email=email
-                        )
-                    update.UpdateRecord.insert1(update_record, skip_duplicates=True)
-                    ndiffs += 1
-
-        print('# {} total deleted records in table {}.'.format(ndels, t))
-        print('# {} total differences in table {}.'.format(ndiffs, t))
+        common_records = (real.proj() & shadow.proj(*pk))
+        attrs = [attr for attr in real.heading.secondary_attributes
+                 if attr in shadow.heading.names and '_ts' not in attr]
+        merged = _records(
+            real & common_records, pk + [real_ts] + attrs, kstr).merge(
+                _records(shadow & common_records,
+                         pk + list(dict.fromkeys([shadow_ts] + attrs)), kstr),
+                on=pk, suffixes=('_real', '_shadow'))
+        ts_real, ts_shadow = (real_ts, shadow_ts) if real_ts != shadow_ts \
+            else (real_ts + '_real', shadow_ts + '_shadow')
+
+        # per-column masks of the string values that differ
+        masks = {
+            attr: np.array([
+                isinstance(shadow_value, str) and shadow_value != real_value
+                for shadow_value, real_value in zip(
+                    merged[attr + '_shadow'].values,
+                    merged[attr + '_real'].values)], dtype=bool)
+            for attr in attrs}
+        changed = np.any(list(masks.values()), axis=0) if masks \
+            else np.zeros(len(merged), dtype=bool)
+        merged = merged.assign(**{attr + '_changed': mask
+                                  for attr, mask in masks.items()})[changed]
+        merged = get_users(common_records, merged)
+
+        update_records = []
+        for record in merged.to_dict('records'):
+            key = {attr: record[attr] for attr in pk}
+            for attr in attrs:
+                if not record[attr + '_changed']:
+                    continue
+                shadow_value = record[attr + '_shadow']
+                real_value = record[attr + '_real']
+                update_records.append(_with_users(dict(
+                    table=table,
+                    attribute=attr,
+                    pk_hash=UUID(dj.hash.key_hash(key)),
+                    original_ts=record[ts_real],
+                    update_ts=record[ts_shadow],
+                    pk_dict=key,
+                    original_value=real_value,
+                    updated_value=shadow_value,
+                    update_narrative='{t}.{a}: {s} != {d}'.format(
+                        t=t, a=attr, s=shadow_value, d=real_value)
+                ), record['responsible_user'], record['user_email']))
+
+        update.UpdateRecord.insert(update_records, skip_duplicates=True)
+
+        print('# {} total deleted records in table {}.'.format(
+            len(deletion_records), t))
+        print('# {} total differences in table {}.'.format(
+            len(update_records), t))
 
 
 def drop(schemas):
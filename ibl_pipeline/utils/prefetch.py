@@ -0,0 +1,137 @@
+'''
+Populate driver that downloads the ALF files of the next keys on a thread
+pool while the current key is computed.
+
+Tables opt in by listing the dataset types their make loads through
+alf_cache.load in a dataset_types class attribute. The file lookups in the
+database stay in the main thread, only the transfers run in the pool.
+'''
+from ibl_pipeline.utils import alf_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import datajoint as dj
+import time
+
+
+def get_session_key(key):
+    return key['subject_uuid'], key['session_start_time']
+
+
+class PrefetchLoader:
+    """
+    Loader for alf_cache.use_loader serving the files fetched in advance.
+
+    Args:
+        dataset_types (list of str): dataset types to prefetch for each key.
+        cache (alf_cache.ALFCache, optional): defaults to alf_cache.get_cache().
+        n_workers (int, optional): number of download threads.
+    """
+
+    def __init__(self, dataset_types, cache=None, n_workers=4):
+        self.dataset_types = dataset_types
+        self.cache = cache or alf_cache.get_cache()
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.pending = dict()
+        # time make spent waiting for files
+        self.download_time = 0
+
+    def prefetch(self, key):
+        session_key = get_session_key(key)
+        if session_key not in self.pending:
+            datasets = alf_cache.get_datasets(key, self.dataset_types)
+            self.pending[session_key] = (
+                datasets, self.executor.submit(self.cache.get, datasets))
+
+    def load(self, key, dataset_types):
+        start = time.time()
+        if dataset_types == self.dataset_types:
+            self.prefetch(key)
+            datasets, future = self.pending.pop(get_session_key(key))
+            files = self.cache.link(datasets, future.result())
+        else:
+            files = self.cache.load(key, dataset_types)
+        self.download_time += time.time() - start
+        return files
+
+    def shutdown(self):
+        for _, future in self.pending.values():
+            future.cancel()
+        self.executor.shutdown()
+
+
+@contextmanager
+def timed_inserts(timer):
+    """Accumulate the time spent in Table.insert (and insert1) in timer['insert']"""
+    insert = dj.Table.insert
+
+    def timed_insert(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return insert(self, *args, **kwargs)
+        finally:
+            timer['insert'] += time.time() - start
+
+    dj.Table.insert = timed_insert
+    try:
+        yield timer
+    finally:
+        dj.Table.insert = insert
+
+
+def populate(table, *restrictions, keys=None, lookahead=4, n_workers=4,
+             **kwargs):
+    """
+    Populate table key by key, downloading the files of the next lookahead
+    keys in the background. Tables without dataset_types are populated as
+    usual.
+
+    Args:
+        table (dj.Imported): table to populate.
+        restrictions: restrictions of the key_source, as in populate.
+        keys (list of dict, optional): keys left to populate, if already
+            fetched by the caller.
+        lookahead (int, optional): number of keys prefetched ahead.
+        n_workers (int, optional): number of download threads.
+        kwargs: passed to populate, e.g. suppress_errors.
+
+    Returns:
+        dict: number of keys, errors, and the download, compute and insert
+            time in seconds.
+    """
+    timer = dict(table=table.__name__, n_keys=0, errors=[],
+                 download=0, compute=0, insert=0)
+
+    if not getattr(table, 'dataset_types', None):
+        start = time.time()
+        with timed_inserts(timer):
+            errors = table.populate(*restrictions, **kwargs)
+        timer['compute'] = time.time() - start - timer['insert']
+        timer['errors'] = errors or []
+        return timer
+
+    kwargs.pop('display_progress', None)
+    if keys is None:
+        keys = ((table.key_source & dj.AndList(restrictions)) -
+                table.proj()).fetch('KEY')
+    timer['n_keys'] = len(keys)
+
+    loader = PrefetchLoader(table.dataset_types, n_workers=n_workers)
+    start = time.time()
+    try:
+        with alf_cache.use_loader(loader), timed_inserts(timer):
+            for i, key in enumerate(keys):
+                for next_key in keys[i:i + lookahead + 1]:
+                    loader.prefetch(next_key)
+                errors = table.populate(key, **kwargs)
+                if errors:
+                    timer['errors'].extend(errors)
+    finally:
+        loader.shutdown()
+
+    timer['download'] = loader.download_time
+    timer['compute'] = \
+        time.time() - start - timer['download'] - timer['insert']
+    print('{table}: {n_keys} keys, {n_errors} errors, download {download:.1f} s, '
+          'compute {compute:.1f} s, insert {insert:.1f} s'.format(
+              n_errors=len(timer['errors']), **timer))
+    return timer
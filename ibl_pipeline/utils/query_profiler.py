@@ -0,0 +1,166 @@
+'''
+Opt-in profiler of the statements sent to the database by the make functions.
+
+When the environment variable DJ_QUERY_PROFILE is set, the functions
+decorated with @profiled (populate_behavior.main, populate_ephys.main,
+ingest_shadow.main) wrap the connection's query method for the duration of
+each make. The number of statements, their total latency and the most
+frequent statement templates are collected per table and printed as a
+ranked report when the function returns. The report is also written as json
+to the path in DJ_QUERY_PROFILE if it is not '1'.
+
+Usage:
+    DJ_QUERY_PROFILE=1 python ibl_pipeline/process/populate_behavior.py
+'''
+from datajoint.autopopulate import AutoPopulate
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import functools
+import json
+import os
+import re
+import time
+
+
+PROFILE_FLAG = 'DJ_QUERY_PROFILE'
+
+# literals, placeholders and IN lists are replaced to group statements differing only by values
+LITERALS = [
+    (re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\""), '?'),
+    (re.compile(r'\b\d+(\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)'), '(?, ...)'),
+    (re.compile(r'(\(\?, \.\.\.\)\s*,\s*)+\(\?, \.\.\.\)'), '(?, ...), ...'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def get_template(sql):
+    for pattern, replacement in LITERALS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class QueryProfile:
+    """Statements issued by the make functions, per table"""
+
+    def __init__(self):
+        self.tables = defaultdict(lambda: dict(
+            n_makes=0, n_statements=0, latency=0.,
+            templates=Counter(), template_latency=Counter()))
+        # tables whose make is running, the innermost is charged
+        self.stack = []
+
+    def add(self, sql, latency):
+        if not self.stack:
+            return
+        stats = self.tables[self.stack[-1]]
+        template = get_template(sql)
+        stats['n_statements'] += 1
+        stats['latency'] += latency
+        stats['templates'][template] += 1
+        stats['template_latency'][template] += latency
+
+    @contextmanager
+    def make(self, table_name):
+        self.tables[table_name]['n_makes'] += 1
+        self.stack.append(table_name)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+
+    def summary(self, n_templates=5):
+        """Tables ranked by number of statements, with their top templates"""
+        summary = []
+        for table_name, stats in self.tables.items():
+            summary.append(dict(
+                table=table_name,
+                n_makes=stats['n_makes'],
+                n_statements=stats['n_statements'],
+                statements_per_make=stats['n_statements'] / max(stats['n_makes'], 1),
+                latency=stats['latency'],
+                top_templates=[
+                    dict(template=template, count=count,
+                         latency=stats['template_latency'][template])
+                    for template, count in
+                    stats['templates'].most_common(n_templates)]
+            ))
+        return sorted(summary, key=lambda s: s['n_statements'], reverse=True)
+
+    def report(self, n_templates=5):
+        lines = ['Statements issued by make, per table:']
+        for s in self.summary(n_templates):
+            lines.append(
+                '{table}: {n_statements} statements in {n_makes} makes '
+                '({statements_per_make:.1f} per make), {latency:.2f} s'.format(**s))
+            for t in s['top_templates']:
+                lines.append(
+                    '    {count:>8} x {latency:8.2f} s  {template:.200}'.format(**t))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profile_makes(profile):
+    """Collect the statements of every make run within the block into profile"""
+    populate = AutoPopulate.populate
+
+    def profiled_populate(self, *args, **kwargs):
+        make = self.make
+        table_name = f'{self.database}.{self.__class__.__name__}'
+
+        def profiled_make(key):
+            conn = self.connection
+            patched_conn = 'query' in vars(conn)
+            query = conn.query
+
+            def timed_query(sql, *args, **kwargs):
+                start = time.time()
+                try:
+                    return query(sql, *args, **kwargs)
+                finally:
+                    profile.add(sql, time.time() - start)
+
+            conn.query = timed_query
+            try:
+                with profile.make(table_name):
+                    return make(key)
+            finally:
+                if patched_conn:
+                    conn.query = query
+                else:
+                    del conn.query
+
+        self.make = profiled_make
+        try:
+            return populate(self, *args, **kwargs)
+        finally:
+            del self.make
+
+    AutoPopulate.populate = profiled_populate
+    try:
+        yield profile
+    finally:
+        AutoPopulate.populate = populate
+
+
+def profiled(func):
+    """
+    Profile the make functions run by func when DJ_QUERY_PROFILE is set, and
+    print the report when it returns.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        flag = os.environ.get(PROFILE_FLAG)
+        if not flag:
+            return func(*args, **kwargs)
+
+        with profile_makes(QueryProfile()) as profile:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                print(profile.report())
+                if flag != '1':
+                    with open(flag, 'w') as f:
+                        json.dump(profile.summary(), f, indent=1)
+    return wrapper
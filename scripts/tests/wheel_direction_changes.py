@@ -0,0 +1,45 @@
+'''
+Benchmark of the direction change extraction of WheelMoveSet on a synthetic
+long ephys session: the previous loop over movements against the
+searchsorted-based get_direction_changes.
+'''
+import numpy as np
+import time
+from ibl_pipeline.group_shared.wheel import get_direction_changes
+
+
+def direction_changes_loop(ts, change_mask, intervals):
+    changes = []
+    for i, (on, off) in enumerate(intervals):
+        mask = np.logical_and(ts > on, ts < off)
+        ind = np.logical_and(mask, change_mask)
+        changes.extend((i, j, t) for j, t in enumerate(ts[ind]))
+    return changes
+
+
+def synthetic_session(duration=2*3600, fs=1000, n_moves=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    ts = np.arange(0, duration, 1 / fs)
+    vel = np.convolve(rng.standard_normal(ts.size), np.ones(50) / 50, 'same')
+    change_mask = np.insert(np.diff(np.sign(vel)) != 0, 0, 0)
+
+    bounds = np.sort(rng.choice(ts[1:-1], 2 * n_moves, replace=False))
+    return ts, change_mask, bounds.reshape(-1, 2)
+
+
+if __name__ == '__main__':
+
+    ts, change_mask, intervals = synthetic_session()
+    print(f'{ts.size} samples, {len(intervals)} movements, '
+          f'{change_mask.sum()} direction changes')
+
+    start = time.time()
+    expected = direction_changes_loop(ts, change_mask, intervals)
+    print(f'loop over movements: {time.time() - start:.2f} s')
+
+    start = time.time()
+    move_ids, change_ids, change_times = get_direction_changes(
+        ts[change_mask], intervals)
+    print(f'searchsorted: {time.time() - start:.3f} s')
+
+    assert expected == list(zip(move_ids, change_ids, change_times))
@@ -0,0 +1,38 @@
+'''
+This script adds the attribute quiescent_period to behavior.Settings, and fills
+it for the existing entries from their task settings, so that MovementTimes
+does not fall back to loading the settings with ONE for these sessions.
+'''
+import datajoint as dj
+from ibl_pipeline import behavior
+from ibl_pipeline import behavior_shared
+from ibl_pipeline.utils import alf_cache
+from tqdm import tqdm
+import alf.io
+
+
+if __name__ == '__main__':
+
+    if 'quiescent_period' not in behavior.Settings.heading.attributes:
+        print('Adding quiescent_period to behavior.Settings...')
+        behavior.Settings.alter(prompt=False, context=vars(behavior_shared))
+        behavior.Settings._heading = None
+
+    keys = (behavior.Settings & 'quiescent_period is NULL').fetch('KEY')
+    print(f'Filling quiescent_period of {len(keys)} sessions...')
+    n_missing = 0
+    for key in tqdm(keys, position=0):
+        try:
+            files = alf_cache.load(key, behavior.Settings.dataset_types)
+            setting = alf.io.load_file_content(files[0])
+            quiescent_period = setting.get('QUIESCENT_PERIOD')
+        except Exception:
+            quiescent_period = None
+
+        if quiescent_period is None:
+            n_missing += 1
+            continue
+        dj.Table._update(behavior.Settings & key, 'quiescent_period',
+                         quiescent_period)
+
+    print(f'{n_missing} sessions have no quiescent period in their settings')